@@ -1,5 +1,6 @@
 import os
 import json
+import math
 import base64
 import streamlit as st
 from dotenv import set_key
@@ -7,6 +8,11 @@ import assist
 
 from settings import *
 from helpers import *
+from ingredients import get_ingredient_index
+from metrics import read_metrics
+from pump_profiles import PumpProfiles, get_pump_profiles, save_pump_profiles
+from order_queue import get_order_queue, size_label
+from pump_daemon import connect
 
 # Import your controller module
 import controller
@@ -32,14 +38,45 @@ if 'selected_cocktail' not in st.session_state:
 
 
 saved_config = load_saved_config()
-# Load the cocktails from file
-cocktail_data = {}
-if os.path.exists(COCKTAILS_FILE):
-    try:
-        with open(COCKTAILS_FILE, 'r') as f:
-            cocktail_data = json.load(f)
-    except Exception as e:
-        st.error(f'Error loading cocktails: {e}')
+# Load the cocktails from cocktails.json or the database
+cocktail_data = load_cocktails()
+
+
+def wait_for_pour(executor_watcher, note, message):
+    """
+    Wait for a drink while counting down in `note`. Updating the note every
+    moment lets Streamlit interrupt the wait when another button (such as
+    Emergency Stop) is pressed.
+    """
+    while not executor_watcher.wait(timeout=0.25):
+        note.info(f'{message} ready in about {math.ceil(executor_watcher.remaining() or 0)} seconds')
+    note.empty()
+
+
+# Drinks and maintenance go to the pump daemon when it's running. Without one, drinks are
+# poured through the order queue shared with the touchscreen, by whichever process owns the pumps.
+pump_client = connect()
+order_queue = pump_client or get_order_queue()
+pump_control = pump_client or controller
+
+
+def pour_order(cocktail, size, note, message):
+    """Queue a drink and wait for it while counting down in `note`."""
+    order = order_queue.enqueue(cocktail, size, source='web')
+    if order.position:
+        message = f'{message} (order #{order.id}, {order.position} ahead of you)'
+    wait_for_pour(order_queue.watch(order.id), note, message)
+
+
+# ---------- Emergency Stop ----------
+# Rendered before everything else so it runs as soon as the page reruns
+if st.button('Emergency Stop', type='primary', help='Stop every pump now and cancel queued drinks'):
+    stopped = order_queue.emergency_stop()
+    aborted = [pour for watcher in stopped for pour in watcher.pours if pour.state == controller.Pour.ABORTED]
+    if aborted:
+        st.warning('All pumps stopped. Poured before stopping: ' + ', '.join(f'{pour.ingredient_name} {pour.poured:.2f} of {pour.amount:g} oz' for pour in aborted))
+    else:
+        st.warning('All pumps stopped.')
 
 
 # ---------- Tabs ----------
@@ -112,27 +149,176 @@ with tabs[0]:
 with tabs[1]:
     st.title('Settings')
 
-    st.subheader('Prime Pumps')
-    if st.button('Prime Pumps'):
-        st.info('Priming all pumps for 10 seconds each...')
+    st.subheader('Prime & Clean Pumps')
+    st.markdown('Pick the pumps to run and how long to run each one. Priming runs the pumps forward, cleaning runs them in reverse.')
+    maintenance_rows = [
+        {
+            'Pump': f'Pump {index + 1}',
+            'Ingredient': saved_config.get(f'Pump {index + 1}', ''),
+            'Run': True,
+            'Seconds': 10.0,
+        }
+        for index in range(len(controller.MOTORS))
+    ]
+    maintenance_plan = st.data_editor(
+        maintenance_rows,
+        disabled=['Pump', 'Ingredient'],
+        hide_index=True,
+        key='maintenance_plan',
+    )
+    maintenance_concurrency = st.slider(
+        'Pumps at once',
+        min_value=1,
+        max_value=len(controller.MOTORS),
+        value=min(MAINTENANCE_CONCURRENCY, len(controller.MOTORS)),
+        help='Limit this to what your power supply can run at the same time.',
+    )
+    durations = {
+        index: float(row['Seconds'] or 0)
+        for index, row in enumerate(maintenance_plan) if row['Run']
+    }
+
+    def show_maintenance_progress(placeholder):
+        def update(progress):
+            with placeholder.container():
+                for pump in progress:
+                    finished = pump.state in (controller.Pour.DONE, controller.Pour.ABORTED)
+                    done = 1.0 if finished else 1.0 - (pump.remaining or 0.0) / pump.seconds
+                    label = f'Pump {pump.pump_index + 1}: {pump.state}'
+                    if not finished:
+                        label += f' ({math.ceil(pump.remaining or 0)} s left)'
+                    st.progress(min(max(done, 0.0), 1.0), text=label)
+        return update
+
+    if not order_queue.is_owner:
+        st.info('Another process (usually the touchscreen) is driving the pumps, so priming, cleaning and test pours are only available there.')
+    prime_col, clean_col = st.columns(2)
+    prime_clicked = prime_col.button('Prime Pumps', disabled=not durations or not order_queue.is_owner)
+    clean_clicked = clean_col.button('Clean Pumps', disabled=not durations or not order_queue.is_owner)
+    maintenance_status = st.empty()
+    if prime_clicked:
         try:
-            controller.prime_pumps(duration=10)
-            st.success('Pumps primed successfully!')
+            watcher = pump_control.prime_pumps(durations, pumps=list(durations), concurrency=maintenance_concurrency, callback=show_maintenance_progress(maintenance_status))
+            if watcher.cancelled:
+                st.warning('Priming was stopped.')
+            else:
+                st.success('Pumps primed successfully!')
         except Exception as e:
             st.error(f'Error priming pumps: {e}')
-
-    # NEW: Clean Pumps
-    st.subheader('Clean Pumps')
-    if st.button('Clean Pumps'):
-        st.info('Reversing all pumps for 10 seconds each (cleaning mode)...')
+    if clean_clicked:
         try:
-            controller.clean_pumps(duration=10)
-            st.success('All pumps reversed (cleaned).')
+            watcher = pump_control.clean_pumps(durations, pumps=list(durations), concurrency=maintenance_concurrency, callback=show_maintenance_progress(maintenance_status))
+            if watcher.cancelled:
+                st.warning('Cleaning was stopped.')
+            else:
+                st.success('All pumps reversed (cleaned).')
         except Exception as e:
             st.error(f'Error cleaning pumps: {e}')
 
+    st.subheader('Calibrate Pumps')
+    st.markdown('Put a measuring glass under the pump, run a test pour and enter how much came out. Test pours of two or more lengths also measure the dead volume of the line.')
+    calibration_pump = st.selectbox(
+        'Pump to calibrate',
+        range(len(controller.MOTORS)),
+        format_func=lambda index: f"Pump {index + 1} ({saved_config.get(f'Pump {index + 1}') or 'empty'})",
+    )
+    calibration_seconds = st.number_input('Test pour seconds', min_value=1.0, value=10.0, step=1.0)
+    calibration_samples = st.session_state.setdefault('calibration_samples', {}).setdefault(calibration_pump, [])
+    if st.button('Run Test Pour', disabled=not order_queue.is_owner):
+        note = st.info('Test pouring...')
+        try:
+            wait_for_pour(pump_control.calibration_pour(calibration_pump, calibration_seconds), note, 'Test pouring...')
+        except Exception as e:
+            st.error(f'Error while pouring: {e}')
+    measured_ounces = st.number_input('Measured ounces', min_value=0.0, value=0.0, step=0.05)
+    if st.button('Add Measurement', disabled=measured_ounces <= 0):
+        calibration_samples.append((calibration_seconds, measured_ounces))
+    if calibration_samples:
+        st.dataframe([{'Seconds': seconds, 'Ounces': ounces} for seconds, ounces in calibration_samples], hide_index=True)
+    current_profile = get_pump_profiles()[calibration_pump]
+    if current_profile.seconds_per_oz is None:
+        st.caption(f'Not calibrated yet. Using OZ_COEFFICIENT ({OZ_COEFFICIENT:g} seconds per oz).')
+    else:
+        st.caption(f'Calibrated at {current_profile.seconds_per_oz:g} seconds per oz with {current_profile.dead_volume:g} oz dead volume.')
+    if st.button('Save Calibration', disabled=not calibration_samples):
+        try:
+            profile = controller.calibrate_pump(calibration_pump, calibration_samples)
+            calibration_samples.clear()
+            st.success(f'Pump {calibration_pump + 1} calibrated: {profile.seconds_per_oz:g} seconds per oz, {profile.dead_volume:g} oz dead volume.')
+        except ValueError as e:
+            st.error(f'Error calibrating pump: {e}')
+
+    st.subheader('Pump Power')
+    if POWER_BUDGET > 0:
+        st.markdown(f'Pumps are started together only while their total current draw stays within the {POWER_BUDGET:g} A power budget.')
+    else:
+        st.markdown(f'Set POWER_BUDGET to your power supply\'s safe current to limit pumps by current draw instead of running {PUMP_CONCURRENCY} at a time.')
+    pump_profiles = get_pump_profiles()
+    power_rows = st.data_editor(
+        [
+            {
+                'Pump': f'Pump {index + 1}',
+                'Ingredient': saved_config.get(f'Pump {index + 1}', ''),
+                'Current draw (A)': pump_profiles[index].current_draw,
+            }
+            for index in range(len(controller.MOTORS))
+        ],
+        disabled=['Pump', 'Ingredient'],
+        hide_index=True,
+        key='pump_power',
+    )
+    if st.button('Save Pump Power'):
+        updated_profiles = PumpProfiles(pump_profiles.to_json())
+        for index, row in enumerate(power_rows):
+            updated_profiles.set(index, current_draw=float(row['Current draw (A)'] or 0))
+        save_pump_profiles(updated_profiles)
+        st.success('Pump power saved.')
+
+    st.subheader('Pump Metrics')
+    samples = read_metrics(METRICS_FILE) if METRICS_FILE else []
+    if not samples:
+        st.info('No pour metrics yet. They are recorded after each drink.')
+    else:
+        def metric_value(name, **labels):
+            return sum(value for sample_name, sample_labels, value in samples if sample_name == name and all(sample_labels.get(key) == str(label) for key, label in labels.items()))
+
+        def metric_mean(name, **labels):
+            count = metric_value(f'{name}_count', **labels)
+            return metric_value(f'{name}_sum', **labels) / count if count else 0.0
+
+        drinks_col, latency_col, wait_col = st.columns(3)
+        drinks_col.metric('Drinks poured', int(metric_value('tipsy_drinks_total')))
+        latency_col.metric('Mean drink time', f"{metric_mean('tipsy_drink_latency_seconds'):.1f} s")
+        wait_col.metric('Mean queue wait', f"{metric_mean('tipsy_queue_wait_seconds'):.1f} s")
+        st.dataframe(
+            [
+                {
+                    'Pump': f'Pump {index + 1}',
+                    'Ingredient': saved_config.get(f'Pump {index + 1}', ''),
+                    'Pours': int(metric_value('tipsy_pours_total', pump=index + 1)),
+                    'Ounces': round(metric_value('tipsy_ounces_poured_total', pump=index + 1), 2),
+                    'Mean pour (s)': round(metric_mean('tipsy_pour_duration_seconds', pump=index + 1), 2),
+                    'Mean retraction (s)': round(metric_mean('tipsy_retraction_seconds', pump=index + 1), 2),
+                    'Mean timing error (ms)': round(metric_mean('tipsy_actuation_error_seconds', pump=index + 1) * 1000, 3),
+                }
+                for index in range(len(controller.MOTORS))
+            ],
+            hide_index=True,
+        )
+        st.caption(f'Read from {METRICS_FILE}, in Prometheus text format.')
+
 # ================ TAB 3: Cocktail Menu ================
 with tabs[2]:
+    active_orders = order_queue.orders()
+    if active_orders:
+        st.subheader('Order Queue')
+        for order in active_orders:
+            order_cols = st.columns([4, 1])
+            ready = 'unknown' if order.eta is None else f'about {math.ceil(order.eta)} seconds'
+            order_cols[0].write(f'#{order.id} {size_label(order.size)} {order.name}: {order.status}, ready in {ready}')
+            if order_cols[1].button('Cancel', key=f'cancel_order_{order.id}'):
+                order_queue.cancel(order.id)
+                st.rerun()
     st.markdown('<h1 style="text-align: center;">Cocktail Menu</h1>', unsafe_allow_html=True)
 
     if st.session_state.selected_cocktail:
@@ -168,6 +354,7 @@ with tabs[2]:
             # Show the recipe
             st.markdown('<h2 style="text-align: center;">Recipe</h2>', unsafe_allow_html=True)
             recipe_adjustments = {}
+            ingredient_index = get_ingredient_index()
             for ingredient, measurement in selected_cocktail.get('ingredients', {}).items():
                 parts = measurement.split()
                 try:
@@ -177,8 +364,9 @@ with tabs[2]:
                     default_value = 1.0
                     unit = measurement
 
+                pump_label = ingredient_index.pump_label(ingredient) or 'not on a pump'
                 value = st.slider(
-                    f'{ingredient} ({measurement})',
+                    f'{ingredient} ({measurement}) - {pump_label}',
                     min_value=0.0,
                     max_value=default_value * 4,
                     value=default_value,
@@ -192,17 +380,16 @@ with tabs[2]:
             cols = st.columns([1, 1])
             with cols[0]:
                 if st.button('Save Recipe'):
-                    updated = False
-                    # Overwrite the JSON with new measurements
+                    updated = None
+                    # Save just this cocktail with its new measurements
                     for idx, cktl in enumerate(cocktail_data.get('cocktails', [])):
                         if get_safe_name(cktl.get('normal_name', '')) == safe_name:
                             cocktail_data['cocktails'][idx]['ingredients'] = recipe_adjustments
-                            updated = True
+                            updated = cocktail_data['cocktails'][idx]
                             break
-                    if updated:
+                    if updated is not None:
                         try:
-                            with open(COCKTAILS_FILE, 'w') as f:
-                                json.dump(cocktail_data, f, indent=2)
+                            get_cocktail_repository().save_cocktail(updated)
                             st.success('Recipe saved!')
                         except Exception as e:
                             st.error(f'Error saving recipe: {e}')
@@ -212,18 +399,33 @@ with tabs[2]:
             with cols[1]:
                 if st.button('Pour'):
                     note = st.info('Pouring a single serving...')
-                    # We call controller.make_drink with single
-                    # Build a dictionary that matches what the controller expects
                     # The 'selected_cocktail' is already a dict from cocktails.json
-                    # so we can pass it directly.
+                    # so we can queue it directly.
                     try:
-                        executor_watcher = controller.make_drink(selected_cocktail, single_or_double='single')
-                        while not executor_watcher.done():
-                            pass
-                        note.empty()
+                        pour_order(selected_cocktail, 'single', note, 'Pouring a single serving...')
                     except Exception as e:
                         st.error(f'Error while pouring: {e}')
 
+            # Pitchers and trays for parties, scaled by servings or total volume
+            with st.expander('Batch'):
+                scale_by = st.radio('Scale by', ['Servings', 'Total ounces'], horizontal=True)
+                if scale_by == 'Servings':
+                    batch = controller.plan_batch(selected_cocktail, servings=st.number_input('Servings', min_value=1, value=8, step=1))
+                else:
+                    batch = controller.plan_batch(selected_cocktail, ounces=st.number_input('Total ounces', min_value=1.0, value=32.0, step=1.0))
+                if batch is None:
+                    st.write('None of the ingredients are on a pump.')
+                else:
+                    if batch.capped:
+                        st.warning(f'Limited to {batch.servings:g} servings to fit in {BATCH_CAPACITY:g} oz.')
+                    st.write(f'{batch.servings:g} servings, {batch.ounces:.1f} oz in {len(batch.rounds)} rounds, ready in about {math.ceil(batch.eta)} seconds')
+                    if st.button('Pour Batch'):
+                        note = st.info(f'Pouring a batch of {batch.servings:g} servings...')
+                        try:
+                            pour_order(selected_cocktail, batch.servings, note, f'Pouring a batch of {batch.servings:g} servings...')
+                        except Exception as e:
+                            st.error(f'Error while pouring: {e}')
+
             # Back to gallery
             if st.button('Back to Menu'):
                 st.session_state.selected_cocktail = None
@@ -261,10 +463,7 @@ with tabs[2]:
                         # but we have no way to adjust recipe first. We'll just pour the default recipe.
                         note = st.info(f'Pouring a single serving of {normal_name} ...')
                         try:
-                            executor_watcher = controller.make_drink(cocktail, single_or_double='single')
-                            while not executor_watcher.done():
-                                pass
-                            note.empty()
+                            pour_order(cocktail, 'single', note, f'Pouring a single serving of {normal_name}...')
                         except Exception as e:
                             st.error(f'Error while pouring: {e}')
         else:
@@ -0,0 +1,211 @@
+# async_controller.py
+"""
+An asyncio flavor of the controller API, for driving many queued drinks
+from one event loop (e.g. an asyncio web server).
+
+Pin changes are still switched on time by the scheduler's single
+ActuationEngine thread, so nothing here sleeps towards a deadline itself.
+Every pour and drink is instead an awaitable that the engine's callbacks
+resolve on the event loop:
+
+    drink = await make_drink(recipe, 'double')
+    async for status in drink.status():
+        print(status.remaining)
+    await drink  # the drink's pours, like asyncio.gather()
+
+Cancelling a task that awaits a drink cancels the drink and stops its
+pumps.
+"""
+import asyncio
+from collections import namedtuple
+
+import controller
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Snapshots yielded by `AsyncDrink.status()`
+PourStatus = namedtuple('PourStatus', ['ingredient_name', 'amount', 'state', 'remaining'])
+DrinkStatus = namedtuple('DrinkStatus', ['pours', 'remaining', 'done', 'cancelled'])
+
+
+class AsyncDrink:
+    """
+    A drink (or maintenance job) on the scheduler, followed from an event loop.
+
+    Awaiting it waits for every pour with `asyncio.gather()` semantics and
+    returns them. If the awaiting task is cancelled, the drink is cancelled
+    too and its pumps stopped.
+    """
+
+    def __init__(self, watcher, loop=None):
+        self.watcher = watcher
+        self.loop = loop or asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        self._pour_futures = {}
+        for pour in watcher.pours:
+            self._pour_futures[pour] = self.loop.create_future()
+            pour.add_listener(self._on_pour_change)
+            self._on_pour_change(pour)
+        self._done = self.loop.create_future()
+        watcher.add_done_callback(lambda watcher: self._call_soon(self._set_done))
+        self._finished = asyncio.gather(*self._pour_futures.values(), self._done)
+
+    @property
+    def pours(self):
+        return self.watcher.pours
+
+    @property
+    def cancelled(self):
+        return self.watcher.cancelled
+
+    def done(self):
+        return self._done.done()
+
+    def cancel(self):
+        """Cancel the drink, stopping any pump it's running. Returns False if it was already cancelled."""
+        return self.watcher.cancel()
+
+    def _call_soon(self, callback, *args):
+        # Pour and watcher callbacks run on the actuation and job threads
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # The event loop is closed, so nobody is waiting any more
+            pass
+
+    def _on_pour_change(self, pour):
+        self._call_soon(self._changed.set)
+        if pour.finished:
+            self._call_soon(self._set_pour_finished, pour)
+
+    def _set_pour_finished(self, pour):
+        future = self._pour_futures[pour]
+        if not future.done():
+            future.set_result(pour)
+
+    def _set_done(self):
+        self._changed.set()
+        if not self._done.done():
+            self._done.set_result(self.watcher)
+
+    async def pour(self, pour):
+        """Wait for one of the drink's pours to be done or aborted, and return it."""
+        return await asyncio.shield(self._pour_futures[pour])
+
+    def wait(self):
+        """
+        A future of the pours, set once every pour is finished and the
+        drink's job is done. Cancelling it (or a task awaiting it) cancels
+        the drink.
+        """
+        waiter = self.loop.create_future()
+
+        def finished(gathered):
+            if not waiter.done():
+                waiter.set_result(gathered.result()[:-1])
+
+        def cancelled(waiter):
+            if waiter.cancelled():
+                self.cancel()
+
+        self._finished.add_done_callback(finished)
+        waiter.add_done_callback(cancelled)
+        return waiter
+
+    def __await__(self):
+        return self.wait().__await__()
+
+    def snapshot(self):
+        """The current DrinkStatus."""
+        return DrinkStatus(
+            pours=[PourStatus(pour.ingredient_name, pour.amount, pour.state, self.watcher.remaining(pour)) for pour in self.pours],
+            remaining=0.0 if self.done() else self.watcher.remaining(),
+            done=self.done(),
+            cancelled=self.cancelled,
+        )
+
+    async def status(self, interval=None):
+        """
+        Yield a DrinkStatus now and every time a pour changes state (and at
+        least every `interval` seconds, for a countdown) until the drink is done.
+        """
+        while True:
+            self._changed.clear()
+            status = self.snapshot()
+            yield status
+            if status.done:
+                return
+            try:
+                await asyncio.wait_for(self._changed.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+class AsyncPumpScheduler:
+    """Submits drinks and maintenance to a PumpScheduler (the shared one by default) from an event loop."""
+
+    def __init__(self, scheduler=None):
+        self._scheduler = scheduler
+
+    @property
+    def scheduler(self):
+        if self._scheduler is None:
+            self._scheduler = controller.get_scheduler()
+        return self._scheduler
+
+    def submit_drink(self, planned_pours):
+        """Queue a drink's PlannedPours and return its AsyncDrink without waiting for it."""
+        return AsyncDrink(self.scheduler.submit_drink(planned_pours))
+
+    async def make_drink(self, recipe, single_or_double='single'):
+        """Queue a single or double `recipe` and return its AsyncDrink, or None if it can't be made."""
+        planned_pours = await asyncio.to_thread(controller.get_planned_pours, recipe, single_or_double)
+        if planned_pours is None:
+            return None
+        return self.submit_drink(planned_pours)
+
+    async def make_batch(self, recipe, servings=None, ounces=None):
+        """Queue a batch of `recipe` and return its AsyncDrink, or None if it can't be made. See `controller.plan_batch()`."""
+        plan = await asyncio.to_thread(controller.plan_batch, recipe, servings, ounces)
+        if plan is None:
+            return None
+        return AsyncDrink(self.scheduler.submit_batch(plan.rounds, controller.batch_concurrency(len(self.scheduler.motors))))
+
+    async def run_maintenance(self, action, duration=10, pumps=None, concurrency=controller.MAINTENANCE_CONCURRENCY):
+        """Run pumps FORWARD (prime) or in REVERSE (clean) and wait until they're finished. See `controller.run_maintenance()`."""
+        job = AsyncDrink(self.scheduler.submit_maintenance(action, duration, pumps, concurrency))
+        await job
+        return job
+
+    async def prime_pumps(self, duration=10, pumps=None, concurrency=controller.MAINTENANCE_CONCURRENCY):
+        return await self.run_maintenance(controller.FORWARD, duration, pumps, concurrency)
+
+    async def clean_pumps(self, duration=10, pumps=None, concurrency=controller.MAINTENANCE_CONCURRENCY):
+        return await self.run_maintenance(controller.REVERSE, duration, pumps, concurrency)
+
+    def emergency_stop(self):
+        """Stop every pump and cancel every drink. Returns the cancelled ExecutorWatchers."""
+        return self.scheduler.emergency_stop()
+
+
+_async_scheduler = AsyncPumpScheduler()
+
+
+async def make_drink(recipe, single_or_double='single'):
+    """Queue a drink on the shared scheduler. See `AsyncPumpScheduler.make_drink()`."""
+    return await _async_scheduler.make_drink(recipe, single_or_double)
+
+
+async def make_batch(recipe, servings=None, ounces=None):
+    """Queue a batch on the shared scheduler. See `AsyncPumpScheduler.make_batch()`."""
+    return await _async_scheduler.make_batch(recipe, servings, ounces)
+
+
+async def prime_pumps(duration=10, pumps=None, concurrency=controller.MAINTENANCE_CONCURRENCY):
+    return await _async_scheduler.prime_pumps(duration, pumps, concurrency)
+
+
+async def clean_pumps(duration=10, pumps=None, concurrency=controller.MAINTENANCE_CONCURRENCY):
+    return await _async_scheduler.clean_pumps(duration, pumps, concurrency)
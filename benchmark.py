@@ -0,0 +1,266 @@
+# benchmark.py
+"""
+Replay a mix of drink orders against the controller on the simulated GPIO
+backend and report service speed.
+
+    python benchmark.py --orders 200 --mix "Vodka Cola=3,Margarita=1" --output results.json
+
+Results are printed and written as JSON, so runs with different
+PUMP_CONCURRENCY, POWER_BUDGET, RETRACTION_TIME or OZ_COEFFICIENT values can
+be compared.
+"""
+import argparse
+import json
+import math
+import random
+
+import controller
+from gpio_backends import SimulatedBackend
+from ingredients import get_ingredient_index
+from journal import CocktailJournal
+from settings import CONFIG_FILE, COCKTAILS_FILE
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of `values` (0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def parse_mix(mix, cocktails):
+    """Parse "Name=weight,Name=weight" into {cocktail: weight}. An empty mix weights every cocktail equally."""
+    by_name = {cocktail.get('normal_name', '').lower(): cocktail for cocktail in cocktails}
+    if not mix:
+        return {name: 1.0 for name in by_name}
+    weights = {}
+    for entry in mix.split(','):
+        name, _, weight = entry.partition('=')
+        name = name.strip().lower()
+        if name not in by_name:
+            raise ValueError(f'Unknown cocktail in mix: "{name}"')
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def pourable(cocktail, ingredient_index):
+    """Whether every ingredient of `cocktail` would be poured: measured in a known unit and on one of the pumps."""
+    ingredients = cocktail.get('ingredients', {})
+    for ingredient_name, measurement in ingredients.items():
+        pump_index = ingredient_index.pump_index(ingredient_name)
+        if pump_index is None or pump_index >= len(controller.MOTORS):
+            return False
+        try:
+            controller.parse_measurement(measurement)
+        except ValueError:
+            return False
+    return bool(ingredients)
+
+
+def build_orders(cocktails, count, mix='', interval=0.0, double_ratio=0.0, seed=None, ingredient_index=None):
+    """
+    Draw `count` orders from `cocktails` using the weights in `mix`. Orders
+    arrive `interval` seconds apart on average (exponentially distributed),
+    or all at once when `interval` is 0. With an `ingredient_index`, only
+    cocktails it can pour every ingredient of are drawn.
+    """
+    rng = random.Random(seed)
+    by_name = {cocktail.get('normal_name', '').lower(): cocktail for cocktail in cocktails}
+    weights = parse_mix(mix, cocktails)
+    if ingredient_index is not None:
+        # A drink poured without some of its ingredients would still count as served
+        unpourable = sorted(name for name in weights if not pourable(by_name[name], ingredient_index))
+        if unpourable:
+            logger.warning(f'Leaving out cocktails the pumps can\'t fully pour: {", ".join(unpourable)}')
+        weights = {name: weight for name, weight in weights.items() if name not in unpourable}
+        if not weights:
+            raise ValueError('None of the cocktails in the mix can be fully poured with this pump config')
+    names = list(weights)
+    arrival = 0.0
+    orders = []
+    for _ in range(count):
+        if interval:
+            arrival += rng.expovariate(1 / interval)
+        orders.append({
+            'cocktail': by_name[rng.choices(names, [weights[name] for name in names])[0]],
+            'size': 'double' if rng.random() < double_ratio else 'single',
+            'arrival': arrival,
+        })
+    return orders
+
+
+def pump_activity(transitions, motors):
+    """
+    Turn recorded pin transitions into busy intervals per pump. A pump is
+    busy whenever its two driver pins differ (forward or reverse).
+    """
+    pins = {}
+    pump_pins = {pin: index for index, (ia, ib) in enumerate(motors) for pin in (ia, ib)}
+    started = {}
+    intervals = {index: [] for index in range(len(motors))}
+    events = sorted(transitions, key=lambda transition: transition[0])
+    position = 0
+    while position < len(events):
+        at = events[position][0]
+        touched = set()
+        while position < len(events) and events[position][0] == at:
+            _, pin, value = events[position]
+            pins[pin] = value
+            if pin in pump_pins:
+                touched.add(pump_pins[pin])
+            position += 1
+        for index in touched:
+            ia, ib = motors[index]
+            busy = pins.get(ia, 0) != pins.get(ib, 0)
+            if busy and index not in started:
+                started[index] = at
+            elif not busy and index in started:
+                intervals[index].append((started.pop(index), at))
+    return intervals
+
+
+def idle_gaps(intervals):
+    """Gaps between the first pump start and the last pump stop where no pump is running."""
+    spans = sorted(span for pump_spans in intervals.values() for span in pump_spans)
+    gaps = []
+    if not spans:
+        return gaps
+    busy_until = spans[0][1]
+    for start, end in spans[1:]:
+        if start > busy_until:
+            gaps.append(start - busy_until)
+        busy_until = max(busy_until, end)
+    return gaps
+
+
+def run_benchmark(orders, config_file=CONFIG_FILE, cocktails_file=COCKTAILS_FILE):
+    """
+    Pour every order on a simulated backend and return the measured results.
+    Each order is submitted at its arrival time without waiting for the ones
+    before it, so drinks queue up like they do at a party.
+    """
+    backend = SimulatedBackend()
+    clock = backend.clock
+    scheduler = controller.PumpScheduler(backend=backend)
+    plans = controller.PourPlanCache(config_file, cocktails_file)
+    latencies = []
+    submitted = []
+    # When each pour finished. Pour callbacks run on the actuation thread, so the clock hasn't moved on yet.
+    finished_at = []
+
+    def track(watcher, arrival):
+        finished = []
+
+        def on_change(pour):
+            if pour.finished:
+                finished.append(clock.monotonic())
+                finished_at.append(finished[-1])
+
+        for pour in watcher.pours:
+            pour.add_listener(on_change)
+        watcher.add_done_callback(lambda watcher: latencies.append(max(finished, default=arrival) - arrival))
+
+    scheduler.start()
+    try:
+        for order in sorted(orders, key=lambda order: order['arrival']):
+            # Pour what's queued up to the order's arrival, then submit it right then
+            clock.run_until(order['arrival'], idle=lambda: all(watcher.done() for watcher in submitted))
+            plan = plans.get(order['cocktail'])
+            watcher = scheduler.submit_drink(plan.double if order['size'] == 'double' else plan.single)
+            track(watcher, order['arrival'])
+            submitted.append(watcher)
+        clock.hold(None)
+        for watcher in submitted:
+            watcher.wait()
+    finally:
+        scheduler.stop()
+
+    # Idle line retractions can run on after the last drink, so stop the clock at its last pour
+    total_time = max(finished_at, default=clock.monotonic())
+    intervals = pump_activity(backend.transitions, scheduler.motors)
+    gaps = idle_gaps(intervals)
+    utilization = {
+        f'Pump {index + 1}': (sum(end - start for start, end in spans) / total_time if total_time else 0.0)
+        for index, spans in intervals.items()
+    }
+    return {
+        'settings': {
+            'PUMP_CONCURRENCY': controller.PUMP_CONCURRENCY,
+            'POWER_BUDGET': controller.POWER_BUDGET,
+            'RETRACTION_TIME': controller.RETRACTION_TIME,
+            'OZ_COEFFICIENT': controller.OZ_COEFFICIENT,
+        },
+        'orders': len(orders),
+        'simulated_seconds': total_time,
+        'drinks_per_hour': len(orders) / total_time * 3600 if total_time else 0.0,
+        'latency': {
+            'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies, default=0.0),
+        },
+        'pump_utilization': utilization,
+        'mean_pump_utilization': sum(utilization.values()) / len(utilization) if utilization else 0.0,
+        'idle_gaps': {
+            'count': len(gaps),
+            'total': sum(gaps),
+            'max': max(gaps, default=0.0),
+            'mean': sum(gaps) / len(gaps) if gaps else 0.0,
+        },
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark drink throughput on the simulated GPIO backend.')
+    parser.add_argument('--orders', type=int, default=100, help='Number of orders to replay')
+    parser.add_argument('--mix', default='', help='Weighted order mix, e.g. "Vodka Cola=3,Margarita=1". Defaults to every cocktail equally.')
+    parser.add_argument('--interval', type=float, default=0.0, help='Mean seconds between orders. 0 queues every order at once.')
+    parser.add_argument('--double-ratio', type=float, default=0.0, help='Fraction of orders that are doubles')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for a repeatable order mix')
+    parser.add_argument('--pump-concurrency', type=int, help='Override PUMP_CONCURRENCY')
+    parser.add_argument('--retraction-time', type=float, help='Override RETRACTION_TIME')
+    parser.add_argument('--oz-coefficient', type=float, help='Override OZ_COEFFICIENT')
+    parser.add_argument('--power-budget', type=float, help='Override POWER_BUDGET')
+    parser.add_argument('--cocktails', default=COCKTAILS_FILE, help='Cocktails file to draw orders from')
+    parser.add_argument('--pump-config', default=CONFIG_FILE, help='Pump config file to pour with')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to write the JSON results')
+    args = parser.parse_args(args)
+
+    if args.pump_concurrency is not None:
+        controller.PUMP_CONCURRENCY = args.pump_concurrency
+    if args.retraction_time is not None:
+        controller.RETRACTION_TIME = args.retraction_time
+    if args.oz_coefficient is not None:
+        controller.OZ_COEFFICIENT = args.oz_coefficient
+    if args.power_budget is not None:
+        controller.POWER_BUDGET = args.power_budget
+
+    # Read through the journal, so edits that aren't compacted yet are included
+    cocktails = CocktailJournal(args.cocktails).load()[0].get('cocktails', [])
+    orders = build_orders(
+        cocktails, args.orders, args.mix, args.interval, args.double_ratio, args.seed,
+        ingredient_index=get_ingredient_index(args.pump_config),
+    )
+    results = run_benchmark(orders, args.pump_config, args.cocktails)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print(f'{results["orders"]} drinks in {results["simulated_seconds"]:.1f} simulated seconds')
+    print(f'Drinks per hour: {results["drinks_per_hour"]:.1f}')
+    latency = results['latency']
+    print(f'Latency p50/p95/p99: {latency["p50"]:.1f}s / {latency["p95"]:.1f}s / {latency["p99"]:.1f}s')
+    print(f'Mean pump utilization: {results["mean_pump_utilization"]:.1%}')
+    print(f'Idle gaps: {results["idle_gaps"]["count"]} totalling {results["idle_gaps"]["total"]:.1f}s')
+    print(f'Results written to {args.output}')
+    return results
+
+
+if __name__ == '__main__':
+    main()
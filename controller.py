@@ -5,16 +5,22 @@ logger = logging.getLogger(__name__)
 import time
 import os
 import json
+import atexit
+import heapq
+import itertools
+import math
+import threading
 import concurrent.futures
+from collections import deque, namedtuple
+from fractions import Fraction
 
 from settings import *
-
-if not DEBUG:
-    try:
-        import RPi.GPIO as GPIO
-    except ModuleNotFoundError:
-        DEBUG = True
-        logger.info('Controller modules not found. Pump control will be disabled')
+from ingredients import IngredientIndex, file_signature, get_ingredient_index
+from gpio_backends import create_backend
+from metrics import REGISTRY, ERROR_BUCKETS
+from pump_profiles import PumpProfiles, fit_calibration, get_pump_profiles, save_pump_profiles
+from storage import get_storage
+from journal import CocktailJournal
 
 # Define GPIO pins for each motor here (same as your test).
 # Adjust these if needed to match your hardware.
@@ -33,221 +39,1544 @@ MOTORS = [
     (15, 14),  # Pump 12
 ]
 
+# Conversions from recipe units to ounces. Measurements without a known unit are treated as ounces.
+UNIT_OUNCES = {
+    'oz': 1.0, 'ounce': 1.0, 'ounces': 1.0,
+    'ml': 1 / 29.5735,
+    'cl': 10 / 29.5735,
+    'dash': 1 / 32, 'dashes': 1 / 32,
+    'tsp': 1 / 6, 'teaspoon': 1 / 6, 'teaspoons': 1 / 6,
+    'tbsp': 0.5, 'tablespoon': 0.5, 'tablespoons': 0.5,
+    'shot': 1.5, 'shots': 1.5,
+    'cup': 8.0, 'cups': 8.0,
+}
+
+
+# Telemetry, written in Prometheus text format to METRICS_FILE by the shared scheduler
+POURS = REGISTRY.counter('tipsy_pours_total', 'Pours finished', ['pump'])
+OUNCES_POURED = REGISTRY.counter('tipsy_ounces_poured_total', 'Ounces poured', ['pump'])
+POUR_DURATION = REGISTRY.histogram('tipsy_pour_duration_seconds', 'Seconds a pump actually ran forward for a pour', ['pump'])
+RETRACTION_DURATION = REGISTRY.histogram('tipsy_retraction_seconds', 'Seconds a pump actually ran in reverse after a pour', ['pump'])
+ACTUATION_ERROR = REGISTRY.histogram('tipsy_actuation_error_seconds', 'How late each pin change was applied', ['pump', 'action'], ERROR_BUCKETS)
+DRINKS = REGISTRY.counter('tipsy_drinks_total', 'Drinks finished')
+DRINKS_CANCELLED = REGISTRY.counter('tipsy_drinks_cancelled_total', 'Drinks cancelled or emergency stopped while pouring')
+QUEUE_WAIT = REGISTRY.histogram('tipsy_queue_wait_seconds', 'Seconds a drink waited behind other jobs before pouring')
+DRINK_LATENCY = REGISTRY.histogram('tipsy_drink_latency_seconds', 'Seconds from ordering a drink until it is finished')
+
+# Motor actions
+FORWARD = 'forward'
+REVERSE = 'reverse'
+STOP = 'stop'
+
+
+_backend = None
+
+
+def get_backend():
+    """Get the default GPIO backend, chosen by GPIO_BACKEND (and DEBUG when it's 'auto')."""
+    global _backend
+    if _backend is None:
+        _backend = create_backend(GPIO_BACKEND, debug=DEBUG)
+    return _backend
 
-def setup_gpio():
+
+def setup_gpio(motors=MOTORS, backend=None):
     """Set up all motor pins for OUTPUT."""
-    if DEBUG:
-        logger.debug('setup_gpio() called — Not actually initializing GPIO pins.')
-    else:
-        GPIO.setmode(GPIO.BCM)
-        for ia, ib in MOTORS:
-            GPIO.setup(ia, GPIO.OUT)
-            GPIO.setup(ib, GPIO.OUT)
+    backend = backend or get_backend()
+    backend.setup([pin for pins in motors for pin in pins])
+
+
+def cleanup_gpio(backend=None):
+    """Release all GPIO pins."""
+    backend = backend or get_backend()
+    backend.cleanup()
+
+
+def motor_levels(action, backend):
+    """The (ia, ib) pin levels that make a motor go FORWARD, REVERSE or STOP."""
+    if action == STOP:
+        return backend.LOW, backend.LOW
+    levels = (backend.HIGH, backend.LOW) if action == FORWARD else (backend.LOW, backend.HIGH)
+    if INVERT_PUMP_PINS:
+        levels = levels[::-1]
+    return levels
+
+
+def drive_motors(actions, backend=None):
+    """
+    Apply `actions`, an iterable of ((ia, ib), action) pairs, as a single
+    batched GPIO call so every motor changes at the same moment.
+    """
+    backend = backend or get_backend()
+    pins = []
+    values = []
+    for (ia, ib), action in actions:
+        pins.extend((ia, ib))
+        values.extend(motor_levels(action, backend))
+    if pins:
+        backend.output(pins, values)
 
 
-def motor_forward(ia, ib):
+def motor_forward(ia, ib, backend=None):
     """Drive motor forward."""
-    if DEBUG:
-        logger.debug(f'motor_forward(ia={ia}, ib={ib}) called — No actual motor movement.')
-    else:
-        if INVERT_PUMP_PINS:
-            GPIO.output(ia, GPIO.LOW)
-            GPIO.output(ib, GPIO.HIGH)
-        else:
-            GPIO.output(ia, GPIO.HIGH)
-            GPIO.output(ib, GPIO.LOW)
+    drive_motors([((ia, ib), FORWARD)], backend)
 
 
-def motor_stop(ia, ib):
+def motor_stop(ia, ib, backend=None):
     """Stop motor."""
-    if DEBUG:
-        logger.debug(f'motor_stop(ia={ia}, ib={ib}) called — No actual motor movement.')
-    else:
-        GPIO.output(ia, GPIO.LOW)
-        GPIO.output(ib, GPIO.LOW)
-
-
-def motor_reverse(ia,ib):
-    if DEBUG:
-        logger.debug(f'motor_reverse(ia={ia}, ib={ib}) called — No actual motor movement.')
-    else:
-        if INVERT_PUMP_PINS:
-            GPIO.output(ia,GPIO.HIGH)
-            GPIO.output(ib,GPIO.LOW)
-        else:
-            GPIO.output(ia,GPIO.LOW)
-            GPIO.output(ib,GPIO.HIGH)
+    drive_motors([((ia, ib), STOP)], backend)
+
+
+def motor_reverse(ia, ib, backend=None):
+    """Drive motor in reverse."""
+    drive_motors([((ia, ib), REVERSE)], backend)
+
+
+def parse_measurement(measurement_str):
+    """
+    Convert a measurement such as "2 oz", "1 1/2 oz", "1/2 oz" or "2 dashes"
+    to ounces. A number on its own is ounces. Raises ValueError if it can't
+    be parsed or its unit isn't one of UNIT_OUNCES.
+    """
+    parts = measurement_str.split()
+    if not parts:
+        raise ValueError('Empty measurement')
+    amount = Fraction(parts.pop(0))
+    if parts and '/' in parts[0]:
+        # A mixed number, e.g. "1 1/2 oz"
+        amount += Fraction(parts.pop(0))
+    unit = parts[0].lower().rstrip('.') if parts else 'oz'
+    if unit not in UNIT_OUNCES:
+        raise ValueError(f'Unknown unit "{parts[0]}"')
+    return float(amount) * UNIT_OUNCES[unit]
+
+
+def pour_seconds(ounces, profile=None):
+    """
+    Seconds to run a pump forward for `ounces`, using the pump's calibrated
+    PumpProfile if given or OZ_COEFFICIENT if not. The profile's dead volume
+    is pushed through first, and retraction time is added to push liquid
+    back through the line after the last retraction.
+    """
+    seconds_per_oz = OZ_COEFFICIENT if profile is None or profile.seconds_per_oz is None else profile.seconds_per_oz
+    dead_volume = 0.0 if profile is None else profile.dead_volume
+    return (ounces + dead_volume) * seconds_per_oz + RETRACTION_TIME
 
 
 class Pour:
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    ABORTED = 'aborted'
+
     def __str__(self):
         return f'{self.ingredient_name}: {self.amount} oz.'
 
-    def __init__(self, pump_index, amount, ingredient_name):
+    def __init__(self, pump_index, amount, ingredient_name, seconds=None):
         self.pump_index = pump_index
         self.amount = amount
         self.ingredient_name = ingredient_name
-        self.running = False
+        self.state = Pour.PENDING
+        # Seconds the pump runs forward
+        self.seconds = pour_seconds(amount, get_pump_profiles()[pump_index]) if seconds is None else seconds
+        self.retraction = RETRACTION_TIME
+        # Predicted start and finish, in seconds from the start of the drink. Set by plan_pours().
+        self.start_offset = None
+        self.end_offset = None
+        # Amps the pump draws while running. Set from its PumpProfile by the scheduler.
+        self.current_draw = 0.0
+        # When each action was actually applied, in nanoseconds on the backend clock
+        self.applied_ns = {}
+        # Actuations handed to the engine, so the pour can be cut short
+        self.scheduled = []
+        # Ounces actually dispensed. Set once the pour is done or aborted.
+        self.poured = None
+        # Whether it was aborted by an emergency stop
+        self.emergency_stopped = False
+        self._listeners = []
 
-    def run(self):
-        self.running = True
-        ia, ib = MOTORS[self.pump_index]
-        seconds_to_pour = self.amount * OZ_COEFFICIENT
+    @property
+    def running(self):
+        return self.state == Pour.RUNNING
 
-        if RETRACTION_TIME:
-            logger.debug(f'Retraction time is set to {RETRACTION_TIME:.2f} seconds. Adding this time to pour time')
-            seconds_to_pour = seconds_to_pour + RETRACTION_TIME
+    @property
+    def duration(self):
+        """Total seconds the pump is busy, including retraction."""
+        return self.seconds + self.retraction
 
-        logger.info(f'Pouring {self.amount} oz of Pump {self.pump_index} for {seconds_to_pour:.2f} seconds.')
-        motor_forward(ia, ib)
-        time.sleep(seconds_to_pour)
+    @property
+    def finished(self):
+        return self.state in (Pour.DONE, Pour.ABORTED)
 
-        if RETRACTION_TIME:
-            logger.info(f'Retracting Pump {self.pump_index} for {RETRACTION_TIME:.2f} seconds')
-            motor_reverse(ia, ib)
-            time.sleep(RETRACTION_TIME)
+    def add_listener(self, callback):
+        """Call `callback(pour)` every time this pour changes state."""
+        self._listeners.append(callback)
+
+    def set_state(self, state):
+        self.state = state
+        for callback in list(self._listeners):
+            try:
+                callback(self)
+            except Exception:
+                logger.exception(f'Error notifying listener of {self}')
+
+    def actuations(self, start_ns):
+        """The timed pin changes for this pour, for a drink that starts pouring at `start_ns`."""
+        forward_ns = start_ns + round(self.start_offset * 1e9)
+        reverse_ns = forward_ns + round(self.seconds * 1e9)
+        actuations = [Actuation(forward_ns, self.pump_index, Actuation.FORWARD, self._on_actuation)]
+        if self.retraction:
+            actuations.append(Actuation(reverse_ns, self.pump_index, Actuation.REVERSE, self._on_actuation))
+        actuations.append(Actuation(reverse_ns + round(self.retraction * 1e9), self.pump_index, Actuation.STOP, self._on_actuation))
+        return actuations
+
+    def _on_actuation(self, actuation):
+        if actuation.error_ns is not None:
+            self.applied_ns[actuation.action] = actuation.deadline_ns + actuation.error_ns
+        if actuation.action == Actuation.FORWARD:
+            logger.info(f'Pouring {self.amount} oz of Pump {self.pump_index} for {self.seconds:.2f} seconds.')
+            self.set_state(Pour.RUNNING)
+        elif actuation.action == Actuation.REVERSE:
+            logger.info(f'Retracting Pump {self.pump_index} for {self.retraction:.2f} seconds')
+        else:
+            self.poured = self.amount
+            self.record_metrics()
+            self.set_state(Pour.DONE)
+
+    def skip_retraction(self, engine):
+        """
+        Leave the line full after this pour by stopping the pump where it
+        would start retracting. Returns False if it's too late to change.
+        """
+        retraction = [actuation for actuation in self.scheduled if actuation.action in (Actuation.REVERSE, Actuation.STOP)]
+        reverse = [actuation for actuation in retraction if actuation.action == Actuation.REVERSE]
+        if not reverse:
+            return False
+        stop = Actuation(reverse[0].deadline_ns, self.pump_index, Actuation.STOP, self._on_actuation)
+        if not engine.reschedule(retraction, [stop]):
+            return False
+        self.scheduled = [actuation for actuation in self.scheduled if actuation not in retraction] + [stop]
+        self.retraction = 0
+        self.end_offset = self.start_offset + self.seconds
+        return True
+
+    def abort(self, stopped_ns, emergency=False):
+        """
+        Mark an unfinished pour as ABORTED after its pump was stopped at
+        `stopped_ns`, working out how much it had poured by then. With
+        `emergency`, it was stopped by an emergency stop.
+        """
+        if self.finished:
+            return
+        # Set the state before cancelling, so actuations scheduled concurrently see the abort
+        self.state = Pour.ABORTED
+        self.emergency_stopped = emergency
+        for actuation in self.scheduled:
+            actuation.cancel()
+        forward_ns = self.applied_ns.get(Actuation.FORWARD)
+        ran = 0.0 if forward_ns is None else (self.applied_ns.get(Actuation.REVERSE, stopped_ns) - forward_ns) / 1e9
+        self.poured = self.amount * min(1.0, max(0.0, ran) / self.seconds) if self.seconds else 0.0
+        logger.warning(f'Aborted {self} after pouring {self.poured:.2f} oz.')
+        self.set_state(Pour.ABORTED)
+
+    def record_metrics(self):
+        """Record how long the pump actually ran, if every pin change was applied."""
+        forward_ns = self.applied_ns.get(Actuation.FORWARD)
+        stop_ns = self.applied_ns.get(Actuation.STOP)
+        if forward_ns is None or stop_ns is None:
+            return
+        pump = self.pump_index + 1
+        reverse_ns = self.applied_ns.get(Actuation.REVERSE, stop_ns)
+        POURS.inc(pump=pump)
+        OUNCES_POURED.inc(self.amount, pump=pump)
+        POUR_DURATION.observe((reverse_ns - forward_ns) / 1e9, pump=pump)
+        if self.retraction:
+            RETRACTION_DURATION.observe((stop_ns - reverse_ns) / 1e9, pump=pump)
+
+
+class Actuation:
+    """A pump pin change due at `deadline_ns` on the backend clock's monotonic_ns() timeline."""
+    FORWARD = FORWARD
+    REVERSE = REVERSE
+    STOP = STOP
+
+    def __init__(self, deadline_ns, pump_index, action, callback=None):
+        self.deadline_ns = deadline_ns
+        self.pump_index = pump_index
+        self.action = action
+        self.callback = callback
+        self.cancelled = False
+        # Nanoseconds between the deadline and when the pins actually changed. Set once applied.
+        self.error_ns = None
+
+    def cancel(self):
+        """Skip this actuation if it hasn't been applied yet."""
+        self.cancelled = True
+
+
+def line_fill(fill, actuations, stopped_ns):
+    """
+    Seconds of pumping that a line holds after `actuations` on its pump were
+    halted at `stopped_ns`, given it held `fill` before they started. Each
+    applied FORWARD adds the time it ran for and each REVERSE takes it away,
+    up to a full line of RETRACTION_TIME.
+    """
+    applied = sorted(
+        (actuation.deadline_ns + actuation.error_ns, actuation.action)
+        for actuation in actuations if actuation.error_ns is not None
+    )
+    for (applied_ns, action), (until_ns, _) in zip(applied, applied[1:] + [(stopped_ns, STOP)]):
+        if action == FORWARD:
+            fill += (until_ns - applied_ns) / 1e9
+        elif action == REVERSE:
+            fill -= (until_ns - applied_ns) / 1e9
+    return min(max(fill, 0.0), RETRACTION_TIME)
 
-        motor_stop(ia, ib)
-        self.running = False
 
+# SCHED_FIFO priority requested for the actuation thread. Needs CAP_SYS_NICE (e.g. running as root on the Pi).
+ACTUATION_PRIORITY = 50
 
-def prime_pumps(duration=10):
+
+class ActuationEngine:
     """
-    Primes each pump for `duration` seconds in sequence (one after another).
+    Switches pump pins on time from a single thread.
+
+    Actuations are kept in a heap ordered by deadline on the backend clock's
+    `monotonic_ns()`. The engine thread sleeps until the earliest deadline
+    (or until new work is scheduled), then switches every pin that is due in
+    one batched GPIO call before running any callbacks, so slow listeners can't delay a
+    motor. The lateness of every transition is kept in `errors`.
     """
-    setup_gpio()
-    try:
-        for index, (ia, ib) in enumerate(MOTORS, start=1):
-            logger.info(f'Priming pump {index} for {duration} seconds...')
-            motor_forward(ia, ib)
-            time.sleep(duration)
-            motor_stop(ia, ib)
-    finally:
-        if not DEBUG:
-            GPIO.cleanup()
+
+    def __init__(self, backend, motors=MOTORS, history=1000):
+        self.backend = backend
+        self.motors = list(motors)
+        # (pump_index, action, error_ns) for the most recent transitions
+        self.errors = deque(maxlen=history)
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """Start the actuation thread. Does nothing if already running."""
+        with self._condition:
+            if self.running:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='pump-actuation', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the actuation thread, dropping anything still scheduled. Callbacks of dropped stops still run so waiters are released."""
+        with self._condition:
+            if not self.running:
+                return
+            self._stopping = True
+            dropped = [actuation for _, _, actuation in self._heap]
+            self._heap = []
+            self._condition.notify_all()
+            thread, self._thread = self._thread, None
+        if thread is not threading.current_thread():
+            thread.join()
+        for actuation in dropped:
+            if actuation.action == Actuation.STOP and not actuation.cancelled:
+                self._run_callback(actuation)
+
+    def schedule(self, actuations):
+        """Add actuations to the timer heap in one step, so none of them can run before the rest are queued."""
+        with self._condition:
+            if not self.running:
+                raise RuntimeError('ActuationEngine is not running')
+            for actuation in actuations:
+                heapq.heappush(self._heap, (actuation.deadline_ns, next(self._sequence), actuation))
+            self._condition.notify_all()
+
+    def _raise_priority(self):
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(ACTUATION_PRIORITY))
+            logger.debug('Actuation thread running with SCHED_FIFO priority')
+        except (AttributeError, OSError) as e:
+            logger.debug(f'Could not raise actuation thread priority: {e}')
+
+    def _run(self):
+        self._raise_priority()
+        clock = self.backend.clock
+        while True:
+            with self._condition:
+                if self._stopping:
+                    return
+                if not self._heap:
+                    clock.wait(self._condition, None)
+                    continue
+                wait_ns = self._heap[0][0] - clock.monotonic_ns()
+                if wait_ns > 0:
+                    clock.wait(self._condition, wait_ns / 1e9)
+                    continue
+                due = []
+                now_ns = clock.monotonic_ns()
+                while self._heap and self._heap[0][0] <= now_ns:
+                    due.append(heapq.heappop(self._heap)[2])
+                # Switch pins while holding the lock so halt() can't be overtaken by a due actuation
+                applied = self._apply(due)
+            for actuation in applied:
+                self._run_callback(actuation)
+
+    def _apply(self, actuations):
+        applied = [actuation for actuation in actuations if not actuation.cancelled]
+        drive_motors([(self.motors[actuation.pump_index], actuation.action) for actuation in applied], self.backend)
+        now_ns = self.backend.clock.monotonic_ns()
+        for actuation in applied:
+            actuation.error_ns = now_ns - actuation.deadline_ns
+            self.errors.append((actuation.pump_index, actuation.action, actuation.error_ns))
+            ACTUATION_ERROR.observe(actuation.error_ns / 1e9, pump=actuation.pump_index + 1, action=actuation.action)
+        return applied
+
+    def reschedule(self, actuations, replacements):
+        """
+        Swap `actuations` for `replacements` in one step, unless one of them
+        has already been applied or cancelled. Returns True if swapped.
+        """
+        with self._condition:
+            if any(actuation.cancelled or actuation.error_ns is not None for actuation in actuations):
+                return False
+            for actuation in actuations:
+                actuation.cancel()
+            self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+            for actuation in replacements:
+                self._heap.append((actuation.deadline_ns, next(self._sequence), actuation))
+            heapq.heapify(self._heap)
+            self._condition.notify_all()
+            return True
+
+    def halt(self, actuations=None):
+        """
+        Cancel `actuations` and stop their pumps in one batched GPIO call, or
+        with no `actuations`, cancel everything scheduled and stop every pump.
+        Callbacks of cancelled actuations are not run. Returns the time the
+        pumps were stopped, in nanoseconds on the backend clock.
+        """
+        with self._condition:
+            if actuations is None:
+                pump_indexes = range(len(self.motors))
+                for _, _, actuation in self._heap:
+                    actuation.cancel()
+                self._heap = []
+            else:
+                actuations = list(actuations)
+                pump_indexes = sorted({actuation.pump_index for actuation in actuations})
+                for actuation in actuations:
+                    actuation.cancel()
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+            drive_motors([(self.motors[pump_index], STOP) for pump_index in pump_indexes], self.backend)
+            self._condition.notify_all()
+            return self.backend.clock.monotonic_ns()
+
+    def _run_callback(self, actuation):
+        if actuation.callback is None:
+            return
+        try:
+            actuation.callback(actuation)
+        except Exception:
+            logger.exception(f'Error running callback for {actuation.action} on Pump {actuation.pump_index}')
+
+
+class MaintenanceRun(Pour):
+    """Runs one pump FORWARD (priming) or in REVERSE (cleaning) for a fixed time, with no retraction."""
+
+    def __str__(self):
+        return f'Pump {self.pump_index + 1}: {self.action} for {self.seconds:g} s.'
+
+    def __init__(self, pump_index, action, seconds):
+        super().__init__(pump_index, 0.0, f'Pump {pump_index + 1}', seconds)
+        self.action = action
+        self.retraction = 0
+
+    def actuations(self, start_ns):
+        forward_ns = start_ns + round(self.start_offset * 1e9)
+        return [
+            Actuation(forward_ns, self.pump_index, self.action, self._on_actuation),
+            Actuation(forward_ns + round(self.seconds * 1e9), self.pump_index, Actuation.STOP, self._on_actuation),
+        ]
+
+    def _on_actuation(self, actuation):
+        if actuation.action == Actuation.STOP:
+            self.set_state(Pour.DONE)
         else:
-            logger.debug('prime_pumps() complete — no GPIO cleanup in debug mode.')
+            logger.info(f'Running {self}')
+            self.set_state(Pour.RUNNING)
+
+
+MaintenanceProgress = namedtuple('MaintenanceProgress', ['pump_index', 'state', 'remaining', 'seconds'])
 
 
-def clean_pumps(duration=10):
+def maintenance_progress(watcher, interval=0.5):
     """
-    Reverse each pump for `duration` seconds (one after another),
+    Yield a list of MaintenanceProgress, one per pump, every time a pump
+    starts or stops (and at least every `interval` seconds) until the
+    maintenance job tracked by `watcher` is finished.
+    """
+    while True:
+        done = watcher.wait_for_change(timeout=interval)
+        yield [MaintenanceProgress(run.pump_index, run.state, watcher.remaining(run), run.seconds) for run in watcher.pours]
+        if done:
+            return
+
+
+def run_maintenance(action, duration=10, pumps=None, concurrency=MAINTENANCE_CONCURRENCY, callback=None):
+    """
+    Run pumps FORWARD (prime) or in REVERSE (clean) and block until they are
+    finished, at most `concurrency` at a time. `duration` is seconds for every
+    pump, or a dict of {pump_index: seconds}. `pumps` limits which pumps run
+    (all of them by default). `callback(progress)` is called with a list of
+    MaintenanceProgress whenever a pump starts or stops.
+    """
+    watcher = get_scheduler().submit_maintenance(action, duration, pumps, concurrency)
+    for progress in maintenance_progress(watcher):
+        if callback is not None:
+            callback(progress)
+    for future in watcher.executors:
+        if not future.cancelled():
+            future.result()
+    return watcher
+
+
+def prime_pumps(duration=10, pumps=None, concurrency=MAINTENANCE_CONCURRENCY, callback=None):
+    """
+    Primes each pump for `duration` seconds, up to `concurrency` pumps at once.
+    """
+    return run_maintenance(FORWARD, duration, pumps, concurrency, callback)
+
+
+def clean_pumps(duration=10, pumps=None, concurrency=MAINTENANCE_CONCURRENCY, callback=None):
+    """
+    Reverse each pump for `duration` seconds, up to `concurrency` pumps at once,
     e.g. for cleaning lines.
     """
-    setup_gpio()
-    try:
-        for index, (ia, ib) in enumerate(MOTORS, start=1):
-            logger.info(f'Reversing pump {index} for {duration} seconds (cleaning)...')
-            motor_reverse(ia, ib)
-            time.sleep(duration)
-            motor_stop(ia, ib)
-    finally:
-        if not DEBUG:
-            GPIO.cleanup()
-        else:
-            logger.debug('clean_pumps() complete no GPIO cleanup in debug mode.')
+    return run_maintenance(REVERSE, duration, pumps, concurrency, callback)
 
 
 class ExecutorWatcher:
+    """
+    Tracks the futures and pours that make up a drink.
+
+    Every future completion and pour state change notifies a condition
+    variable, so callers can block in `wait()` or `wait_for_change()`
+    instead of polling `done()`.
+    """
 
     def __init__(self):
         self.executors = []
         self.pours = []
+        # Predicted seconds for the whole drink, and when pouring actually started
+        self.eta = None
+        self.started_at = None
+        self.clock = time.monotonic
+        self._condition = threading.Condition()
+        self._changes = 0
+        self._callbacks = []
+        self._callbacks_fired = False
+        self.cancelled = False
+        self._cancel_callbacks = []
 
     def done(self):
-        if any([not executor.done() for executor in self.executors]):
-            return False
+        with self._condition:
+            if any([not executor.done() for executor in self.executors]):
+                return False
+            return True
+
+    def add_executor(self, future):
+        """Track a future. The watcher is notified as soon as it finishes."""
+        with self._condition:
+            self.executors.append(future)
+        future.add_done_callback(self._on_change)
+
+    def add_pour(self, pour):
+        """Track a pour. The watcher is notified whenever its state changes."""
+        with self._condition:
+            self.pours.append(pour)
+        pour.add_listener(self._on_change)
+        self._on_change()
+
+    def mark_started(self):
+        """Record that pouring has begun, so `remaining()` counts down from now."""
+        with self._condition:
+            self.started_at = self.clock()
+        self._on_change()
+
+    def remaining(self, pour=None):
+        """Predicted seconds until the drink (or the given pour) is finished, or None if unknown."""
+        if pour is not None and pour.state == Pour.DONE:
+            return 0.0
+        end = self.eta if pour is None else pour.end_offset
+        if end is None:
+            return None
+        if self.started_at is None:
+            return end
+        return max(0.0, self.started_at + end - self.clock())
+
+    def add_cancel_callback(self, callback):
+        """Call `callback(watcher)` when the drink is cancelled, e.g. to stop its pumps."""
+        with self._condition:
+            self._cancel_callbacks.append(callback)
+
+    def cancel(self):
+        """
+        Cancel the drink. Queued work is dropped and the cancel callbacks stop
+        anything already pouring, leaving its pours ABORTED. Returns False if
+        the drink was already cancelled.
+        """
+        with self._condition:
+            if self.cancelled:
+                return False
+            self.cancelled = True
+            callbacks, self._cancel_callbacks = self._cancel_callbacks, []
+            executors = list(self.executors)
+        for future in executors:
+            future.cancel()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.exception('Error running ExecutorWatcher cancel callback')
+        self._on_change()
         return True
 
+    def add_done_callback(self, callback):
+        """Call `callback(watcher)` once every tracked future has finished."""
+        with self._condition:
+            if not self._callbacks_fired:
+                self._callbacks.append(callback)
+                return
+        callback(self)
 
-def pour_ingredients(ingredients, single_or_double, pump_config, parent_watcher):
-    executor = concurrent.futures.ThreadPoolExecutor()
-    executor_watcher = ExecutorWatcher()
-    factor = 2 if single_or_double.lower() == 'double' else 1
-    index = 1
-    for ingredient_name, measurement_str in sorted(ingredients.items(), key=lambda x: x[1], reverse=True):
-        parts = measurement_str.split()
-        if not parts:
-            logger.critical(f'Cannot parse measurement for {ingredient_name}. Skipping.')
-            continue
-        try:
-            oz_amount = float(parts[0])  # parse numeric
-        except ValueError:
-            logger.critical(f'Cannot parse numeric amount "{parts[0]}" for {ingredient_name}. Skipping.')
-            continue
+    def wait(self, timeout=None):
+        """Block until every tracked future has finished. Returns `done()`."""
+        with self._condition:
+            return self._condition.wait_for(self.done, timeout)
 
-        oz_needed = oz_amount * factor
+    def wait_for_change(self, timeout=None):
+        """Block until a future finishes or a pour changes state. Returns `done()`."""
+        with self._condition:
+            changes = self._changes
+            self._condition.wait_for(lambda: self._changes != changes or self.done(), timeout)
+            return self.done()
 
-        # find a matching pump label in pump_config
-        chosen_pump = None
-        for pump_label, config_ing_name in pump_config.items():
-            if config_ing_name.strip().lower() == ingredient_name.strip().lower():
-                chosen_pump = pump_label
-                break
+    def _on_change(self, *args):
+        with self._condition:
+            self._changes += 1
+            self._condition.notify_all()
+            if self._callbacks_fired or not self.executors or not self.done():
+                return
+            self._callbacks_fired = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.exception('Error running ExecutorWatcher done callback')
 
-        if not chosen_pump:
-            logger.critical(f'No pump mapped to ingredient "{ingredient_name}". Skipping.')
-            continue
 
-        # parse 'Pump 1' -> index=0
+class PumpScheduler:
+    """
+    Long-lived owner of the pump hardware.
+
+    The scheduler sets up the GPIO pins once in `start()` and releases them
+    in `stop()`. Drinks and maintenance jobs run one at a time on a single
+    job worker, and every pour's pin changes are switched on time by a single
+    ActuationEngine thread, so no threads are created per order or per pump.
+    Pins are driven and pours are timed through `backend`, the default GPIO
+    backend if not given. With a `metrics_file`, the telemetry is written
+    there in Prometheus text format after every drink. Pump current draws
+    come from `profiles`, or PUMP_PROFILES_FILE if not given.
+    """
+
+    def __init__(self, motors=MOTORS, backend=None, metrics_file=None, profiles=None):
+        self.motors = list(motors)
+        self.backend = backend or get_backend()
+        self.metrics_file = metrics_file
+        self.profiles = profiles
+        self.engine = ActuationEngine(self.backend, self.motors)
+        self._job_executor = None
+        # Watchers of queued and pouring jobs, so they can all be cancelled at once
+        self._watchers = set()
+        self._watchers_lock = threading.Lock()
+        # Lookahead retraction: drinks waiting to pour with the pumps they use, pumps whose
+        # line was left full, the fills and retractions scheduled for idle lines, and the
+        # lines filled speculatively by preprime()
+        self._queued = []
+        self._pouring = []
+        self.primed = set()
+        self._line_actuations = {}
+        self._speculative = set()
+        # While a job's pours run, retractions of other lines wait for them (with the
+        # delay and seconds to retract), so no more pumps run than the job was planned for
+        self._lines_held = False
+        self._deferred = {}
+        self._lines_lock = threading.Lock()
+        # Submitted jobs that haven't finished, and whether the running one is waiting on its pours.
+        # A virtual clock doesn't move on while a job is working, see `jobs_busy()`.
+        self._jobs_pending = 0
+        self._job_waiting = False
+        self._jobs_lock = threading.Lock()
+        self.backend.clock.add_busy_check(self.jobs_busy)
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._job_executor is not None
+
+    def start(self):
+        """Set up the GPIO pins and worker threads. Does nothing if already running."""
+        with self._lock:
+            if self.running:
+                return
+            setup_gpio(self.motors, self.backend)
+            self.engine.start()
+            self._job_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='pump-job')
+            logger.debug('PumpScheduler started')
+
+    def stop(self, wait=True):
+        """Finish (or with `wait=False`, drop) queued work, stop the workers and release the GPIO pins."""
+        with self._lock:
+            if not self.running:
+                return
+            if not wait:
+                # Stop the pumps and abort the drink in progress so it doesn't wait on pin changes that won't happen
+                self.emergency_stop()
+            self._job_executor.shutdown(wait=wait, cancel_futures=not wait)
+            self._job_executor = None
+            self.engine.stop()
+            drive_motors([(pins, STOP) for pins in self.motors], self.backend)
+            cleanup_gpio(self.backend)
+            logger.debug('PumpScheduler stopped')
+
+    def submit_job(self, function, *args):
+        """Queue `function(scheduler, *args)` behind any drinks already in progress."""
+        if not self.running:
+            raise RuntimeError('PumpScheduler is not running')
+        with self._jobs_lock:
+            self._jobs_pending += 1
+        future = self._job_executor.submit(function, self, *args)
+        future.add_done_callback(self._job_done)
+        return future
+
+    def _job_done(self, future):
+        with self._jobs_lock:
+            self._jobs_pending -= 1
+            self._job_waiting = False
+
+    def set_job_waiting(self, waiting):
+        """Mark the running job as waiting on its pours, or working again."""
+        with self._jobs_lock:
+            self._job_waiting = waiting
+
+    def jobs_busy(self):
+        """
+        Whether a job has work to do before it waits on its pours again, e.g.
+        planning the next drink right after the last one finished. Simulated
+        time holds still until it's done.
+        """
+        with self._jobs_lock:
+            return self._jobs_pending > 0 and not self._job_waiting
+
+    def schedule_pours(self, pours):
+        """
+        Hand every pin change for `pours` to the actuation engine, timed from
+        now. Returns the start time in nanoseconds.
+
+        Fills and retractions of other lines are halted and held back until
+        `resume_lines()` is called once the pours are finished, since they
+        weren't planned within POWER_BUDGET or PUMP_CONCURRENCY alongside them.
+        """
+        if not self.running:
+            raise RuntimeError('PumpScheduler is not running')
+        with self._lines_lock:
+            self._lines_held = True
+            pending, self._line_actuations = self._line_actuations, {}
+        for pump_index, actuations in pending.items():
+            self._hold_line(pump_index, actuations)
+        start_ns = self.backend.clock.monotonic_ns()
+        actuations = []
+        for pour in pours:
+            pour.scheduled = pour.actuations(start_ns)
+            if pour.finished:
+                # Aborted while being scheduled
+                for actuation in pour.scheduled:
+                    actuation.cancel()
+            actuations.extend(pour.scheduled)
+        with self._lines_lock:
+            self._pouring = list(pours)
+        self.engine.schedule(actuations)
+        return start_ns
+
+    def _hold_line(self, pump_index, actuations):
+        """Halt a line's fill or retraction, and retract whatever it holds once the lines are resumed."""
+        now_ns = self.backend.clock.monotonic_ns()
+        fill = line_fill(RETRACTION_TIME if pump_index in self.primed else 0.0, actuations, self.engine.halt(actuations))
+        if not fill:
+            self.primed.discard(pump_index)
+            return
+        self.primed.add(pump_index)
+        # A retraction that was already due carries on straight after, an idle line waits the whole timeout again
+        due = any(actuation.action == Actuation.REVERSE and actuation.deadline_ns <= now_ns for actuation in actuations)
+        with self._lines_lock:
+            self._deferred[pump_index] = (0 if due else RETRACTION_IDLE_TIMEOUT, fill)
+
+    def resume_lines(self):
+        """Let the line retractions held back by `schedule_pours()` run, once the job's pours are finished."""
+        with self._lines_lock:
+            self._lines_held = False
+            deferred, self._deferred = self._deferred, {}
+        offsets = self._plan_lines(Actuation.REVERSE, {pump_index: seconds for pump_index, (_, seconds) in deferred.items()})
+        for pump_index, (delay, seconds) in sorted(deferred.items()):
+            self._schedule_idle_retraction(pump_index, delay + offsets[pump_index], seconds)
+
+    def prepare_lines(self, watcher, pours):
+        """
+        Adjust a drink's pours for the state of the lines just before it pours.
+
+        A pump whose line was left full (or filled by `preprime()`) skips the
+        refill at the start of its pour. A pump that a drink queued behind
+        this one also uses skips its retraction to keep the line full (as do
+        pumps of a pouring drink when a drink that uses them is ordered, see
+        `submit_drink()`), and is retracted after RETRACTION_IDLE_TIMEOUT
+        seconds if nothing pours from it by then.
+        Returns True if any pour time changed.
+        """
+        with self._lines_lock:
+            self._queued = [(queued, pumps) for queued, pumps in self._queued if queued is not watcher and not queued.cancelled]
+            upcoming = set().union(*[pumps for _, pumps in self._queued])
+            pending = [self._line_actuations.pop(pour.pump_index, []) for pour in pours]
+            self._speculative.difference_update(pour.pump_index for pour in pours)
+        if not RETRACTION_TIME:
+            return False
+
+        changed = False
+        for pour, actuations in zip(pours, pending):
+            pump_index = pour.pump_index
+            fill = RETRACTION_TIME if pump_index in self.primed else 0.0
+            if actuations:
+                fill = line_fill(fill, actuations, self.engine.halt(actuations))
+            if fill and pour.seconds >= fill:
+                pour.seconds -= fill
+                changed = True
+            if pump_index in upcoming and pour.retraction:
+                pour.retraction = 0
+                changed = True
+            pour.add_listener(self._on_line_change)
+        return changed
+
+    def forget_lines(self, pump_indexes):
+        """Cancel pending fills and retractions of `pump_indexes` and stop treating their lines as full."""
+        with self._lines_lock:
+            pending = [self._line_actuations.pop(pump_index, []) for pump_index in pump_indexes]
+            for pump_index in pump_indexes:
+                self._deferred.pop(pump_index, None)
+            self._speculative.difference_update(pump_indexes)
+        for actuations in pending:
+            if actuations:
+                self.engine.halt(actuations)
+        self.primed.difference_update(pump_indexes)
+
+    def preprime(self, pump_indexes):
+        """
+        Speculatively push liquid up to the nozzle of `pump_indexes` without
+        dispensing, so a drink that uses them starts pouring sooner. Only runs
+        while no drink or maintenance job is queued, and only with a
+        RETRACTION_TIME to fill the lines for. Lines filled this way are
+        retracted by `release_lines()`, or after RETRACTION_IDLE_TIMEOUT
+        seconds if nothing pours from them. The fills are staggered within
+        the limits a drink is planned to. Returns the pumps being filled.
+        """
+        if not RETRACTION_TIME or not self.running:
+            return []
+        with self._watchers_lock:
+            if self._watchers:
+                return []
+        offsets = self._plan_lines(Actuation.FORWARD, {pump_index: RETRACTION_TIME for pump_index in set(pump_indexes)})
+        start_ns = self.backend.clock.monotonic_ns()
+        actuations = []
+        filling = []
+        with self._lines_lock:
+            if self._lines_held:
+                # A job started pouring in the meantime
+                return []
+            for pump_index, offset in sorted(offsets.items()):
+                if pump_index in self.primed or pump_index in self._line_actuations:
+                    continue
+                forward_ns = start_ns + round(offset * 1e9)
+                fill = [
+                    Actuation(forward_ns, pump_index, Actuation.FORWARD),
+                    Actuation(forward_ns + round(RETRACTION_TIME * 1e9), pump_index, Actuation.STOP, self._on_line_filled),
+                ]
+                self._line_actuations[pump_index] = fill
+                self._speculative.add(pump_index)
+                actuations.extend(fill)
+                filling.append(pump_index)
+        if filling:
+            logger.debug(f'Pre-priming pumps {", ".join(str(pump_index + 1) for pump_index in filling)}')
+            self.engine.schedule(actuations)
+        return filling
+
+    def release_lines(self, pump_indexes=None):
+        """
+        Retract lines filled by `preprime()` that no drink has claimed, or
+        only those of `pump_indexes`. Returns the pumps being retracted.
+        """
+        with self._lines_lock:
+            released = sorted(self._speculative if pump_indexes is None else self._speculative & set(pump_indexes))
+            self._speculative.difference_update(released)
+            pending = [self._line_actuations.pop(pump_index, []) for pump_index in released]
+            held = [self._deferred.pop(pump_index, None) for pump_index in released]
+        fills = {}
+        for pump_index, actuations, deferred in zip(released, pending, held):
+            fill = RETRACTION_TIME if pump_index in self.primed else 0.0
+            if deferred is not None:
+                fill = deferred[1]
+            if actuations:
+                fill = line_fill(fill, actuations, self.engine.halt(actuations))
+            if fill:
+                fills[pump_index] = fill
+            else:
+                self.primed.discard(pump_index)
+        offsets = self._plan_lines(Actuation.REVERSE, fills)
+        for pump_index, fill in fills.items():
+            self._schedule_idle_retraction(pump_index, delay=offsets[pump_index], seconds=fill)
+        return sorted(fills)
+
+    def _plan_lines(self, action, seconds):
+        """
+        Plan filling (FORWARD) or retracting (REVERSE) lines, for `seconds`
+        by pump index, within POWER_BUDGET or PUMP_CONCURRENCY like a drink.
+        Returns the seconds from now each pump starts, by pump index.
+        """
+        if not seconds:
+            return {}
+        runs = [MaintenanceRun(pump_index, action, line_seconds) for pump_index, line_seconds in seconds.items()]
+        self.plan(runs)
+        return {run.pump_index: run.start_offset for run in runs}
+
+    def _on_line_filled(self, actuation):
+        pump_index = actuation.pump_index
+        with self._lines_lock:
+            if self._line_actuations.get(pump_index, [None])[-1] is not actuation:
+                return
+            del self._line_actuations[pump_index]
+            self.primed.add(pump_index)
+        self._schedule_idle_retraction(pump_index)
+
+    def _on_line_change(self, pour):
+        if pour.emergency_stopped:
+            # Nothing moves after an emergency stop until someone asks it to
+            return
+        if pour.state == Pour.DONE and pour.retraction:
+            self.primed.discard(pour.pump_index)
+        elif pour.state == Pour.DONE or (pour.state == Pour.ABORTED and (Actuation.FORWARD in pour.applied_ns or pour.pump_index in self.primed)):
+            # The line is left full, whether the pour skipped its retraction or was stopped partway
+            self.primed.add(pour.pump_index)
+            self._schedule_idle_retraction(pour.pump_index)
+
+    def _schedule_idle_retraction(self, pump_index, delay=None, seconds=None):
+        if not self.running:
+            return
+        if delay is None:
+            delay = RETRACTION_IDLE_TIMEOUT
+        if seconds is None:
+            seconds = RETRACTION_TIME
+        reverse_ns = self.backend.clock.monotonic_ns() + round(delay * 1e9)
+
+        def retracted(actuation):
+            with self._lines_lock:
+                if self._line_actuations.get(pump_index) is retraction:
+                    del self._line_actuations[pump_index]
+                    self.primed.discard(pump_index)
+
+        retraction = [
+            Actuation(reverse_ns, pump_index, Actuation.REVERSE),
+            Actuation(reverse_ns + round(seconds * 1e9), pump_index, Actuation.STOP, retracted),
+        ]
+        with self._lines_lock:
+            if self._lines_held:
+                # Retracted once the pouring job is finished, see `schedule_pours()`
+                self._deferred[pump_index] = (delay, seconds)
+                return
+            self._line_actuations[pump_index] = retraction
+        if delay:
+            logger.debug(f'Keeping Pump {pump_index + 1} primed for {delay:g} seconds')
+        self.engine.schedule(retraction)
+
+    def plan(self, pours, concurrency=None):
+        """Plan `pours` on this scheduler's pumps. See `plan_drink()`."""
+        return plan_drink(pours, len(self.motors), self.profiles, concurrency)
+
+    def track(self, watcher, pours):
+        """Let `watcher.cancel()` stop `pours`, and include it in `emergency_stop()` until it's done."""
+        watcher.add_cancel_callback(lambda watcher: self.abort_pours(pours))
+        with self._watchers_lock:
+            self._watchers.add(watcher)
+
+        def untrack(watcher):
+            with self._watchers_lock:
+                self._watchers.discard(watcher)
+
+        watcher.add_done_callback(untrack)
+
+    def abort_pours(self, pours):
+        """Stop any of `pours` that are still running, in one GPIO batch, and mark the unfinished ones ABORTED."""
+        unfinished = [pour for pour in pours if not pour.finished]
+        if not unfinished:
+            return
+        stopped_ns = self.engine.halt([actuation for pour in unfinished for actuation in pour.scheduled])
+        for pour in unfinished:
+            pour.abort(stopped_ns)
+
+    def emergency_stop(self):
+        """
+        Stop every pump in a single GPIO batch, then cancel every queued and
+        pouring job. Lines are left as they are, with no fill or retraction
+        scheduled for them. Returns the watchers that were cancelled.
+        """
+        if not self.running:
+            return []
+        stopped_ns = self.engine.halt()
+        logger.warning('Emergency stop: all pumps stopped')
+        with self._watchers_lock:
+            watchers = list(self._watchers)
+        # Drop queued jobs before aborting the pouring one, so the next drink can't start in between
+        for watcher in watchers:
+            for future in watcher.executors:
+                future.cancel()
+        for watcher in watchers:
+            for pour in watcher.pours:
+                pour.abort(stopped_ns, emergency=True)
+            watcher.cancel()
+        self.forget_lines(range(len(self.motors)))
+        return watchers
+
+    def submit_drink(self, planned_pours, concurrency=None, metrics=True):
+        """
+        Queue a drink's PlannedPours and return the ExecutorWatcher that
+        tracks it. The watcher's ETA is known immediately. See `plan_drink()`
+        for `concurrency`. With `metrics=False` (e.g. for a calibration pour)
+        it isn't counted in the drink metrics.
+        """
+        pours = [
+            Pour(planned.pump_index, planned.ounces, planned.ingredient_name, planned.seconds)
+            for planned in planned_pours if planned.pump_index < len(self.motors)
+        ]
+        self.plan(pours, concurrency)
+        executor_watcher = ExecutorWatcher()
+        executor_watcher.clock = self.backend.clock.monotonic
+        for pour in sorted(pours, key=lambda pour: pour.start_offset):
+            executor_watcher.add_pour(pour)
+        executor_watcher.eta = max([pour.end_offset for pour in pours], default=0.0)
+        ordered_at = self.backend.clock.monotonic()
+
+        def pour_drink(scheduler):
+            if scheduler.prepare_lines(executor_watcher, pours):
+                scheduler.plan(pours, concurrency)
+                executor_watcher.eta = max([pour.end_offset for pour in pours], default=0.0)
+            pour_ingredients(pours, executor_watcher, scheduler=scheduler)
+            if metrics and executor_watcher.cancelled:
+                DRINKS_CANCELLED.inc()
+            elif metrics:
+                DRINKS.inc()
+                started_at = ordered_at if executor_watcher.started_at is None else executor_watcher.started_at
+                QUEUE_WAIT.observe(started_at - ordered_at)
+                DRINK_LATENCY.observe(scheduler.backend.clock.monotonic() - ordered_at)
+            if scheduler.metrics_file:
+                REGISTRY.write(scheduler.metrics_file)
+
+        with self._lines_lock:
+            self._queued.append((executor_watcher, {pour.pump_index for pour in pours}))
+            pouring = list(self._pouring)
+        if RETRACTION_TIME:
+            # Keep lines full for this drink if the one pouring now uses them too
+            for pour in pouring:
+                if not pour.finished and pour.retraction and pour.pump_index in {planned.pump_index for planned in pours}:
+                    pour.skip_retraction(self.engine)
+        executor_watcher.add_executor(self.submit_job(pour_drink))
+        self.track(executor_watcher, pours)
+        return executor_watcher
+
+    def submit_batch(self, rounds, concurrency=None):
+        """
+        Queue the rounds of a batch (see `plan_batch()`) as drinks, one after
+        another, and return a single ExecutorWatcher that tracks them all.
+        Its ETA is the whole batch's, and cancelling it (or any round)
+        cancels the rest of the batch.
+        """
+        round_watchers = [self.submit_drink(planned_pours, concurrency) for planned_pours in rounds]
+        batch_watcher = ExecutorWatcher()
+        batch_watcher.clock = self.backend.clock.monotonic
+        batch_watcher.eta = sum(watcher.eta for watcher in round_watchers)
+
+        def on_first_pour(pour):
+            if pour.state != Pour.PENDING and batch_watcher.started_at is None:
+                batch_watcher.mark_started()
+
+        for watcher in round_watchers:
+            for pour in watcher.pours:
+                batch_watcher.add_pour(pour)
+            for future in watcher.executors:
+                batch_watcher.add_executor(future)
+            watcher.add_cancel_callback(lambda watcher: batch_watcher.cancel())
+        for pour in round_watchers[0].pours if round_watchers else []:
+            pour.add_listener(on_first_pour)
+
+        def cancel_rounds(batch_watcher):
+            # Drop the rounds still queued before stopping the one pouring, so the next can't start in between
+            for watcher in reversed(round_watchers):
+                watcher.cancel()
+
+        batch_watcher.add_cancel_callback(cancel_rounds)
+        return batch_watcher
+
+    def submit_maintenance(self, action, duration=10, pumps=None, concurrency=MAINTENANCE_CONCURRENCY):
+        """
+        Queue a prime (FORWARD) or clean (REVERSE) of `pumps` and return the
+        ExecutorWatcher that tracks it. See `run_maintenance()`.
+        """
+        if pumps is None:
+            pumps = range(len(self.motors))
+        durations = duration if isinstance(duration, dict) else {pump_index: duration for pump_index in pumps}
+        runs = [
+            MaintenanceRun(pump_index, action, durations[pump_index])
+            for pump_index in pumps if 0 <= pump_index < len(self.motors) and durations.get(pump_index, 0) > 0
+        ]
+        self.plan(runs, concurrency)
+        executor_watcher = ExecutorWatcher()
+        executor_watcher.clock = self.backend.clock.monotonic
+        for run in sorted(runs, key=lambda run: (run.start_offset, run.pump_index)):
+            executor_watcher.add_pour(run)
+        executor_watcher.eta = max([run.end_offset for run in runs], default=0.0)
+
+        def maintain(scheduler):
+            # Priming and cleaning leave the lines in a state of their own
+            scheduler.forget_lines([run.pump_index for run in runs])
+            pour_ingredients(runs, executor_watcher, scheduler=scheduler)
+
+        executor_watcher.add_executor(self.submit_job(maintain))
+        self.track(executor_watcher, runs)
+        return executor_watcher
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Get the shared PumpScheduler, starting it on first use."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = PumpScheduler(metrics_file=METRICS_FILE)
+            atexit.register(_scheduler.stop)
+        _scheduler.start()
+        return _scheduler
+
+
+PlannedPour = namedtuple('PlannedPour', ['pump_index', 'ingredient_name', 'ounces', 'seconds'])
+PourPlan = namedtuple('PourPlan', ['single', 'double'])
+# A pitcher or tray of a recipe, scaled to `servings` and split into `rounds` of PlannedPours.
+#   ounces: total volume of the batch
+#   eta: predicted seconds for every round, once the batch starts pouring
+#   capped: whether fewer servings were planned than asked for, to fit BATCH_CAPACITY
+BatchPlan = namedtuple('BatchPlan', ['servings', 'ounces', 'rounds', 'eta', 'capped'])
+
+
+def compile_recipe(ingredients, ingredient_index, motor_count=len(MOTORS), profiles=None):
+    """
+    Compile a recipe's ingredients into an immutable PourPlan holding the
+    single and double PlannedPours for every ingredient that can be measured
+    and is on a pump in `ingredient_index`. Pour times come from each pump's
+    calibration in `profiles`.
+    """
+    if profiles is None:
+        profiles = PumpProfiles()
+    single = []
+    for ingredient_name, measurement_str in ingredients.items():
         try:
-            pump_num_str = chosen_pump.replace('Pump', '').strip()
-            pump_index = int(pump_num_str) - 1
+            oz_needed = parse_measurement(measurement_str)
         except ValueError:
-            logger.critical(f'Could not parse pump label "{chosen_pump}". Skipping.')
+            logger.critical(f'Cannot parse measurement "{measurement_str}" for {ingredient_name}. Skipping.')
             continue
 
-        if pump_index < 0 or pump_index >= len(MOTORS):
+        pump_index = ingredient_index.pump_index(ingredient_name)
+        if pump_index is None:
+            logger.critical(f'No pump mapped to ingredient "{ingredient_name}". Skipping.')
+            continue
+
+        if pump_index < 0 or pump_index >= motor_count:
             logger.critical(f'Pump index {pump_index} out of range for "{ingredient_name}". Skipping.')
             continue
 
-        pour = Pour(pump_index, oz_needed, ingredient_name)
-        parent_watcher.pours.append(pour)
-        executor_watcher.executors.append(executor.submit(pour.run))
+        single.append(PlannedPour(pump_index, ingredient_name, oz_needed, pour_seconds(oz_needed, profiles[pump_index])))
 
-        if index % PUMP_CONCURRENCY == 0:
-            while not executor_watcher.done():
-                pass
-        index += 1
+    double = [
+        planned._replace(ounces=planned.ounces * 2, seconds=pour_seconds(planned.ounces * 2, profiles[planned.pump_index]))
+        for planned in single
+    ]
+    return PourPlan(tuple(single), tuple(double))
 
-    while not executor_watcher.done():
-        pass
-    
-    if not DEBUG:
-        GPIO.cleanup()
-    else:
-        logger.debug('pour_ingredients() complete — no GPIO cleanup in debug mode.')
-        
 
-def make_drink(recipe, single_or_double="single"):
+class PourPlanCache:
     """
-    Prepare a drink using the hardware pumps, based on:
-      1) a `recipe` dict from cocktails.json (with "ingredients": {...})
-      2) single_or_double parameter (either "single" or "double").
+    Compiled PourPlans for every recipe in the cocktails file.
 
-    In debug mode, only prints messages instead of driving motors.
+    Plans are compiled ahead of time and only rebuilt when the cocktails
+    file or its journal, the pump config or profiles files, OZ_COEFFICIENT or RETRACTION_TIME change, so
+    looking one up never reads or parses a file. Recipes that aren't in the
+    cocktails file (e.g. adjusted in the app) are compiled once on first use.
+
+    With a `storage` (see storage.py), the cocktails and pump config come
+    from it instead of the files, and plans are rebuilt when its revision
+    changes.
     """
-    # 1) Load the pump config dictionary, e.g. {"Pump 1": "vodka", "Pump 2": "gin", ...}
-    if not os.path.exists(CONFIG_FILE):
-        logger.critical(f'pump_config file not found: {CONFIG_FILE}')
+
+    def __init__(self, config_file=CONFIG_FILE, cocktails_file=COCKTAILS_FILE, profiles_file=PUMP_PROFILES_FILE, storage=None):
+        self.config_file = config_file
+        self.cocktails_file = cocktails_file
+        self.journal = CocktailJournal(cocktails_file)
+        self.profiles_file = profiles_file
+        self.storage = storage
+        self.index = IngredientIndex({})
+        self.profiles = PumpProfiles()
+        self._plans = {}
+        self._signature = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def recipe_key(ingredients):
+        return tuple(sorted(ingredients.items()))
+
+    def _current_signature(self):
+        if self.storage is not None:
+            revision = self.storage.revision()
+            return (revision, revision, file_signature(self.profiles_file), OZ_COEFFICIENT, RETRACTION_TIME)
+        return (
+            file_signature(self.config_file), self.journal.signature(), file_signature(self.profiles_file),
+            OZ_COEFFICIENT, RETRACTION_TIME,
+        )
+
+    def _refresh(self):
+        signature = self._current_signature()
+        if signature == self._signature:
+            return
+
+        self._plans = {}
+        if signature[0] is None:
+            logger.critical(f'pump_config file not found: {self.config_file}')
+        self.profiles = get_pump_profiles(self.profiles_file)
+
+        cocktails = []
+        if self.storage is not None:
+            self.index = IngredientIndex(self.storage.load_pump_config())
+            cocktails = self.storage.load_cocktails().get('cocktails', [])
+        else:
+            self.index = get_ingredient_index(self.config_file)
+        if self.storage is None and any(signature[1]):
+            try:
+                cocktails = self.journal.load()[0].get('cocktails', [])
+            except Exception as e:
+                logger.critical(f'Error reading {self.cocktails_file}: {e}')
+        for cocktail in cocktails:
+            ingredients = cocktail.get('ingredients', {})
+            self._plans[self.recipe_key(ingredients)] = compile_recipe(ingredients, self.index, profiles=self.profiles)
+
+        self._signature = signature
+        logger.debug(f'Compiled pour plans for {len(self._plans)} recipes')
+
+    def get(self, recipe):
+        """Get the PourPlan for a recipe dict."""
+        ingredients = recipe.get('ingredients', {})
+        key = self.recipe_key(ingredients)
+        with self._lock:
+            self._refresh()
+            plan = self._plans.get(key)
+            if plan is None:
+                plan = self._plans[key] = compile_recipe(ingredients, self.index, profiles=self.profiles)
+            return plan
+
+
+_plan_cache = PourPlanCache(storage=get_storage())
+
+
+def calibration_pour(pump_index, seconds):
+    """
+    Dispense from one pump for `seconds`, the way a real pour would (refilling
+    the line for RETRACTION_TIME first and retracting afterwards), so the
+    amount in the glass can be measured for `calibrate_pump()`. Returns the
+    ExecutorWatcher of the pour.
+    """
+    planned = PlannedPour(pump_index, f'Pump {pump_index + 1} calibration', 0.0, seconds + RETRACTION_TIME)
+    return get_scheduler().submit_drink([planned], metrics=False)
+
+
+def calibrate_pump(pump_index, samples, profiles_file=PUMP_PROFILES_FILE):
+    """
+    Fit a pump's seconds per ounce and dead volume from calibration pours,
+    a list of (seconds, measured ounces), and save them to its profile.
+    Returns the updated PumpProfile.
+    """
+    seconds_per_oz, dead_volume = fit_calibration(samples)
+    profiles = PumpProfiles(get_pump_profiles(profiles_file).to_json())
+    profiles.set(pump_index, seconds_per_oz=round(seconds_per_oz, 4), dead_volume=round(dead_volume, 4))
+    save_pump_profiles(profiles, profiles_file)
+    logger.info(f'Calibrated Pump {pump_index + 1}: {seconds_per_oz:.3f} seconds per oz, {dead_volume:.3f} oz dead volume')
+    return profiles[pump_index]
+
+
+def emergency_stop():
+    """Stop every pump and cancel every drink and maintenance job in this process. See `PumpScheduler.emergency_stop()`."""
+    with _scheduler_lock:
+        scheduler = _scheduler
+    if scheduler is None:
+        return []
+    return scheduler.emergency_stop()
+
+
+def plan_pours(pours, concurrency=PUMP_CONCURRENCY, power_budget=None):
+    """
+    Assign pours to `concurrency` pump slots, longest pour first, each one
+    going to the slot that frees up earliest. This keeps the total drink
+    time close to the minimum possible. Sets each pour's `start_offset` and
+    `end_offset` and returns the slots as lists of pours in run order.
+
+    With a `power_budget` in amps, a pour also waits until the
+    `current_draw` of the pumps running alongside it leaves room in the
+    budget for the whole time it runs. A pour that needs more than the
+    whole budget runs on its own.
+    """
+    concurrency = max(1, concurrency)
+    if not power_budget:
+        slots = [[] for _ in range(min(concurrency, len(pours)))]
+        free_at = [(0.0, index) for index in range(len(slots))]
+        for pour in sorted(pours, key=lambda pour: pour.duration, reverse=True):
+            start, index = heapq.heappop(free_at)
+            pour.start_offset = start
+            pour.end_offset = start + pour.duration
+            slots[index].append(pour)
+            heapq.heappush(free_at, (pour.end_offset, index))
+        return slots
+
+    def current(pour):
+        return min(pour.current_draw, power_budget)
+
+    def fits(pour, start, placed):
+        end = start + pour.duration
+        overlapping = [other for other in placed if other.start_offset < end and other.end_offset > start]
+        # The load only goes up where another pour starts, so those are the only points to check
+        for point in [start] + [other.start_offset for other in overlapping if other.start_offset > start]:
+            running = [other for other in overlapping if other.start_offset <= point < other.end_offset]
+            if len(running) >= concurrency or sum(map(current, running)) + current(pour) > power_budget + 1e-9:
+                return False
+        return True
+
+    slots = []
+    placed = []
+    for pour in sorted(pours, key=lambda pour: pour.duration, reverse=True):
+        # Everything has stopped by the last end time, so some candidate always fits
+        start = next(
+            start for start in sorted({0.0} | {other.end_offset for other in placed})
+            if fits(pour, start, placed)
+        )
+        pour.start_offset = start
+        pour.end_offset = start + pour.duration
+        placed.append(pour)
+        free = [index for index, slot in enumerate(slots) if slot[-1].end_offset <= start]
+        if free:
+            slots[min(free, key=lambda index: (slots[index][-1].end_offset, index))].append(pour)
+        else:
+            slots.append([pour])
+    return slots
+
+
+def plan_drink(pours, motor_count=len(MOTORS), profiles=None, concurrency=None):
+    """
+    Plan a drink's `pours` with plan_pours(), at most `concurrency` pumps at
+    a time and within POWER_BUDGET if it's set. Without a `concurrency`,
+    drinks are limited by PUMP_CONCURRENCY, or only by the budget when there
+    is one. Pump current draws come from `profiles`, or PUMP_PROFILES_FILE.
+    """
+    profiles = profiles or get_pump_profiles()
+    for pour in pours:
+        pour.current_draw = profiles[pour.pump_index].current_draw
+    if concurrency is None:
+        concurrency = motor_count if POWER_BUDGET > 0 else PUMP_CONCURRENCY
+    return plan_pours(pours, min(concurrency, motor_count), POWER_BUDGET)
+
+
+def pour_ingredients(pours, parent_watcher, scheduler=None):
+    """Schedule planned pours on the actuation engine and block until every pour is done or aborted."""
+    if scheduler is None:
+        scheduler = get_scheduler()
+    if not pours:
         return
+    finished = threading.Event()
+    done = set()
 
-    try:
-        with open(CONFIG_FILE, 'r') as f:
-            pump_config = json.load(f)
-    except Exception as e:
-        logger.critical(f'Error reading {CONFIG_FILE}: {e}')
+    def on_change(pour):
+        if pour.finished:
+            done.add(pour)
+            if len(done) == len(pours) and not finished.is_set():
+                # Set before the engine moves on, so simulated time waits for this job to carry on
+                scheduler.set_job_waiting(False)
+                finished.set()
+
+    for pour in pours:
+        pour.add_listener(on_change)
+        # It may have been aborted while queued
+        on_change(pour)
+    if finished.is_set():
         return
+    parent_watcher.mark_started()
+    scheduler.set_job_waiting(True)
+    scheduler.schedule_pours(pours)
+    finished.wait()
+    scheduler.resume_lines()
+
+
+def preprime_cocktail(recipe):
+    """
+    Speculatively fill the lines of the pumps a `recipe` pours from, e.g.
+    while it's on screen, so ordering it starts pouring sooner. Returns the
+    pumps being filled. See `PumpScheduler.preprime()`.
+    """
+    if not recipe.get('ingredients') or not RETRACTION_TIME:
+        return []
+    plan = _plan_cache.get(recipe)
+    if not _plan_cache.index:
+        return []
+    return get_scheduler().preprime([planned.pump_index for planned in plan.single])
 
-    # 2) Extract the recipe's ingredients
-    ingredients = recipe.get('ingredients', {})
-    if not ingredients:
+
+def release_primed_lines():
+    """Retract every line filled by `preprime_cocktail()` that wasn't poured from. Returns the pumps being retracted."""
+    with _scheduler_lock:
+        scheduler = _scheduler
+    if scheduler is None:
+        return []
+    return scheduler.release_lines()
+
+
+def get_planned_pours(recipe, single_or_double='single'):
+    """The PlannedPours of a single or double `recipe`, or None if it has no ingredients or no pumps are configured."""
+    if not recipe.get('ingredients'):
         logger.critical('No ingredients found in recipe.')
+        return None
+    plan = _plan_cache.get(recipe)
+    if not _plan_cache.index:
+        return None
+    return plan.double if single_or_double.lower() == 'double' else plan.single
+
+
+def drink_seconds(recipe, single_or_double='single'):
+    """
+    Predicted seconds a drink takes once it starts pouring, planned the way
+    the scheduler would without touching the pumps. None if it can't be made.
+    A number of servings is planned as a batch.
+    """
+    if not isinstance(single_or_double, str):
+        plan = plan_batch(recipe, servings=single_or_double)
+        return None if plan is None else plan.eta
+    planned_pours = get_planned_pours(recipe, single_or_double)
+    if planned_pours is None:
+        return None
+    pours = [
+        Pour(planned.pump_index, planned.ounces, planned.ingredient_name, planned.seconds)
+        for planned in planned_pours if planned.pump_index < len(MOTORS)
+    ]
+    plan_drink(pours)
+    return max([pour.end_offset for pour in pours], default=0.0)
+
+
+def batch_concurrency(motor_count=len(MOTORS)):
+    """
+    How many pumps a batch runs at once: every pump when POWER_BUDGET keeps
+    them safe, or else the most that PUMP_CONCURRENCY or
+    MAINTENANCE_CONCURRENCY says the power supply can run together.
+    """
+    if POWER_BUDGET > 0:
+        return motor_count
+    return max(PUMP_CONCURRENCY, MAINTENANCE_CONCURRENCY)
+
+
+def plan_batch(recipe, servings=None, ounces=None, capacity=None, chunk_ounces=None):
+    """
+    Plan a batch of `recipe` for a pitcher or tray, scaled to a number of
+    `servings` or to a total volume in `ounces`. Returns a BatchPlan, or
+    None if the recipe can't be made.
+
+    The batch is kept within `capacity` ounces (BATCH_CAPACITY), making
+    fewer servings if it wouldn't fit. It's poured in rounds of the whole
+    recipe, each pouring at most `chunk_ounces` (BATCH_CHUNK_OUNCES) of any
+    ingredient, so every ingredient goes in together instead of one after
+    another.
+    """
+    single = get_planned_pours(recipe, 'single')
+    if not single:
+        return None
+    single = [planned for planned in single if planned.pump_index < len(MOTORS)]
+    serving_ounces = sum(planned.ounces for planned in single)
+    if servings is None:
+        servings = 1.0 if ounces is None or not serving_ounces else ounces / serving_ounces
+    if servings <= 0 or not serving_ounces:
+        return None
+    capacity = BATCH_CAPACITY if capacity is None else capacity
+    chunk_ounces = BATCH_CHUNK_OUNCES if chunk_ounces is None else chunk_ounces
+    capped = bool(capacity) and servings * serving_ounces > capacity
+    if capped:
+        servings = capacity / serving_ounces
+        logger.warning(f'Batch of {recipe.get("normal_name", "cocktail")} limited to {servings:g} servings to fit {capacity:g} oz')
+
+    largest = max(planned.ounces for planned in single) * servings
+    round_count = max(1, math.ceil(largest / chunk_ounces - 1e-9)) if chunk_ounces > 0 else 1
+    profiles = _plan_cache.profiles
+    round_pours = tuple(
+        planned._replace(
+            ounces=planned.ounces * servings / round_count,
+            seconds=pour_seconds(planned.ounces * servings / round_count, profiles[planned.pump_index]),
+        )
+        for planned in single
+    )
+    pours = [Pour(planned.pump_index, planned.ounces, planned.ingredient_name, planned.seconds) for planned in round_pours]
+    plan_drink(pours, profiles=profiles, concurrency=batch_concurrency())
+    round_seconds = max([pour.end_offset for pour in pours], default=0.0)
+    return BatchPlan(servings, serving_ounces * servings, (round_pours,) * round_count, round_seconds * round_count, capped)
+
+
+def make_batch(recipe, servings=None, ounces=None):
+    """
+    Pour a batch of `recipe`, scaled to `servings` or a total volume in
+    `ounces`, and return the ExecutorWatcher that tracks every round of it.
+    See `plan_batch()`.
+    """
+    plan = plan_batch(recipe, servings, ounces)
+    if plan is None:
         return
+    return get_scheduler().submit_batch(plan.rounds, batch_concurrency())
+
 
-    setup_gpio()
-    executor = concurrent.futures.ThreadPoolExecutor()
-    executor_watcher = ExecutorWatcher()
-    executor_watcher.executors.append(executor.submit(pour_ingredients, ingredients, single_or_double, pump_config, executor_watcher))
+def make_drink(recipe, single_or_double="single"):
+    """
+    Prepare a drink using the hardware pumps, based on:
+      1) a `recipe` dict from cocktails.json (with "ingredients": {...})
+      2) single_or_double parameter (either "single" or "double", or a
+         number of servings to pour as a batch with `make_batch()`).
 
-    return executor_watcher
\ No newline at end of file
+    In debug mode, only prints messages instead of driving motors.
+    """
+    if not isinstance(single_or_double, str):
+        return make_batch(recipe, servings=single_or_double)
+    planned_pours = get_planned_pours(recipe, single_or_double)
+    if planned_pours is None:
+        return
+    return get_scheduler().submit_drink(planned_pours)
@@ -0,0 +1,238 @@
+# file_watch.py
+"""
+Calls back when files or directories change, so the interface reloads
+cocktails when they're saved instead of polling for them.
+
+On Linux this uses inotify through ctypes, so nothing is checked until the
+kernel says something changed. Elsewhere (or if inotify can't be set up)
+it falls back to stat-ing the paths every `poll_interval` seconds.
+
+Changes are debounced: the callback runs once the paths have been quiet
+for `debounce` seconds, with every path that changed in that time. A
+saved file is usually written, renamed and appended to in a quick burst,
+and this reports it once.
+
+    watcher = FileWatcher(['cocktails.json', 'drink_logos'], print)
+    watcher.start()
+
+A watched file is reported by its own path, and a change inside a watched
+directory by the path of the file in it.
+"""
+import os
+import time
+import errno
+import ctypes
+import select
+import struct
+import threading
+import ctypes.util
+
+from ingredients import file_signature
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+EVENT_HEADER = struct.Struct('iIII')
+
+DEFAULT_DEBOUNCE = 0.25
+DEFAULT_POLL_INTERVAL = 1.0
+
+
+class Inotify:
+    """A thin ctypes wrapper around an inotify instance."""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, 'libc not found')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """Watch a file or directory. Returns the watch descriptor."""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def read(self):
+        """The events ready to read, as (watch descriptor, mask, name) tuples."""
+        events = []
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(buffer):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = buffer[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher:
+    """
+    Watches files and directories on a background thread, and calls
+    `callback` with a frozenset of the paths that changed. The callback
+    runs on the watcher's thread.
+    """
+
+    def __init__(self, paths, callback, debounce=DEFAULT_DEBOUNCE, poll_interval=DEFAULT_POLL_INTERVAL, use_inotify=True):
+        self.paths = list(dict.fromkeys(paths))
+        self.callback = callback
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self._inotify = None
+        # Watch descriptors to the directory they watch, and for each watched directory the names in it to report
+        self._directories = {}
+        self._names = {}
+        self._snapshot = {}
+        self._stopped = threading.Event()
+        self._wake_read, self._wake_write = os.pipe()
+        self._thread = None
+
+    @property
+    def using_inotify(self):
+        return self._inotify is not None
+
+    def start(self):
+        if self.use_inotify:
+            try:
+                self._inotify = Inotify()
+                self._add_watches()
+            except (OSError, AttributeError):
+                logger.warning('inotify is not available, so watched files will be polled', exc_info=True)
+                if self._inotify is not None:
+                    self._inotify.close()
+                    self._inotify = None
+        if self._inotify is None:
+            self._snapshot = self._take_snapshot()
+        self._thread = threading.Thread(target=self._run, name='file-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        os.write(self._wake_write, b'\0')
+        if self._thread is not None:
+            self._thread.join()
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+    def _add_watches(self):
+        # Files are watched through their directory, since saving replaces them with a new file
+        wds = {}
+        for path in self.paths:
+            if os.path.isdir(path):
+                directory, name = path, None
+            else:
+                directory, name = os.path.split(path)
+                directory = directory or '.'
+            if directory not in wds:
+                try:
+                    wds[directory] = self._inotify.add_watch(directory)
+                except FileNotFoundError:
+                    logger.warning(f'Not watching {path}, since {directory} does not exist')
+                    continue
+                self._directories[wds[directory]] = directory
+            self._names.setdefault(directory, {})[name] = path
+
+    def _paths_for(self, wd, name):
+        directory = self._directories.get(wd)
+        if directory is None:
+            return set()
+        names = self._names[directory]
+        if None in names:
+            # The whole directory is watched
+            return {os.path.join(names[None], name) if name else names[None]}
+        if name in names:
+            return {names[name]}
+        return set()
+
+    def _take_snapshot(self):
+        snapshot = {}
+        for path in self.paths:
+            snapshot[path] = file_signature(path)
+            if os.path.isdir(path):
+                try:
+                    entries = list(os.scandir(path))
+                except OSError:
+                    continue
+                for entry in entries:
+                    snapshot[os.path.join(path, entry.name)] = file_signature(entry.path)
+        return snapshot
+
+    def _wait(self, timeout):
+        """Wait up to `timeout` seconds (forever if None) for changes, and return the paths that changed."""
+        if self._inotify is None:
+            self._stopped.wait(timeout)
+            if self._stopped.is_set():
+                return set()
+            snapshot = self._take_snapshot()
+            changed = {path for path in snapshot.keys() | self._snapshot.keys() if snapshot.get(path) != self._snapshot.get(path)}
+            self._snapshot = snapshot
+            return changed
+
+        ready, _, _ = select.select([self._inotify.fd, self._wake_read], [], [], timeout)
+        if self._inotify.fd not in ready:
+            return set()
+        changed = set()
+        for wd, mask, name in self._inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                logger.warning('Too many file changes to follow, reporting every watched path')
+                changed.update(self.paths)
+            else:
+                changed.update(self._paths_for(wd, name))
+        return changed
+
+    def _run(self):
+        pending = set()
+        quiet_at = None
+        while not self._stopped.is_set():
+            timeout = None if self._inotify is not None else self.poll_interval
+            if pending:
+                remaining = max(0.0, quiet_at - time.monotonic())
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            changed = self._wait(timeout)
+            if changed:
+                pending |= changed
+                quiet_at = time.monotonic() + self.debounce
+            elif pending and time.monotonic() >= quiet_at:
+                paths, pending = frozenset(pending), set()
+                try:
+                    self.callback(paths)
+                except Exception:
+                    logger.exception('Error handling file changes')
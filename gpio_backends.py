@@ -0,0 +1,263 @@
+# gpio_backends.py
+import time
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RealClock:
+    """Wall clock time."""
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def monotonic_ns(self):
+        return time.monotonic_ns()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, condition, seconds):
+        """Wait on `condition` (held by the caller) for up to `seconds` (None for no limit), waking early if it's notified."""
+        condition.wait(seconds)
+
+    def add_busy_check(self, check):
+        """Real time can't wait for anyone, see `VirtualClock.add_busy_check()`."""
+
+
+class VirtualClock:
+    """
+    Simulated time that never really sleeps.
+
+    Sleeping or waiting on the clock moves it forward instantly, so a single
+    actuation thread can run through hours of pours in milliseconds.
+
+    To feed in events at set times (like orders arriving), `run_until()`
+    holds waits at that time, so nothing on the clock runs past it first.
+    """
+
+    def __init__(self, start=0.0):
+        self._now_ns = int(start * 1e9)
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        # Waits don't move the clock past the hold, and conditions blocked at it are woken when it moves
+        self._hold_ns = None
+        self._held = set()
+        self._parked = False
+        self._busy_checks = []
+
+    def monotonic(self):
+        return self._now_ns / 1e9
+
+    def monotonic_ns(self):
+        return self._now_ns
+
+    def advance(self, seconds):
+        """Move the clock forward, e.g. to simulate idle time between orders."""
+        with self._lock:
+            self._now_ns += max(0, round(seconds * 1e9))
+            self._changed.notify_all()
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def wait(self, condition, seconds):
+        """
+        Move the clock forward by `seconds`, but no further than the hold.
+        At the hold, or with no limit (None), block on `condition` until it's
+        notified or the hold moves.
+        """
+        if seconds is not None and any(check() for check in self._busy_checks):
+            # Other threads are still reacting to the last pin change, so let them catch up first
+            condition.wait(0.001)
+            return
+        with self._lock:
+            if seconds is not None:
+                target_ns = self._now_ns + max(0, round(seconds * 1e9))
+                if self._hold_ns is not None:
+                    target_ns = min(target_ns, max(self._now_ns, self._hold_ns))
+                if target_ns > self._now_ns or seconds <= 0:
+                    self._now_ns = target_ns
+                    self._changed.notify_all()
+                    return
+            self._held.add(condition)
+            self._parked = seconds is None
+            self._changed.notify_all()
+        try:
+            condition.wait()
+        finally:
+            with self._lock:
+                self._held.discard(condition)
+                self._parked = False
+
+    def add_busy_check(self, check):
+        """Don't move the clock forward while `check()` is true, e.g. while a thread works out what to pour next."""
+        self._busy_checks.append(check)
+
+    def hold(self, seconds):
+        """Stop waits from moving the clock past `seconds`, or let them again with None."""
+        with self._lock:
+            self._hold_ns = None if seconds is None else round(seconds * 1e9)
+            held = list(self._held)
+        for condition in held:
+            with condition:
+                condition.notify_all()
+
+    def run_until(self, seconds, idle=lambda: True):
+        """
+        Let waits move the clock up to `seconds` and block until they have.
+        If the waiting thread has nothing scheduled and `idle()` is true,
+        jump straight there. The clock stays held at `seconds` afterwards.
+        """
+        self.hold(seconds)
+        target_ns = round(seconds * 1e9)
+        with self._lock:
+            while self._now_ns < target_ns:
+                if self._parked and idle():
+                    self._now_ns = target_ns
+                    break
+                # Idle can turn true without the clock noticing, so check again now and then
+                self._changed.wait(0.01)
+
+
+def as_batch(pins, values):
+    """
+    Normalize the arguments to `output()` into equal length lists. Like
+    RPi.GPIO, `pins` may be one pin or a sequence, and `values` one value for
+    every pin or a sequence with one per pin.
+    """
+    if isinstance(pins, int):
+        pins = [pins]
+    pins = list(pins)
+    if isinstance(values, int):
+        values = [values] * len(pins)
+    values = list(values)
+    if len(pins) != len(values):
+        raise ValueError(f'Got {len(values)} values for {len(pins)} pins')
+    return pins, values
+
+
+class GPIOBackend:
+    """
+    Interface between the controller and the motor driver pins.
+
+    Backends set up and drive output pins and provide the clock that pours
+    are timed against.
+    """
+    name = None
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self, clock=None):
+        self.clock = clock or RealClock()
+
+    def setup(self, pins):
+        """Configure `pins` as outputs."""
+        raise NotImplementedError
+
+    def output(self, pins, values):
+        """Drive one pin or a batch of pins HIGH or LOW in a single call. See `as_batch()`."""
+        raise NotImplementedError
+
+    def cleanup(self):
+        """Release all pins."""
+        raise NotImplementedError
+
+
+class RPiGPIOBackend(GPIOBackend):
+    """Drives the pins through RPi.GPIO."""
+    name = 'rpi'
+
+    def __init__(self, clock=None):
+        super().__init__(clock)
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        self.HIGH = GPIO.HIGH
+        self.LOW = GPIO.LOW
+
+    def setup(self, pins):
+        self.GPIO.setmode(self.GPIO.BCM)
+        self.GPIO.setup(list(pins), self.GPIO.OUT, initial=self.GPIO.LOW)
+
+    def output(self, pins, values):
+        pins, values = as_batch(pins, values)
+        if pins:
+            self.GPIO.output(pins, values)
+
+    def cleanup(self):
+        self.GPIO.cleanup()
+
+
+class LoggingBackend(GPIOBackend):
+    """Logs pin changes instead of driving hardware. Pours still take real time."""
+    name = 'logging'
+
+    def setup(self, pins):
+        logger.debug('setup() called — Not actually initializing GPIO pins.')
+
+    def output(self, pins, values):
+        pins, values = as_batch(pins, values)
+        logger.debug(f'output(pins={pins}, values={values}) called — No actual motor movement.')
+
+    def cleanup(self):
+        logger.debug('cleanup() called — no GPIO cleanup in debug mode.')
+
+
+class SimulatedBackend(GPIOBackend):
+    """
+    Records every pin transition against a VirtualClock, so pours complete
+    instantly while keeping their simulated timing. Pins changed in one
+    batch share a timestamp.
+    """
+    name = 'simulated'
+
+    def __init__(self, clock=None):
+        super().__init__(clock or VirtualClock())
+        self.pins = {}
+        self.transitions = []
+        self._lock = threading.Lock()
+
+    def setup(self, pins):
+        with self._lock:
+            for pin in pins:
+                self.pins.setdefault(pin, self.LOW)
+
+    def output(self, pins, values):
+        pins, values = as_batch(pins, values)
+        with self._lock:
+            now = self.clock.monotonic()
+            for pin, value in zip(pins, values):
+                if self.pins.get(pin) != value:
+                    self.transitions.append((now, pin, value))
+                self.pins[pin] = value
+
+    def cleanup(self):
+        with self._lock:
+            self.pins = {}
+
+
+BACKENDS = {
+    RPiGPIOBackend.name: RPiGPIOBackend,
+    LoggingBackend.name: LoggingBackend,
+    SimulatedBackend.name: SimulatedBackend,
+}
+
+
+def create_backend(name='auto', debug=False):
+    """
+    Create a GPIO backend by name. 'auto' uses RPi.GPIO unless `debug` is set
+    or RPi.GPIO isn't installed, in which case it falls back to logging.
+    """
+    if name == 'auto':
+        if debug:
+            return LoggingBackend()
+        try:
+            return RPiGPIOBackend()
+        except ModuleNotFoundError:
+            logger.info('Controller modules not found. Pump control will be disabled')
+            return LoggingBackend()
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f'Unknown GPIO backend "{name}". Choose from: auto, {", ".join(BACKENDS)}')
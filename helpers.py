@@ -1,9 +1,17 @@
 import base64
 import os
+import copy
 import json
+import bisect
+import threading
+from collections import namedtuple
+from collections.abc import Sequence
 import streamlit as st
 import settings
 import assist
+from ingredients import file_signature, get_ingredient_index
+from storage import cocktail_id as get_cocktail_id, get_storage
+from journal import CocktailJournal, apply_changes, write_json
 from rembg import remove
 from PIL import Image
 
@@ -12,6 +20,9 @@ logger = logging.getLogger(__name__)
 
 
 def load_saved_config():
+    storage = get_storage()
+    if storage is not None:
+        return storage.load_pump_config()
     if os.path.exists(settings.CONFIG_FILE):
         try:
             with open(settings.CONFIG_FILE, 'r') as f:
@@ -24,33 +35,432 @@ def load_saved_config():
 
 def save_config(data):
     try:
-        with open(settings.CONFIG_FILE, 'w') as f:
-            json.dump(data, f, indent=2)
+        storage = get_storage()
+        if storage is not None:
+            storage.save_pump_config(data)
+        else:
+            write_json(settings.CONFIG_FILE, data)
     except Exception as e:
         logger.exception('Error saving pump configuration')
 
 
-def load_cocktails():
-    if os.path.exists(settings.COCKTAILS_FILE):
+class CocktailMenu(Sequence):
+    """
+    The cocktails that have images, favorites first and each group in file
+    order, read straight from a CocktailRepository. Favoriting a cocktail
+    reorders it in place, so there's nothing to rebuild.
+
+    With `pourable_only`, cocktails that use an ingredient that isn't on a
+    pump are left out too. The pump config is checked by `refresh()`.
+    """
+
+    def __init__(self, repository, pourable_only=False):
+        self.repository = repository
+        self.pourable_only = pourable_only
+        self._ingredient_index = get_ingredient_index() if pourable_only else None
+        # The pourable favorites and others, and the repository revision and ingredient index they were filtered at
+        self._filtered = None
+        self._filtered_key = None
+
+    def refresh(self):
+        """Pick up changes to the cocktails and the pump config."""
+        self.repository.refresh()
+        if self.pourable_only:
+            self._ingredient_index = get_ingredient_index()
+
+    def _menu_positions(self):
+        """The favorites and the rest as file positions. Call with the repository's lock held."""
+        repository = self.repository
+        if not self.pourable_only:
+            return repository._favorites, repository._others
+        key = (repository.revision, self._ingredient_index)
+        if self._filtered_key != key:
+            ingredient_index = self._ingredient_index
+            self._filtered = tuple(
+                [position for position in positions if not ingredient_index.missing(repository._records[position].get('ingredients', {}))]
+                for positions in (repository._favorites, repository._others)
+            )
+            self._filtered_key = key
+        return self._filtered
+
+    def __len__(self):
+        with self.repository._lock:
+            favorites, others = self._menu_positions()
+            return len(favorites) + len(others)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        repository = self.repository
+        with repository._lock:
+            favorites, others = self._menu_positions()
+            if index < 0:
+                index += len(favorites) + len(others)
+            if 0 <= index < len(favorites):
+                position = favorites[index]
+            elif 0 <= index - len(favorites) < len(others):
+                position = others[index - len(favorites)]
+            else:
+                raise IndexError('cocktail menu index out of range')
+            return repository._records[position]
+
+    def menu_index(self, cocktail_id):
+        """Where a cocktail is on this menu, or None if it isn't on it."""
+        repository = self.repository
+        with repository._lock:
+            position = repository._positions.get(cocktail_id)
+            if position is None:
+                return None
+            favorites, others = self._menu_positions()
+            for offset, positions in ((0, favorites), (len(favorites), others)):
+                index = bisect.bisect_left(positions, position)
+                if index < len(positions) and positions[index] == position:
+                    return offset + index
+            return None
+
+
+class CocktailRepository:
+    """
+    Keeps the cocktails file parsed in memory, along with the names of the
+    images in the logo folder.
+
+    Every lookup only stats the cocktails file, its journal and the logo
+    folder: when only the journal grew, just the new changes are read and
+    applied, and the file is parsed again only when it was replaced. The
+    folder is listed again when a file is added to or removed from it.
+    `revision` goes up whenever any of them changes, so callers can tell
+    when what they built from the cocktails is out of date.
+
+    Cocktails are addressed by `get_cocktail_id()`. The menu order is kept
+    as two sorted lists of file positions, favorites and the rest, so
+    `set_favorite()` moves one cocktail with a binary search instead of
+    sorting the whole list. Single cocktail edits are appended to the
+    CocktailJournal, and folded into the file in the background once the
+    journal is over JOURNAL_COMPACT_BYTES.
+    """
+
+    def __init__(self, cocktails_file=None, logo_folder=None):
+        self.cocktails_file = cocktails_file or settings.COCKTAILS_FILE
+        self.logo_folder = logo_folder or settings.LOGO_FOLDER
+        self.journal = CocktailJournal(self.cocktails_file)
+        self.revision = 0
+        self._data = {}
+        self._signature = None
+        self._journal_offset = 0
+        self._compactor = None
+        self._images = frozenset()
+        self._images_signature = None
+        self._loaded = False
+        self._lock = threading.RLock()
+        # The cocktail records in file order, and the menu as file positions
+        self._records = []
+        self._positions = {}
+        self._favorites = []
+        self._others = []
+        self._indexed_revision = None
+
+    def _reindex(self):
+        self._records = self._data.get('cocktails', [])
+        self._positions = {}
+        self._favorites = []
+        self._others = []
+        for position, cocktail in enumerate(self._records):
+            cocktail_id = get_cocktail_id(cocktail)
+            self._positions.setdefault(cocktail_id, position)
+            if f'{cocktail_id}.png' in self._images:
+                (self._favorites if cocktail.get('favorite', False) else self._others).append(position)
+
+    def watched_paths(self):
+        """The files and folders the cocktails are read from, to watch for changes."""
+        return [self.cocktails_file, self.journal.journal_file, self.logo_folder]
+
+    def _data_signature(self):
+        return self.journal.signature()
+
+    def _read(self):
+        """The cocktails and the signature they were read at."""
+        # When the cocktails file is the same and the journal only grew, apply just the new changes
+        if self._loaded and self._signature is not None and self.journal.signature()[0] == self._signature[0]:
+            changes, offset, signature = self.journal.read_since(self._journal_offset)
+            if signature[0] == self._signature[0] and offset >= self._journal_offset:
+                apply_changes(self._data, changes)
+                self._journal_offset = offset
+                return self._data, signature
+        data, self._journal_offset, signature = self.journal.load()
+        return data, signature
+
+    def _refresh(self):
+        signature = self._data_signature()
+        if not self._loaded or signature != self._signature:
+            try:
+                self._data, self._signature = self._read()
+            except Exception:
+                # Keep what we had, and try again on the next lookup
+                logger.exception('Error loading cocktails')
+                return
+            self.revision += 1
+
+        images_signature = file_signature(self.logo_folder)
+        if not self._loaded or images_signature != self._images_signature:
+            try:
+                self._images = frozenset(os.listdir(self.logo_folder))
+            except OSError:
+                self._images = frozenset()
+            self._images_signature = images_signature
+            self.revision += 1
+        if self.revision != self._indexed_revision:
+            self._reindex()
+            self._indexed_revision = self.revision
+        self._loaded = True
+
+    def refresh(self):
+        """Pick up changes to the cocktails file or logo folder. Returns the current `revision`."""
+        with self._lock:
+            self._refresh()
+            return self.revision
+
+    def load(self):
+        """A copy of the whole cocktails file, safe to change and save."""
+        with self._lock:
+            self._refresh()
+            return copy.deepcopy(self._data)
+
+    def cocktails(self):
+        """The cocktails in the file. These are the cached records, so don't change them."""
+        with self._lock:
+            self._refresh()
+            return list(self._data.get('cocktails', []))
+
+    def menu(self, pourable_only=False):
+        """
+        A CocktailMenu of this repository. It reads what's in memory without
+        checking the disk, so call its `refresh()` to pick up changes from
+        other processes.
+        """
+        with self._lock:
+            self._refresh()
+        return CocktailMenu(self, pourable_only)
+
+    def get(self, cocktail_id):
+        """The cocktail with an ID, or None."""
+        with self._lock:
+            self._refresh()
+            position = self._positions.get(cocktail_id)
+            return None if position is None else self._records[position]
+
+    def menu_index(self, cocktail_id):
+        """Where a cocktail is on the menu, or None if it isn't on it."""
+        with self._lock:
+            self._refresh()
+            return CocktailMenu(self).menu_index(cocktail_id)
+
+    def valid_cocktails(self, pourable_only=False):
+        """The cocktails that have images, in menu order. See `get_valid_cocktails()`."""
+        with self._lock:
+            self._refresh()
+            return list(CocktailMenu(self, pourable_only))
+
+    def set_favorite(self, cocktail_id, favorite=True):
+        """
+        Mark a cocktail as a favorite or not, and save only that cocktail.
+        Returns its new index on the menu, or None if it isn't on the menu.
+        """
+        with self._lock:
+            self._refresh()
+            position = self._positions.get(cocktail_id)
+            if position is None:
+                return None
+            record = self._records[position]
+            if record.get('favorite') != favorite:
+                # Replace the record rather than change it, since callers may hold on to the old one
+                record = self._records[position] = {**record, 'favorite': favorite}
+                source, target = (self._others, self._favorites) if favorite else (self._favorites, self._others)
+                index = bisect.bisect_left(source, position)
+                if index < len(source) and source[index] == position:
+                    del source[index]
+                    bisect.insort(target, position)
+                self._write_record(position, record)
+                self.revision += 1
+                self._indexed_revision = self.revision
+            return self.menu_index(cocktail_id)
+
+    def save_cocktail(self, cocktail):
+        """Add a cocktail, or replace the one with the same ID, saving only that cocktail."""
+        self._change([{'op': 'upsert', 'cocktail': copy.deepcopy(cocktail)}])
+
+    def append_cocktails(self, cocktails):
+        """
+        Add cocktails, replacing any with the same IDs, then move favorites
+        first. Only the new cocktails are saved.
+        """
+        self._change([{'op': 'append', 'cocktails': copy.deepcopy(cocktails)}])
+
+    def _change(self, changes):
+        with self._lock:
+            self._refresh()
+            apply_changes(self._data, changes)
+            self.revision += 1
+            self._reindex()
+            self._indexed_revision = self.revision
+            self._write_changes(changes)
+
+    def _write_record(self, position, record):
+        self._write_changes([{'op': 'upsert', 'cocktail': record}])
+
+    def _write_changes(self, changes):
+        """Journal changes that are already applied in memory."""
+        start, end, signature = self.journal.append(changes)
+        # If nothing else changed the files since we read them, we're still up to date
+        if self._signature is not None and start == self._journal_offset and signature[0] == self._signature[0]:
+            self._journal_offset = end
+            self._signature = signature
+        if settings.JOURNAL_COMPACT_BYTES and end > settings.JOURNAL_COMPACT_BYTES:
+            self._compact_in_background()
+
+    def _compact_in_background(self):
+        if self._compactor is None or not self._compactor.is_alive():
+            self._compactor = threading.Thread(target=self.compact, name='cocktail-journal-compactor', daemon=True)
+            self._compactor.start()
+
+    def compact(self):
+        """Fold the journal into the cocktails file with an atomic write-and-rename."""
         try:
-            with open(settings.COCKTAILS_FILE, 'r') as f:
-                return json.load(f)
+            # Not under self._lock, so lookups carry on while the file is written
+            signatures = self.journal.compact()
         except Exception:
-            logger.exception('Error loading cocktails')
-    return {}
+            logger.exception('Error compacting the cocktail journal')
+            return
+        if signatures is not None:
+            before, after = signatures
+            with self._lock:
+                # What's in memory is exactly what was compacted, so there's nothing to read again
+                if self._signature == before:
+                    self._signature = after
+                    self._journal_offset = 0
+
+    def _write(self, data):
+        self._signature = self.journal.write(data)
+        self._journal_offset = 0
+
+    def save(self, data):
+        """Write `data` as the whole cocktails file and keep it as the in-memory copy, without parsing it again."""
+        data = copy.deepcopy(data)
+        with self._lock:
+            self._write(data)
+            self._data = data
+            self.revision += 1
+            self._reindex()
+            self._indexed_revision = self.revision
+
+
+class SQLiteCocktailRepository(CocktailRepository):
+    """
+    A CocktailRepository kept in a SQLiteStorage instead of the cocktails
+    file. It's read again when the database's revision changes, and a
+    favorite toggle or recipe edit writes just that cocktail.
+    """
+
+    def __init__(self, storage, logo_folder=None):
+        super().__init__(storage.database_file, logo_folder)
+        self.storage = storage
+
+    def watched_paths(self):
+        # Writes from other processes land in the write-ahead log first
+        return [self.storage.database_file, f'{self.storage.database_file}-wal', self.logo_folder]
+
+    def _data_signature(self):
+        return self.storage.revision()
+
+    def _read(self):
+        revision = self.storage.revision()
+        return self.storage.load_cocktails(), revision
+
+    def _written(self, revisions):
+        previous, revision = revisions
+        # If another process wrote in between, keep the old signature so its change is read
+        if previous == self._signature:
+            self._signature = revision
+
+    def _write_record(self, position, record):
+        self._written(self.storage.set_favorite(get_cocktail_id(record), record.get('favorite', False)))
+
+    def _write_changes(self, changes):
+        if all(change['op'] == 'upsert' for change in changes):
+            for change in changes:
+                cocktail = change['cocktail']
+                self._written(self.storage.save_cocktail(cocktail, self._positions[get_cocktail_id(cocktail)]))
+        else:
+            # Appending moves favorites first, so every position may have changed
+            self._written(self.storage.save_cocktails(self._data))
+
+    def compact(self):
+        """Nothing to fold: the database is written in place."""
+
+    def _write(self, data):
+        self._written(self.storage.save_cocktails(data))
+
+
+_repositories = {}
+_repositories_lock = threading.Lock()
+
+
+def get_cocktail_repository():
+    """Get the CocktailRepository for the current storage backend and LOGO_FOLDER."""
+    storage = get_storage()
+    key = (settings.COCKTAILS_FILE if storage is None else storage.database_file, settings.LOGO_FOLDER)
+    with _repositories_lock:
+        if key not in _repositories:
+            if storage is None:
+                _repositories[key] = CocktailRepository(*key)
+            else:
+                _repositories[key] = SQLiteCocktailRepository(storage, settings.LOGO_FOLDER)
+        return _repositories[key]
+
+
+# How a cocktail changed between two lists, see diff_cocktails()
+CocktailChange = namedtuple('CocktailChange', ['kind', 'cocktail_id', 'cocktail'])
+
+
+def diff_cocktails(old, new):
+    """
+    What changed from one list of cocktails to another, by ID, as a list of
+    CocktailChanges. `kind` is 'added', 'removed', 'changed' (anything but
+    the favorite flag), 'favorited' or 'unfavorited'. A cocktail can be
+    both changed and (un)favorited. Moving on the menu isn't a change.
+    """
+    old_cocktails = {get_cocktail_id(cocktail): cocktail for cocktail in old}
+    new_cocktails = {get_cocktail_id(cocktail): cocktail for cocktail in new}
+    changes = []
+    for cocktail_id, cocktail in new_cocktails.items():
+        before = old_cocktails.get(cocktail_id)
+        if before is None:
+            changes.append(CocktailChange('added', cocktail_id, cocktail))
+        elif before is not cocktail and before != cocktail:
+            favorite = cocktail.get('favorite', False)
+            if {**before, 'favorite': favorite} != {**cocktail, 'favorite': favorite}:
+                changes.append(CocktailChange('changed', cocktail_id, cocktail))
+            if before.get('favorite', False) != favorite:
+                changes.append(CocktailChange('favorited' if favorite else 'unfavorited', cocktail_id, cocktail))
+    for cocktail_id, cocktail in old_cocktails.items():
+        if cocktail_id not in new_cocktails:
+            changes.append(CocktailChange('removed', cocktail_id, cocktail))
+    return changes
+
+
+def load_cocktails():
+    return get_cocktail_repository().load()
 
 
 def save_cocktails(data, append=True):
     """Save the given list of cocktails to the cocktails file."""
     try:
-        cocktails = load_cocktails()
-        with open(settings.COCKTAILS_FILE, 'w') as f:
-            if append:
-                cocktails['cocktails'] += data['cocktails']
-            else:
-                cocktails = data
-            cocktails['cocktails'] = sorted(cocktails['cocktails'], key=lambda cocktail: not cocktail.get('favorite', False))
-            json.dump(cocktails, f, indent=2)
+        if append:
+            # Only the new cocktails are written, see CocktailRepository.append_cocktails()
+            get_cocktail_repository().append_cocktails(data['cocktails'])
+        else:
+            cocktails = dict(data)
+            cocktails['cocktails'] = sorted(data['cocktails'], key=lambda cocktail: not cocktail.get('favorite', False))
+            get_cocktail_repository().save(cocktails)
     except Exception as e:
         st.error(f'Error saving cocktails: {e}')
 
@@ -68,32 +478,23 @@ def get_cocktail_image_path(cocktail):
     return path
 
 
-def get_valid_cocktails():
-    """Get the list of cocktails that have images associated with them."""
-    cocktail_data = load_cocktails().get('cocktails', [])
-    cocktails = []
-    for cocktail in cocktail_data:
-        if os.path.exists(get_cocktail_image_path(cocktail)):
-            cocktails.append(cocktail)
-    return cocktails
+def get_valid_cocktails(pourable_only=False):
+    """Get the list of cocktails that have images associated with them.
+    With `pourable_only`, cocktails that use an ingredient that isn't on a pump are left out too.
+    Favorites come first. The cocktails are shared with the cache, so copy one before changing it."""
+    return get_cocktail_repository().valid_cocktails(pourable_only)
 
 
 def favorite_cocktail(cocktail_index):
     """Mark a cocktail as a favorite. Returns the new index of the cocktail"""
-    cocktails = get_valid_cocktails()
-    cocktail = cocktails[cocktail_index]
-    cocktail['favorite'] = True
-    save_cocktails({'cocktails': cocktails}, append=False)
-    return get_valid_cocktails().index(cocktail)
+    repository = get_cocktail_repository()
+    return repository.set_favorite(get_cocktail_id(repository.menu()[cocktail_index]), True)
 
 
 def unfavorite_cocktail(cocktail_index):
     """Unmark a cocktail as a favorite. Returns the new index of the cocktail"""
-    cocktails = get_valid_cocktails()
-    cocktail = cocktails[cocktail_index]
-    cocktail['favorite'] = False
-    save_cocktails({'cocktails': cocktails}, append=False)
-    return get_valid_cocktails().index(cocktail)
+    repository = get_cocktail_repository()
+    return repository.set_favorite(get_cocktail_id(repository.menu()[cocktail_index]), False)
 
 
 def save_base64_image(base64_string, output_path):
@@ -0,0 +1,136 @@
+# ingredients.py
+import os
+import re
+import json
+import threading
+
+import settings
+from storage import get_storage
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Different names for the same liquid, keyed by normalized name.
+# Recipes and pump labels are both resolved through this table before matching.
+INGREDIENT_ALIASES = {
+    'whiskey': 'whisky',
+    'bourbon whiskey': 'bourbon',
+    'cola': 'coke',
+    'coca cola': 'coke',
+    'fresh lime juice': 'lime juice',
+    'freshly squeezed lime juice': 'lime juice',
+    'fresh lemon juice': 'lemon juice',
+    'freshly squeezed lemon juice': 'lemon juice',
+    'fresh orange juice': 'orange juice',
+    'oj': 'orange juice',
+    'sugar syrup': 'simple syrup',
+    'syrup': 'simple syrup',
+    'angostura bitters': 'bitters',
+    'aromatic bitters': 'bitters',
+    'cointreau': 'triple sec',
+    'orange liqueur': 'triple sec',
+    'tonic': 'tonic water',
+    'soda': 'soda water',
+    'club soda': 'soda water',
+    'white rum': 'rum',
+    'light rum': 'rum',
+    'silver tequila': 'tequila',
+    'blanco tequila': 'tequila',
+}
+
+
+def normalize_ingredient(name):
+    """Lower-case an ingredient name, collapse punctuation and whitespace, then resolve aliases."""
+    name = re.sub(r'[^a-z0-9]+', ' ', name.lower()).strip()
+    return INGREDIENT_ALIASES.get(name, name)
+
+
+def parse_pump_label(pump_label):
+    """Convert a pump label such as 'Pump 1' to a zero based pump index. Raises ValueError if it can't be parsed."""
+    return int(pump_label.replace('Pump', '').strip()) - 1
+
+
+def file_signature(path):
+    """Cheap change detection for a file: its modification time and size, or None if it's missing."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class IngredientIndex:
+    """Maps normalized ingredient names to the pump that dispenses them."""
+
+    def __init__(self, pump_config):
+        self.pump_config = dict(pump_config)
+        self._pumps = {}
+        for pump_label, ingredient_name in self.pump_config.items():
+            key = normalize_ingredient(ingredient_name)
+            if not key:
+                continue
+            try:
+                pump_index = parse_pump_label(pump_label)
+            except ValueError:
+                logger.critical(f'Could not parse pump label "{pump_label}". Skipping.')
+                continue
+            if key in self._pumps:
+                logger.warning(f'"{ingredient_name}" is on more than one pump. Using {self._pumps[key][0]}.')
+                continue
+            self._pumps[key] = (pump_label, pump_index)
+
+    def __len__(self):
+        return len(self._pumps)
+
+    def __contains__(self, ingredient_name):
+        return normalize_ingredient(ingredient_name) in self._pumps
+
+    def pump_label(self, ingredient_name):
+        """Get the label of the pump for an ingredient, or None if no pump has it."""
+        return self._pumps.get(normalize_ingredient(ingredient_name), (None, None))[0]
+
+    def pump_index(self, ingredient_name):
+        """Get the zero based index of the pump for an ingredient, or None if no pump has it."""
+        return self._pumps.get(normalize_ingredient(ingredient_name), (None, None))[1]
+
+    def missing(self, ingredients):
+        """List the ingredients that aren't on any pump."""
+        return [ingredient_name for ingredient_name in ingredients if ingredient_name not in self]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_ingredient_index(config_file=None):
+    """
+    Get the IngredientIndex for a pump config file, rebuilding it only when
+    the file changes. Without a file, the pump config comes from the
+    storage backend.
+    """
+    storage = get_storage() if config_file is None else None
+    if storage is not None:
+        config_file = storage.database_file
+        signature = storage.revision()
+    else:
+        if config_file is None:
+            config_file = settings.CONFIG_FILE
+        signature = file_signature(config_file)
+    with _indexes_lock:
+        cached = _indexes.get(config_file)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        pump_config = {}
+        if storage is not None:
+            pump_config = storage.load_pump_config()
+        elif signature is not None:
+            try:
+                with open(config_file, 'r') as f:
+                    pump_config = json.load(f)
+            except Exception:
+                logger.exception(f'Error reading {config_file}')
+        index = IngredientIndex(pump_config)
+        _indexes[config_file] = (signature, index)
+        return index
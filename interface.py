@@ -1,9 +1,15 @@
 # interface.py
+import math
 import pygame
 
 from settings import *
-from helpers import get_cocktail_image_path, get_valid_cocktails, wrap_text, favorite_cocktail, unfavorite_cocktail
-from controller import make_drink
+from helpers import get_cocktail_image_path, get_cocktail_repository, wrap_text, diff_cocktails
+from storage import cocktail_id
+from file_watch import FileWatcher, DEFAULT_POLL_INTERVAL
+import controller
+from controller import Pour
+from order_queue import get_order_queue
+from pump_daemon import connect
 
 import logging
 logger = logging.getLogger(__name__)
@@ -22,6 +28,9 @@ normal_text_size = 72
 small_text_size = int(normal_text_size * 0.6)
 text_position = (screen_width // 2, int(screen_height * 0.85))
 
+# Posted from the FileWatcher thread with the `paths` that changed
+FILES_CHANGED = pygame.USEREVENT + 1
+
 def add_layer(*args, function=screen.blit, key=None):
     if key == None:
         key = len(layers)
@@ -148,9 +157,22 @@ def show_pouring_and_loading(watcher):
     if pouring_img:
         add_layer(pouring_img, (0, -150), key='pouring')
 
+    # Tapping anywhere (or pressing Escape) while pouring stops every pump
+    font = pygame.font.SysFont(None, small_text_size)
+    stop_hint = font.render('Tap anywhere to stop', True, (255, 255, 255))
+    add_layer(stop_hint, stop_hint.get_rect(center=(screen_width // 2, text_position[1] + small_text_size)), key='pour_stop_hint')
+
     pour_layers = []
     pouring_line = 0
+    shown_eta = None
     while not watcher.done():
+        # Only taps and keys, so cocktail file changes wait for the menu
+        for event in pygame.event.get(eventtype=[pygame.MOUSEBUTTONDOWN, pygame.KEYDOWN]):
+            if event.type == pygame.MOUSEBUTTONDOWN or event.key == pygame.K_ESCAPE:
+                logger.warning('Stop requested from the interface')
+                watcher.queue.emergency_stop()
+                watcher.cancel()
+
         angle = (angle - 5) % 360
         if loading_img:
             rotated_loading = pygame.transform.rotate(loading_img, angle)
@@ -185,32 +207,55 @@ def show_pouring_and_loading(watcher):
             if pour.running and loading_img:
                 rect = rotated_loading.get_rect(center=status_position)
                 add_layer(rotated_loading, rect, key=logo_layer_key)
+            elif pour.state == Pour.DONE and checkmark_img:
+                rect = checkmark_img.get_rect(center=status_position)
+                add_layer(checkmark_img, rect, key=logo_layer_key)
             else:
-                if checkmark_img:
-                    rect = checkmark_img.get_rect(center=status_position)
-                    add_layer(checkmark_img, rect, key=logo_layer_key)
-                else:
-                    remove_layer(logo_layer_key)
+                # Pending pours are still waiting for a pump slot, and aborted ones never finished
+                remove_layer(logo_layer_key)
                     
 
+        remaining = watcher.remaining()
+        if remaining is not None:
+            eta_text = f'Ready in {math.ceil(remaining)} s'
+            if eta_text != shown_eta:
+                font = pygame.font.SysFont(None, small_text_size)
+                text_surface = font.render(eta_text, True, (255, 255, 255))
+                add_layer(text_surface, text_surface.get_rect(center=text_position), key='pour_eta')
+                shown_eta = eta_text
+
         draw_frame()
+        # Sleep until a pour changes state or it's time for the next spinner frame
+        watcher.wait_for_change(timeout=1 / 60)
 
     for layer in pour_layers:
         remove_layer(layer)
 
+    remove_layer('pour_eta')
+    remove_layer('pour_stop_hint')
     remove_layer('pouring')
     remove_layer('pouring_background')
     draw_frame()
-    pygame.event.clear()  # Drop all events that happened while pouring
+    # Drop all events that happened while pouring, except cocktail file changes
+    files_changed = pygame.event.get(eventtype=FILES_CHANGED)
+    pygame.event.clear()
+    for event in files_changed:
+        pygame.event.post(event)
 
 def run_interface():
 
+    # Scaled images by path, for the cocktails on and beside the screen
+    cocktail_images = {}
+
     def load_cocktail_image(cocktail):
         """Given a Cocktail object, load the image for that cocktail and scale it to the screen size"""
         path = get_cocktail_image_path(cocktail)
+        if path in cocktail_images:
+            return cocktail_images[path]
         try:
             img = pygame.image.load(path)
             img = pygame.transform.scale(img, (screen_width * COCKTAIL_IMAGE_SCALE, screen_height * COCKTAIL_IMAGE_SCALE))
+            cocktail_images[path] = img
             return img
         except Exception as e:
             logger.exception(f'Error loading {path}')
@@ -224,6 +269,9 @@ def run_interface():
         previous_image = load_cocktail_image(previous_cocktail)
         next_cocktail = cocktails[(index + 1) % len(cocktails)]
         next_image = load_cocktail_image(next_cocktail)
+        shown_paths = {get_cocktail_image_path(cocktail) for cocktail in (previous_cocktail, current_cocktail, next_cocktail)}
+        for path in set(cocktail_images) - shown_paths:
+            del cocktail_images[path]
         return current_cocktail, current_image, current_cocktail_name, previous_image, next_image
 
     # Load the static background image (tipsy.png)
@@ -235,14 +283,32 @@ def run_interface():
         logger.exception('Error loading background image (tipsy.png)')
         add_layer((0, 0), function=screen.fill, key='background')
     
-    cocktails = get_valid_cocktails()
+    cocktail_repository = get_cocktail_repository()
+    # The menu reads through to the repository, so favoriting reorders it without a reload.
+    # Only cocktails with every ingredient on a pump are shown.
+    cocktails = cocktail_repository.menu(pourable_only=True)
+    # The cocktails on screen, to tell what changed when the files do
+    shown_cocktails = list(cocktails)
     if not cocktails:
-        logger.critical('No valid cocktails found in cocktails.json')
+        logger.critical('No pourable cocktails found in cocktails.json for the pump config')
         pygame.quit()
         return
+    # Reload when the web app saves cocktails, the pump config or an image, instead of polling for it
+    file_watcher = FileWatcher(
+        cocktail_repository.watched_paths() + [CONFIG_FILE],
+        lambda paths: pygame.event.post(pygame.event.Event(FILES_CHANGED, paths=paths)),
+        debounce=FILE_WATCH_DEBOUNCE,
+        poll_interval=RELOAD_COCKTAILS_TIMEOUT / 1000 if RELOAD_COCKTAILS_TIMEOUT else DEFAULT_POLL_INTERVAL,
+    ).start()
+    # Drinks go to the pump daemon when it's running, or else through the order queue shared with the web app
+    pump_client = connect()
+    order_queue = pump_client or get_order_queue()
+    pump_control = pump_client or controller
     current_index = 0
     current_cocktail, current_image, current_cocktail_name, previous_image, next_image = load_cocktail(current_index)
-    reload_time = pygame.time.get_ticks()
+    # When the current cocktail was swiped to, and the name of the one whose lines were pre-primed
+    shown_time = pygame.time.get_ticks()
+    preprimed_name = None
 
     margin = 50  # adjust as needed for spacing
     # Load single & double buttons and scale them to 75% of original (base size: 150x150)
@@ -303,6 +369,31 @@ def run_interface():
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
+            if event.type == FILES_CHANGED:
+                if CONFIG_FILE in event.paths and preprimed_name:
+                    # The pre-primed lines may not be this cocktail's pumps any more
+                    pump_control.release_primed_lines()
+                    preprimed_name = None
+                reload_needed = False
+                for path in event.paths & set(cocktail_images):
+                    logger.debug(f'Reloading {path}')
+                    del cocktail_images[path]
+                    reload_needed = True
+                # A pump config change can add or remove pourable cocktails too
+                cocktails.refresh()
+                changes = diff_cocktails(shown_cocktails, cocktails)
+                for change in changes:
+                    logger.debug(f'Cocktail {change.kind}: {change.cocktail_id}')
+                if changes and cocktails:
+                    shown_cocktails = list(cocktails)
+                    # Stay on the same cocktail, wherever it moved to
+                    index = cocktails.menu_index(cocktail_id(current_cocktail))
+                    current_index = min(current_index, len(cocktails) - 1) if index is None else index
+                    reload_needed = True
+                elif not cocktails:
+                    logger.warning('No pourable cocktails left, keeping the ones on screen')
+                if reload_needed and cocktails:
+                    current_cocktail, current_image, current_cocktail_name, previous_image, next_image = load_cocktail(current_index)
             if event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_q:
                     running = False
@@ -321,34 +412,35 @@ def run_interface():
                         if single_logo:
                             animate_logo_click(single_logo, single_rect, base_size=150, target_size=220, layer_key='single_logo', duration=150)
 
-                        executor_watcher = make_drink(current_cocktail, 'single')
+                        order = order_queue.enqueue(current_cocktail, 'single', source='touchscreen')
 
-                        show_pouring_and_loading(watcher=executor_watcher)
+                        show_pouring_and_loading(watcher=order_queue.watch(order.id))
 
                     elif double_rect.collidepoint(pos):
                         # Animate double logo click
                         if double_logo:
                             animate_logo_click(double_logo, double_rect, base_size=150, target_size=220, layer_key='double_logo', duration=150)
 
-                        executor_watcher = make_drink(current_cocktail, 'double')
+                        order = order_queue.enqueue(current_cocktail, 'double', source='touchscreen')
 
-                        show_pouring_and_loading(executor_watcher)
+                        show_pouring_and_loading(order_queue.watch(order.id))
                     
                     elif reload_cocktails_rect and reload_cocktails_rect.collidepoint(pos):
                         logger.debug('Reloading cocktails due to reload button press')
                         animate_logo_rotate(reload_logo, reload_cocktails_rect, layer_key='reload_logo')
-                        cocktails = get_valid_cocktails()
+                        cocktails.refresh()
+                        shown_cocktails = list(cocktails)
+                        cocktail_images.clear()
+                        current_index = min(current_index, len(cocktails) - 1)
                         current_cocktail, current_image, current_cocktail_name, previous_image, next_image = load_cocktail(current_index)
 
                     elif favorite_rect and favorite_rect.collidepoint(pos):
-                        if current_cocktail.get('favorite'):
-                            logger.debug(f'Unfavoriting current cocktail: {current_index}')
-                            current_index = unfavorite_cocktail(current_index)
-                        else:
-                            logger.debug(f'Favoriting current cocktail: {current_index}')
-                            current_index = favorite_cocktail(current_index)
+                        favorite = not current_cocktail.get('favorite')
+                        logger.debug(f'{"Favoriting" if favorite else "Unfavoriting"} current cocktail: {current_index}')
+                        cocktail_repository.set_favorite(cocktail_id(current_cocktail), favorite)
+                        current_index = cocktails.menu_index(cocktail_id(current_cocktail))
                             
-                        cocktails = get_valid_cocktails()
+                        shown_cocktails = list(cocktails)
                         current_cocktail, current_image, current_cocktail_name, previous_image, next_image = load_cocktail(current_index)
                         
                     dragging = False
@@ -380,6 +472,10 @@ def run_interface():
                         clock.tick(60)
                     current_index = new_index
                     current_cocktail, current_image, current_cocktail_name, previous_image, next_image = load_cocktail(current_index)
+                    if preprimed_name:
+                        pump_control.release_primed_lines()
+                        preprimed_name = None
+                    shown_time = pygame.time.get_ticks()
 
                     # Animate both extra logos zooming together.
                     if single_logo and double_logo:
@@ -406,13 +502,14 @@ def run_interface():
                 dragging = False
                 drag_offset = 0
 
-        # Main drawing (when not in special animation)
-        if RELOAD_COCKTAILS_TIMEOUT and pygame.time.get_ticks() - reload_time > RELOAD_COCKTAILS_TIMEOUT:
-            logger.debug('Reloading cocktails due to auto reload timeout')
-            cocktails = get_valid_cocktails()
-            current_cocktail, current_image, current_cocktail_name, previous_image, next_image = load_cocktail(current_index)
-            reload_time = pygame.time.get_ticks()
+        # Pre-prime the lines of a cocktail that has been on screen for a while, so ordering it pours sooner
+        if (SPECULATIVE_PRIME_DWELL and order_queue.is_owner and not dragging and preprimed_name != current_cocktail_name
+                and pygame.time.get_ticks() - shown_time >= SPECULATIVE_PRIME_DWELL * 1000):
+            logger.debug(f'Pre-priming lines for {current_cocktail_name}')
+            pump_control.preprime_cocktail(current_cocktail)
+            preprimed_name = current_cocktail_name
 
+        # Main drawing (when not in special animation)
         if dragging:
             remove_layer('cocktail_name')
             remove_layer('favorite_logo')
@@ -437,6 +534,7 @@ def run_interface():
                     add_layer(unfavorite_logo, favorite_rect, key='favorite_logo')
         draw_frame()
         clock.tick(60)
+    file_watcher.stop()
     pygame.quit()
 
 if __name__ == '__main__':
@@ -0,0 +1,171 @@
+# journal.py
+"""
+An append-only journal of edits to the cocktails file, so saving one
+recipe or favorite doesn't rewrite the whole menu.
+
+Edits are appended to `<cocktails file>.journal`, one JSON change per line:
+
+    {"op": "upsert", "cocktail": {...}}      add a cocktail, or replace the one with its ID
+    {"op": "append", "cocktails": [...]}     upsert several, then move favorites first
+
+Readers apply the journal on top of the cocktails file. `compact()` folds
+the journal back into the file with an atomic write-and-rename. A lock
+file next to them keeps readers, writers and the compactor, in any
+process, from seeing each other's half-done work.
+"""
+import os
+import json
+import fcntl
+from contextlib import contextmanager
+
+from ingredients import file_signature
+from storage import cocktail_id
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def write_json(path, data):
+    """Write JSON to `path` in one step, so other processes never read half of it."""
+    temp_file = f'{path}.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(temp_file, path)
+
+
+def apply_changes(data, changes):
+    """Apply journaled changes to cocktails.json `data` in place. Every change can be applied twice safely."""
+    cocktails = data.setdefault('cocktails', [])
+    positions = {}
+    for position, cocktail in enumerate(cocktails):
+        positions.setdefault(cocktail_id(cocktail), position)
+
+    def upsert(cocktail):
+        position = positions.get(cocktail_id(cocktail))
+        if position is None:
+            positions[cocktail_id(cocktail)] = len(cocktails)
+            cocktails.append(cocktail)
+        else:
+            cocktails[position] = cocktail
+
+    for change in changes:
+        op = change.get('op')
+        if op == 'upsert':
+            upsert(change['cocktail'])
+        elif op == 'append':
+            for cocktail in change['cocktails']:
+                upsert(cocktail)
+            cocktails[:] = sorted(cocktails, key=lambda cocktail: not cocktail.get('favorite', False))
+            positions = {}
+            for position, cocktail in enumerate(cocktails):
+                positions.setdefault(cocktail_id(cocktail), position)
+        else:
+            logger.warning(f'Skipping unknown cocktail change "{op}"')
+    return data
+
+
+class CocktailJournal:
+    """The cocktails file and its journal of edits."""
+
+    def __init__(self, cocktails_file):
+        self.cocktails_file = cocktails_file
+        self.journal_file = f'{cocktails_file}.journal'
+        self.lock_file = f'{cocktails_file}.lock'
+
+    @contextmanager
+    def lock(self, exclusive=False):
+        """Hold the lock shared (to read) or exclusive (to change the files)."""
+        with open(self.lock_file, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def signature(self):
+        """Cheap change detection for both files: their modification times and sizes."""
+        return file_signature(self.cocktails_file), file_signature(self.journal_file)
+
+    def _read_changes(self, offset=0):
+        """
+        The changes from `offset` on, and the offset after the last whole
+        line. A line cut short by a crash is left unread.
+        """
+        try:
+            with open(self.journal_file, 'rb') as f:
+                f.seek(offset)
+                chunk = f.read()
+        except FileNotFoundError:
+            return [], 0
+        end = chunk.rfind(b'\n') + 1
+        changes = []
+        for line in chunk[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                changes.append(json.loads(line))
+            except ValueError:
+                logger.warning(f'Skipping a damaged line in {self.journal_file}')
+        return changes, offset + end
+
+    def _load(self):
+        data = {}
+        if os.path.exists(self.cocktails_file):
+            with open(self.cocktails_file, 'r') as f:
+                data = json.load(f)
+        changes, offset = self._read_changes()
+        return apply_changes(data, changes), offset
+
+    def _replace(self, data):
+        write_json(self.cocktails_file, data)
+        if os.path.exists(self.journal_file):
+            os.truncate(self.journal_file, 0)
+
+    def load(self):
+        """The cocktails with every journaled change applied, the journal offset they're read up to, and the signature."""
+        with self.lock():
+            data, offset = self._load()
+            return data, offset, self.signature()
+
+    def read_since(self, offset):
+        """The changes journaled since `offset`, the offset they're read up to, and the signature."""
+        with self.lock():
+            changes, offset = self._read_changes(offset)
+            return changes, offset, self.signature()
+
+    def append(self, changes):
+        """
+        Journal `changes`. Returns the offsets they were written between,
+        and the signature right after.
+        """
+        lines = ''.join(json.dumps(change) + '\n' for change in changes).encode()
+        with self.lock(exclusive=True):
+            with open(self.journal_file, 'a+b') as f:
+                start = f.seek(0, os.SEEK_END)
+                if start:
+                    f.seek(start - 1)
+                    if f.read(1) != b'\n':
+                        # End a line cut short by a crash, so it doesn't swallow the first change
+                        lines = b'\n' + lines
+                f.write(lines)
+            return start, start + len(lines), self.signature()
+
+    def write(self, data):
+        """Replace the cocktails file with `data` and empty the journal. Returns the signature after."""
+        with self.lock(exclusive=True):
+            self._replace(data)
+            return self.signature()
+
+    def compact(self):
+        """
+        Fold the journal into the cocktails file. Returns the signatures
+        before and after, or None if there was nothing to fold.
+        """
+        with self.lock(exclusive=True):
+            before = self.signature()
+            if before[1] is None or before[1][1] == 0:
+                return None
+            data, _ = self._load()
+            self._replace(data)
+            logger.debug(f'Compacted {before[1][1]} bytes of cocktail changes into {self.cocktails_file}')
+            return before, self.signature()
@@ -1,6 +1,16 @@
 # main.py
+import os
 import subprocess
 import sys
+import time
+
+from settings import PUMP_SOCKET
+
+# Launch the pump daemon first, so it owns the GPIO pins and both frontends talk to it.
+daemon_process = subprocess.Popen([sys.executable, "pump_daemon.py"])
+deadline = time.monotonic() + 10
+while not os.path.exists(PUMP_SOCKET) and daemon_process.poll() is None and time.monotonic() < deadline:
+    time.sleep(0.1)
 
 # Launch the Pygame interface in a separate process.
 interface_process = subprocess.Popen([sys.executable, "interface.py"])
@@ -11,3 +21,5 @@ streamlit_process = subprocess.Popen(["streamlit", "run", "app.py"])
 # Wait for both processes to finish.
 interface_process.wait()
 streamlit_process.wait()
+daemon_process.terminate()
+daemon_process.wait()
@@ -0,0 +1,162 @@
+# metrics.py
+import os
+import re
+import math
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Bucket upper bounds, in seconds
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, math.inf)
+ERROR_BUCKETS = (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, math.inf)
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Counter:
+    """A value per label set that only goes up."""
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple((name, str(labels[name])) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self._values.items())]
+
+
+class Histogram(Counter):
+    """Counts observations into cumulative buckets per label set, with their sum and count."""
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        if self.buckets[-1] != math.inf:
+            self.buckets += (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [bucket_count + (value <= bound) for bucket_count, bound in zip(counts, self.buckets)]
+            self._values[key] = (counts, total + value, count + 1)
+
+    def value(self, **labels):
+        """The (sum, count) of observations for a label set."""
+        with self._lock:
+            _, total, count = self._values.get(self._key(labels), (None, 0.0, 0))
+            return total, count
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append((f'{self.name}_bucket', key + (('le', format_value(bound)),), bucket_count))
+                samples.append((f'{self.name}_sum', key, total))
+                samples.append((f'{self.name}_count', key, count))
+        return samples
+
+
+class MetricsRegistry:
+    """A named set of counters and histograms that renders as Prometheus text."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                # Reloading a module shouldn't reset its metrics
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write `render()` to `path`, replacing the old file in one step so readers never see half a file."""
+        temp_path = f'{path}.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                f.write(self.render())
+            os.replace(temp_path, path)
+        except OSError:
+            logger.exception(f'Error writing metrics to {path}')
+
+
+REGISTRY = MetricsRegistry()
+
+
+SAMPLE_PATTERN = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+LABEL_PATTERN = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="([^"]*)"')
+
+
+def parse_metrics(text):
+    """Parse Prometheus text into a list of (name, {label: value}, value) samples."""
+    samples = []
+    for line in text.splitlines():
+        match = SAMPLE_PATTERN.match(line.strip())
+        if not match:
+            continue
+        name, labels, value = match.groups()
+        samples.append((name, dict(LABEL_PATTERN.findall(labels or '')), float(value.replace('+Inf', 'inf'))))
+    return samples
+
+
+def read_metrics(path):
+    """Read samples written by `MetricsRegistry.write()`. Returns an empty list if there's no file yet."""
+    try:
+        with open(path, 'r') as f:
+            return parse_metrics(f.read())
+    except FileNotFoundError:
+        return []
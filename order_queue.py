@@ -0,0 +1,496 @@
+# order_queue.py
+import os
+import json
+import time
+import fcntl
+import atexit
+import socket
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+import settings
+import controller
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+QUEUED = 'queued'
+POURING = 'pouring'
+DONE = 'done'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+EXPIRED = 'expired'
+ACTIVE = (QUEUED, POURING)
+
+# Finished orders kept in the orders file so their status can still be looked up
+ORDER_HISTORY = 50
+
+
+# An order as seen by every process sharing the orders file.
+#   position: place in line, 0 for the drink pouring now, None once finished
+#   eta: predicted seconds until the drink is ready, or None if unknown
+#   pours: (ingredient_name, amount, state) of each pour once submitted to the pumps
+Order = namedtuple('Order', ['id', 'name', 'size', 'status', 'position', 'eta', 'ordered_at', 'pours', 'source'])
+
+
+def size_label(size):
+    """How to show an order's size: Single, Double or a batch's number of servings."""
+    if isinstance(size, str):
+        return size.title()
+    return f'Batch of {size:g} servings'
+
+
+class OrderPour(namedtuple('OrderPour', ['ingredient_name', 'amount', 'state'])):
+    """A pour of an order, with the parts of the Pour interface the UIs use."""
+
+    def __str__(self):
+        return f'{self.ingredient_name}: {self.amount} oz.'
+
+    @property
+    def running(self):
+        return self.state == controller.Pour.RUNNING
+
+    @property
+    def finished(self):
+        return self.state in (controller.Pour.DONE, controller.Pour.ABORTED)
+
+
+class OrderQueue:
+    """
+    A first in, first out queue of drink orders shared by every process
+    through `orders_file`.
+
+    Any process can enqueue, cancel and look up orders. Only one process at a
+    time owns the pumps: the first whose queue is started takes an exclusive
+    lock next to the orders file and pours every order, in the order they
+    were placed, through `submit(recipe, size)` (`controller.make_drink` if
+    not given). If that process exits, another started queue takes over and
+    pours the orders that were still waiting. A drink that was pouring when
+    its owner went away is marked failed, since how much of it was poured
+    isn't known, and one that waited more than ORDER_EXPIRY seconds with
+    nobody to pour it is marked expired instead of pouring unattended.
+
+    The owner also listens on a Unix socket next to the orders file, so
+    other processes can have it stop the pumps, or look at a new or
+    cancelled order, right away instead of at its next poll.
+    """
+
+    def __init__(self, orders_file=None, submit=None, poll_interval=0.25):
+        self.orders_file = orders_file or settings.ORDERS_FILE
+        self.submit = submit or controller.make_drink
+        self.poll_interval = poll_interval
+        # ExecutorWatchers of the orders this process submitted to the pumps
+        self._watchers = {}
+        self._owner_file = None
+        self._wake_path = f'{self.orders_file}.wake'
+        self._wake_socket = None
+        self._listener = None
+        self._thread = None
+        self._stopping = threading.Event()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    @property
+    def is_owner(self):
+        """Whether this process pours the orders."""
+        return self._owner_file is not None
+
+    def start(self):
+        """Start watching the queue, pouring its orders if no other process does. Does nothing if already running."""
+        with self._lock:
+            if self.running:
+                return
+            self._stopping.clear()
+            # Settle who owns the pumps before returning, so callers can check `is_owner`
+            self._take_ownership()
+            self._thread = threading.Thread(target=self._run, name='order-queue', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop watching the queue and hand the pumps over to another process. Orders still queued are kept."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._stopping.set()
+        self._wake.set()
+        thread.join()
+        self._release_ownership()
+
+    @contextmanager
+    def _locked(self):
+        """Hold the lock on the orders file while reading and changing it."""
+        with open(f'{self.orders_file}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.orders_file, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.exception(f'Error reading {self.orders_file}. Starting a new order queue.')
+        return {'next_id': 1, 'orders': []}
+
+    def _write(self, data):
+        """Replace the orders file in one step, so a crash never leaves half a file."""
+        temp_path = f'{self.orders_file}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(temp_path, self.orders_file)
+
+    def _update(self, change):
+        """Apply `change(data)` to the orders file under its lock and return its result."""
+        with self._locked():
+            data = self._read()
+            before = json.dumps(data, sort_keys=True)
+            result = change(data)
+            if json.dumps(data, sort_keys=True) != before:
+                self._write(data)
+            return result
+
+    def enqueue(self, recipe, size='single', source=None):
+        """
+        Add a drink to the end of the queue and return its Order. `size` is
+        "single", "double" or a number of servings for a batch.
+        """
+        if isinstance(size, str):
+            size = 'double' if size.lower() == 'double' else 'single'
+        else:
+            size = float(size)
+        record = {
+            'name': recipe.get('normal_name', ''),
+            'recipe': recipe,
+            'size': size,
+            'status': QUEUED,
+            'source': source,
+            'ordered_at': time.time(),
+            'started_at': None,
+            'duration': controller.drink_seconds(recipe, size),
+            'pours': [],
+        }
+
+        def add(data):
+            record['id'] = data['next_id']
+            data['next_id'] += 1
+            data['orders'].append(record)
+            return record['id']
+
+        order_id = self._update(add)
+        logger.info(f'Order {order_id}: {size_label(size)} {record["name"]}' + (f' from {source}' if source else ''))
+        self._wake_owner()
+        return self.status(order_id)
+
+    def cancel(self, order_id):
+        """Cancel a queued or pouring order. Returns False if it had already finished."""
+        cancelled = self._cancel(lambda record: record['id'] == order_id)
+        return bool(cancelled)
+
+    def cancel_all(self):
+        """Cancel every queued and pouring order. Returns the ids of the cancelled orders."""
+        return self._cancel(lambda record: True)
+
+    def _cancel(self, matches, message=b'wake'):
+        def cancel(data):
+            cancelled = []
+            for record in data['orders']:
+                if record['status'] in ACTIVE and matches(record):
+                    record['status'] = CANCELLED
+                    cancelled.append(record['id'])
+            return cancelled
+
+        cancelled = self._update(cancel)
+        # Stop a drink this process is pouring right away instead of at the next poll
+        for order_id in cancelled:
+            watcher = self._watchers.get(order_id)
+            if watcher is not None:
+                watcher.cancel()
+        self._wake_owner(message)
+        return cancelled
+
+    def emergency_stop(self):
+        """
+        Stop every pump at once and cancel every order. The process that owns
+        the pumps is told to stop them straight away. Returns the
+        ExecutorWatchers stopped in this process.
+        """
+        if self.is_owner:
+            watchers = controller.emergency_stop()
+            self.cancel_all()
+            return watchers
+        # Cancel first, so the owner can't start the next order once it has stopped the pumps
+        self._cancel(lambda record: True, b'stop')
+        return []
+
+    def _wake_owner(self, message=b'wake'):
+        """Have the owner act on a change to the queue now, or with b'stop', stop the pumps first."""
+        self._wake.set()
+        if self.is_owner:
+            return
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as wake_socket:
+                wake_socket.sendto(message, self._wake_path)
+        except OSError:
+            # Nobody is listening. Whoever takes the pumps next sees the change when it starts.
+            logger.debug(f'No order queue owner is listening on {self._wake_path}')
+
+    def status(self, order_id):
+        """The Order with `order_id`, or None if it isn't known."""
+        return next((order for order in self.orders(active=False) if order.id == order_id), None)
+
+    def orders(self, active=True):
+        """Every Order in the queue, oldest first. With `active`, only the ones queued or pouring."""
+        with self._locked():
+            records = self._read()['orders']
+        now = time.time()
+        orders = []
+        wait = 0.0
+        position = 0
+        for record in records:
+            if record['status'] in ACTIVE:
+                duration = record.get('duration')
+                if duration is None or wait is None:
+                    wait = None
+                elif record.get('started_at') is not None:
+                    wait += max(0.0, record['started_at'] + duration - now)
+                else:
+                    wait += duration
+                orders.append(self._order(record, position, wait))
+                position += 1
+            elif not active:
+                orders.append(self._order(record, None, None))
+        return orders
+
+    def _order(self, record, position, eta):
+        pours = [OrderPour(*pour) for pour in record.get('pours', [])]
+        return Order(record['id'], record['name'], record['size'], record['status'], position, eta, record['ordered_at'], pours, record.get('source'))
+
+    def watch(self, order_id):
+        """An OrderWatcher that follows the order with `order_id`."""
+        return OrderWatcher(self, order_id)
+
+    def local_watcher(self, order_id):
+        """The ExecutorWatcher of an order this process is pouring, or None."""
+        return self._watchers.get(order_id)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            if self.is_owner or self._take_ownership():
+                try:
+                    self._process()
+                except Exception:
+                    logger.exception('Error processing the order queue')
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def _take_ownership(self):
+        owner_file = open(f'{self.orders_file}.owner', 'a')
+        try:
+            fcntl.flock(owner_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            owner_file.close()
+            return False
+        self._owner_file = owner_file
+        self._listen()
+        logger.info(f'Process {os.getpid()} now pours the orders in {self.orders_file}')
+        return True
+
+    def _release_ownership(self):
+        self._stop_listening()
+        owner_file, self._owner_file = self._owner_file, None
+        if owner_file is not None:
+            fcntl.flock(owner_file, fcntl.LOCK_UN)
+            owner_file.close()
+
+    def _listen(self):
+        """Listen for other processes waking the owner, see `_wake_owner()`."""
+        try:
+            if os.path.exists(self._wake_path):
+                # Only the owner listens here, so it was left behind by one that went away
+                os.unlink(self._wake_path)
+            wake_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            wake_socket.bind(self._wake_path)
+        except OSError:
+            logger.warning(f'Could not listen on {self._wake_path}. Other processes will wait for the next poll.', exc_info=True)
+            return
+        self._wake_socket = wake_socket
+        self._listener = threading.Thread(target=self._handle_wakes, args=(wake_socket,), name='order-queue-wake', daemon=True)
+        self._listener.start()
+
+    def _stop_listening(self):
+        wake_socket, self._wake_socket = self._wake_socket, None
+        if wake_socket is None:
+            return
+        # Wakes the listener up with an empty message
+        wake_socket.shutdown(socket.SHUT_RDWR)
+        self._listener.join()
+        wake_socket.close()
+        try:
+            os.unlink(self._wake_path)
+        except FileNotFoundError:
+            pass
+
+    def _handle_wakes(self, wake_socket):
+        while True:
+            message = wake_socket.recv(64)
+            if not message:
+                return
+            if message == b'stop':
+                logger.warning('Emergency stop requested by another process')
+                controller.emergency_stop()
+            self._wake.set()
+
+    def _process(self):
+        """Submit new orders to the pumps in order, and write back the progress of the ones this process is pouring."""
+        cancel = []
+
+        def process(data):
+            for record in data['orders']:
+                watcher = self._watchers.get(record['id'])
+                if record['status'] == CANCELLED:
+                    if watcher is not None and not watcher.cancelled:
+                        cancel.append(watcher)
+                    continue
+                if record['status'] not in ACTIVE:
+                    continue
+                if watcher is None:
+                    if record['status'] == POURING:
+                        logger.warning(f'Order {record["id"]} was pouring when the pumps changed hands. Marking it failed.')
+                        record['status'] = FAILED
+                        continue
+                    if settings.ORDER_EXPIRY and time.time() - record['ordered_at'] > settings.ORDER_EXPIRY:
+                        # Nobody was there to pour it, and whoever ordered it may be long gone
+                        logger.warning(f'Order {record["id"]} waited more than {settings.ORDER_EXPIRY:g} seconds to pour. Marking it expired.')
+                        record['status'] = EXPIRED
+                        continue
+                    try:
+                        watcher = self.submit(record['recipe'], record['size'])
+                    except Exception:
+                        logger.exception(f'Error pouring order {record["id"]}')
+                        watcher = None
+                    if watcher is None:
+                        record['status'] = FAILED
+                        continue
+                    self._watchers[record['id']] = watcher
+                    watcher.add_done_callback(lambda watcher: self._wake.set())
+                    record['duration'] = watcher.eta
+                self._record_progress(record, watcher)
+            finished = [record for record in data['orders'] if record['status'] not in ACTIVE]
+            for record in finished[:-ORDER_HISTORY]:
+                data['orders'].remove(record)
+            for order_id in set(self._watchers) - {record['id'] for record in data['orders'] if record['status'] in ACTIVE}:
+                del self._watchers[order_id]
+
+        self._update(process)
+        for watcher in cancel:
+            watcher.cancel()
+
+    def _record_progress(self, record, watcher):
+        record['pours'] = [[pour.ingredient_name, pour.amount, pour.state] for pour in watcher.pours]
+        if watcher.done():
+            record['status'] = CANCELLED if watcher.cancelled else DONE
+        elif watcher.started_at is not None:
+            record['status'] = POURING
+            if record.get('started_at') is None:
+                record['started_at'] = time.time() - (watcher.clock() - watcher.started_at)
+
+
+class OrderWatcher:
+    """
+    Follows an order through the queue, with the parts of the ExecutorWatcher
+    interface the UIs use. Orders poured by this process are followed live,
+    others by polling the orders file.
+    """
+
+    def __init__(self, queue, order_id):
+        self.queue = queue
+        self.order_id = order_id
+        self.order = queue.status(order_id)
+        self.refreshed_at = time.monotonic()
+
+    @property
+    def _local(self):
+        return self.queue.local_watcher(self.order_id)
+
+    def refresh(self):
+        self.order = self.queue.status(self.order_id) or self.order
+        self.refreshed_at = time.monotonic()
+        return self.order
+
+    @property
+    def pours(self):
+        local = self._local
+        return local.pours if local is not None else self.order.pours
+
+    @property
+    def cancelled(self):
+        return self.order.status == CANCELLED
+
+    def done(self):
+        return self.order is None or self.order.status not in ACTIVE
+
+    def remaining(self):
+        """Predicted seconds until the drink is ready, counting the orders ahead of it, or None if unknown."""
+        if self.done():
+            return 0.0
+        if self.order.eta is None:
+            return None
+        return max(0.0, self.order.eta - (time.monotonic() - self.refreshed_at))
+
+    def cancel(self):
+        return self.queue.cancel(self.order_id)
+
+    def wait_for_change(self, timeout=None):
+        """
+        Block until the order or one of its pours changes, or `timeout`
+        passes. Returns `done()`. The queue is a locked file read or a
+        round trip to the pump daemon, so it's checked at most every
+        `poll_interval`, and orders poured here are followed live between.
+        """
+        due = self.refreshed_at + self.queue.poll_interval
+        local = self._local
+        if local is not None and not local.done():
+            if local.wait_for_change(timeout):
+                # Pick up the order's final status straight away
+                due = 0
+        else:
+            wait = max(0.0, due - time.monotonic())
+            time.sleep(wait if timeout is None else min(timeout, wait))
+        if time.monotonic() >= due:
+            self.refresh()
+        return self.done()
+
+    def wait(self, timeout=None):
+        """Block until the order has finished. Returns `done()`."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.done():
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            self.wait_for_change(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return self.done()
+
+
+_order_queue = None
+_order_queue_lock = threading.Lock()
+
+
+def get_order_queue():
+    """Get this process's OrderQueue on ORDERS_FILE, starting it on first use."""
+    global _order_queue
+    with _order_queue_lock:
+        if _order_queue is None:
+            _order_queue = OrderQueue()
+            atexit.register(_order_queue.stop)
+        _order_queue.start()
+        return _order_queue
@@ -0,0 +1,358 @@
+# pump_daemon.py
+"""
+Run the pump controller as a daemon that owns the GPIO pins, so the
+Streamlit app and the pygame interface never drive the pumps themselves.
+
+    python pump_daemon.py
+
+The frontends talk to it through a Unix socket at PUMP_SOCKET, one JSON
+request per line answered by one JSON response per line:
+
+    {"op": "enqueue", "recipe": {...}, "size": "double"}
+    {"ok": true, "result": {"id": 7, "status": "queued", ...}}
+
+When no daemon is running, `connect()` returns None and the frontends
+fall back to pouring through the order queue themselves.
+"""
+import os
+import json
+import time
+import signal
+import socket
+import itertools
+import threading
+import socketserver
+from collections import namedtuple
+
+import settings
+import controller
+from order_queue import OrderQueue, OrderWatcher, Order, OrderPour
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Maintenance jobs and test pours kept around for their progress to be looked up
+JOB_HISTORY = 20
+
+# What the app reports about drinks cut short by an emergency stop
+StoppedPour = namedtuple('StoppedPour', ['ingredient_name', 'amount', 'poured', 'state'])
+StoppedDrink = namedtuple('StoppedDrink', ['pours'])
+
+
+class PumpDaemonError(RuntimeError):
+    """The daemon couldn't carry out a request."""
+
+
+def order_to_json(order):
+    return None if order is None else order._asdict()
+
+
+def order_from_json(data):
+    if data is None:
+        return None
+    return Order(**{**data, 'pours': [OrderPour(*pour) for pour in data['pours']]})
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Answers every request line on a connection until the client closes it."""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = {'ok': True, 'result': self.server.dispatch(json.loads(line))}
+            except Exception as e:
+                logger.exception('Error handling pump daemon request')
+                response = {'ok': False, 'error': str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode())
+            self.wfile.flush()
+
+
+class PumpDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves the order queue and pump maintenance over a Unix socket.
+
+    Drinks are poured through `order_queue`, which the daemon starts so it
+    owns the pumps. Maintenance jobs and test pours run on the controller's
+    shared scheduler, and their progress can be polled by job id.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path=None, order_queue=None):
+        self.socket_path = socket_path or settings.PUMP_SOCKET
+        self.order_queue = order_queue or OrderQueue()
+        self._jobs = {}
+        self._job_ids = itertools.count(1)
+        self._jobs_lock = threading.Lock()
+        if os.path.exists(self.socket_path):
+            if connect(self.socket_path) is not None:
+                raise PumpDaemonError(f'A pump daemon is already running on {self.socket_path}')
+            # Left behind by a daemon that didn't shut down cleanly
+            os.unlink(self.socket_path)
+        super().__init__(self.socket_path, RequestHandler)
+
+    def serve(self):
+        """Start pouring orders and answer requests until `shutdown()` is called."""
+        self.order_queue.start()
+        if not self.order_queue.is_owner:
+            logger.warning('Another process is driving the pumps. Orders will pour once it exits.')
+        logger.info(f'Pump daemon listening on {self.socket_path}')
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+            self.order_queue.stop()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def dispatch(self, request):
+        op = request.pop('op', None)
+        handler = getattr(self, f'op_{op}', None)
+        if handler is None:
+            raise ValueError(f'Unknown op "{op}"')
+        return handler(**request)
+
+    def _add_job(self, watcher):
+        with self._jobs_lock:
+            job_id = next(self._job_ids)
+            self._jobs[job_id] = watcher
+            finished = [finished_id for finished_id, job in self._jobs.items() if job.done()]
+            for finished_id in finished[:-JOB_HISTORY]:
+                del self._jobs[finished_id]
+        return job_id
+
+    def _scheduler(self):
+        if not self.order_queue.is_owner:
+            raise PumpDaemonError('Another process is driving the pumps')
+        return controller.get_scheduler()
+
+    def _job(self, job_id):
+        with self._jobs_lock:
+            watcher = self._jobs.get(job_id)
+        if watcher is None:
+            raise ValueError(f'Unknown job {job_id}')
+        return watcher
+
+    def op_ping(self):
+        return 'pong'
+
+    def op_enqueue(self, recipe, size='single', source=None):
+        return order_to_json(self.order_queue.enqueue(recipe, size, source))
+
+    def op_status(self, order_id):
+        return order_to_json(self.order_queue.status(order_id))
+
+    def op_orders(self, active=True):
+        return [order_to_json(order) for order in self.order_queue.orders(active)]
+
+    def op_cancel(self, order_id):
+        return self.order_queue.cancel(order_id)
+
+    def op_cancel_all(self):
+        return self.order_queue.cancel_all()
+
+    def op_emergency_stop(self):
+        with self._jobs_lock:
+            jobs = list(self._jobs.values())
+        stopped = self.order_queue.emergency_stop()
+        for watcher in jobs:
+            watcher.cancel()
+        return [
+            [[pour.ingredient_name, pour.amount, pour.poured, pour.state] for pour in watcher.pours]
+            for watcher in stopped
+        ]
+
+    def op_prime(self, duration=10, pumps=None, concurrency=settings.MAINTENANCE_CONCURRENCY):
+        return self._maintenance(controller.FORWARD, duration, pumps, concurrency)
+
+    def op_clean(self, duration=10, pumps=None, concurrency=settings.MAINTENANCE_CONCURRENCY):
+        return self._maintenance(controller.REVERSE, duration, pumps, concurrency)
+
+    def _maintenance(self, action, duration, pumps, concurrency):
+        if isinstance(duration, dict):
+            # JSON object keys are always strings
+            duration = {int(pump_index): seconds for pump_index, seconds in duration.items()}
+        return self._add_job(self._scheduler().submit_maintenance(action, duration, pumps, concurrency))
+
+    def op_calibration_pour(self, pump_index, seconds):
+        self._scheduler()
+        return self._add_job(controller.calibration_pour(pump_index, seconds))
+
+    def op_job(self, job_id):
+        watcher = self._job(job_id)
+        return {
+            'done': watcher.done(),
+            'cancelled': watcher.cancelled,
+            'remaining': watcher.remaining(),
+            'progress': [[run.pump_index, run.state, watcher.remaining(run), run.seconds] for run in watcher.pours],
+        }
+
+    def op_cancel_job(self, job_id):
+        return self._job(job_id).cancel()
+
+    def op_preprime(self, recipe):
+        if not self.order_queue.is_owner:
+            return []
+        return controller.preprime_cocktail(recipe)
+
+    def op_release_lines(self):
+        return controller.release_primed_lines()
+
+
+class JobWatcher:
+    """Follows a maintenance job or test pour running in the daemon, like the ExecutorWatcher it mirrors."""
+
+    def __init__(self, client, job_id):
+        self.client = client
+        self.job_id = job_id
+        self.refresh()
+
+    def refresh(self):
+        self.state = self.client.request('job', job_id=self.job_id)
+        return self.state
+
+    @property
+    def cancelled(self):
+        return self.state['cancelled']
+
+    @property
+    def progress(self):
+        """A list of MaintenanceProgress, one per pump."""
+        return [controller.MaintenanceProgress(*run) for run in self.state['progress']]
+
+    def done(self):
+        return self.state['done']
+
+    def remaining(self):
+        return self.state['remaining']
+
+    def cancel(self):
+        return self.client.request('cancel_job', job_id=self.job_id)
+
+    def wait_for_change(self, timeout=None):
+        """Poll the job until `timeout` passes. Returns `done()`."""
+        if not self.done():
+            self.client.sleep(timeout)
+            self.refresh()
+        return self.done()
+
+    def wait(self, timeout=None):
+        """Block until the job has finished. Returns `done()`."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.wait_for_change(None if deadline is None else max(0.0, deadline - time.monotonic())):
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+        return self.done()
+
+
+class PumpClient:
+    """
+    Talks to a PumpDaemon. Has the order interface of OrderQueue and the
+    maintenance functions of the controller, so the frontends can use it in
+    place of either.
+    """
+
+    def __init__(self, socket_path=None, timeout=5.0, poll_interval=0.25):
+        self.socket_path = socket_path or settings.PUMP_SOCKET
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        # The daemon owns the pumps, and everything asked of this client runs there
+        self.is_owner = True
+
+    def request(self, op, **args):
+        """Send one request to the daemon and return its result."""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall((json.dumps({'op': op, **args}) + '\n').encode())
+            with sock.makefile('rb') as reader:
+                line = reader.readline()
+        if not line:
+            raise PumpDaemonError(f'The pump daemon closed the connection during "{op}"')
+        response = json.loads(line)
+        if not response['ok']:
+            raise PumpDaemonError(response['error'])
+        return response['result']
+
+    def sleep(self, timeout=None):
+        time.sleep(self.poll_interval if timeout is None else min(timeout, self.poll_interval))
+
+    def enqueue(self, recipe, size='single', source=None):
+        return order_from_json(self.request('enqueue', recipe=recipe, size=size, source=source))
+
+    def status(self, order_id):
+        return order_from_json(self.request('status', order_id=order_id))
+
+    def orders(self, active=True):
+        return [order_from_json(order) for order in self.request('orders', active=active)]
+
+    def cancel(self, order_id):
+        return self.request('cancel', order_id=order_id)
+
+    def cancel_all(self):
+        return self.request('cancel_all')
+
+    def emergency_stop(self):
+        """Stop every pump and cancel every order and job. Returns a StoppedDrink for each drink that was stopped."""
+        return [StoppedDrink([StoppedPour(*pour) for pour in pours]) for pours in self.request('emergency_stop')]
+
+    def watch(self, order_id):
+        return OrderWatcher(self, order_id)
+
+    def local_watcher(self, order_id):
+        return None
+
+    def run_maintenance(self, op, duration=10, pumps=None, concurrency=settings.MAINTENANCE_CONCURRENCY, callback=None):
+        """Run a maintenance job in the daemon and block until it's finished, like `controller.run_maintenance()`."""
+        watcher = JobWatcher(self, self.request(op, duration=duration, pumps=pumps, concurrency=concurrency))
+        while True:
+            done = watcher.wait_for_change(timeout=0.5)
+            if callback is not None:
+                callback(watcher.progress)
+            if done:
+                return watcher
+
+    def prime_pumps(self, duration=10, pumps=None, concurrency=settings.MAINTENANCE_CONCURRENCY, callback=None):
+        return self.run_maintenance('prime', duration, pumps, concurrency, callback)
+
+    def clean_pumps(self, duration=10, pumps=None, concurrency=settings.MAINTENANCE_CONCURRENCY, callback=None):
+        return self.run_maintenance('clean', duration, pumps, concurrency, callback)
+
+    def calibration_pour(self, pump_index, seconds):
+        return JobWatcher(self, self.request('calibration_pour', pump_index=pump_index, seconds=seconds))
+
+    def preprime_cocktail(self, recipe):
+        return self.request('preprime', recipe=recipe)
+
+    def release_primed_lines(self):
+        return self.request('release_lines')
+
+
+def connect(socket_path=None):
+    """A PumpClient for the daemon listening on `socket_path` (PUMP_SOCKET by default), or None if it isn't running."""
+    client = PumpClient(socket_path)
+    if not os.path.exists(client.socket_path):
+        return None
+    try:
+        client.request('ping')
+    except (OSError, PumpDaemonError):
+        logger.debug(f'No pump daemon is answering on {client.socket_path}')
+        return None
+    return client
+
+
+def main():
+    logging.basicConfig(level=logging.DEBUG if settings.DEBUG else logging.INFO)
+    daemon = PumpDaemon()
+    # Shut down cleanly on SIGTERM too, so the socket is removed and queued orders are handed over
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=daemon.shutdown).start())
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
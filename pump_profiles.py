@@ -0,0 +1,116 @@
+# pump_profiles.py
+import json
+import threading
+from collections import namedtuple
+
+import settings
+from ingredients import file_signature, parse_pump_label
+from journal import write_json
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Hardware details of a pump that the scheduler plans around. Stored alongside
+# pump_config.json in PUMP_PROFILES_FILE as {"Pump 1": {"current_draw": 1.2}, ...}
+#   current_draw: amps the pump draws while running
+#   seconds_per_oz: calibrated flow rate, or None to use OZ_COEFFICIENT
+#   dead_volume: ounces pushed through before anything reaches the glass
+PumpProfile = namedtuple('PumpProfile', ['current_draw', 'seconds_per_oz', 'dead_volume'])
+
+
+def default_profile():
+    return PumpProfile(current_draw=settings.PUMP_CURRENT_DRAW, seconds_per_oz=None, dead_volume=0.0)
+
+
+class PumpProfiles:
+    """PumpProfiles by zero based pump index. Pumps without a profile get `default_profile()`."""
+
+    def __init__(self, profiles=None):
+        self._profiles = {}
+        for pump_label, values in (profiles or {}).items():
+            try:
+                pump_index = parse_pump_label(pump_label)
+            except ValueError:
+                logger.critical(f'Could not parse pump label "{pump_label}" in pump profiles. Skipping.')
+                continue
+            try:
+                self._profiles[pump_index] = default_profile()._replace(**values)
+            except (TypeError, ValueError):
+                logger.critical(f'Invalid pump profile for "{pump_label}": {values}. Skipping.')
+
+    def __getitem__(self, pump_index):
+        return self._profiles.get(pump_index) or default_profile()
+
+    def __contains__(self, pump_index):
+        return pump_index in self._profiles
+
+    def set(self, pump_index, **values):
+        """Update some of a pump's profile values."""
+        self._profiles[pump_index] = self[pump_index]._replace(**values)
+
+    def to_json(self):
+        return {
+            f'Pump {pump_index + 1}': {name: value for name, value in profile._asdict().items() if value is not None}
+            for pump_index, profile in sorted(self._profiles.items())
+        }
+
+
+def fit_calibration(samples):
+    """
+    Fit a pump's flow from calibration pours, a list of (seconds, ounces)
+    pairs of how long the pump dispensed and how much was measured in the
+    glass. Models `seconds = seconds_per_oz * (ounces + dead_volume)` and
+    returns (seconds_per_oz, dead_volume). One sample, or a fit that would
+    give a negative dead volume, is fitted with no dead volume.
+    """
+    samples = [(float(seconds), float(ounces)) for seconds, ounces in samples if ounces > 0]
+    if not samples:
+        raise ValueError('Calibration needs at least one pour that dispensed something')
+    count = len(samples)
+    mean_ounces = sum(ounces for _, ounces in samples) / count
+    mean_seconds = sum(seconds for seconds, _ in samples) / count
+    spread = sum((ounces - mean_ounces) ** 2 for _, ounces in samples)
+    if spread:
+        slope = sum((ounces - mean_ounces) * (seconds - mean_seconds) for seconds, ounces in samples) / spread
+        intercept = mean_seconds - slope * mean_ounces
+        if slope > 0 and intercept >= 0:
+            return slope, intercept / slope
+    # Through the origin
+    return sum(seconds * ounces for seconds, ounces in samples) / sum(ounces ** 2 for _, ounces in samples), 0.0
+
+
+_profiles = {}
+_profiles_lock = threading.Lock()
+
+
+def get_pump_profiles(profiles_file=None):
+    """Get the PumpProfiles in a profiles file, reading it again only when it changes."""
+    if profiles_file is None:
+        profiles_file = settings.PUMP_PROFILES_FILE
+    signature = file_signature(profiles_file)
+    with _profiles_lock:
+        cached = _profiles.get(profiles_file)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        data = {}
+        if signature is not None:
+            try:
+                with open(profiles_file, 'r') as f:
+                    data = json.load(f)
+            except Exception:
+                logger.exception(f'Error reading {profiles_file}')
+        profiles = PumpProfiles(data)
+        _profiles[profiles_file] = (signature, profiles)
+        return profiles
+
+
+def save_pump_profiles(profiles, profiles_file=None):
+    """Write PumpProfiles to the profiles file, replacing it in one step so a crash can't leave it cut short."""
+    if profiles_file is None:
+        profiles_file = settings.PUMP_PROFILES_FILE
+    try:
+        write_json(profiles_file, profiles.to_json())
+    except Exception:
+        logger.exception('Error saving pump profiles')
@@ -11,7 +11,20 @@ if 'PYTEST_CURRENT_TEST' not in os.environ:
     
 CONFIG_FILE = os.getenv('PUMP_CONFIG_FILE', 'pump_config.json')
 COCKTAILS_FILE = os.getenv('COCKTAILS_FILE', 'cocktails.json')
+# Per-pump hardware details (e.g. current draw), kept alongside the pump config
+PUMP_PROFILES_FILE = os.getenv('PUMP_PROFILES_FILE', 'pump_profiles.json')
 LOGO_FOLDER = os.getenv('LOGO_FOLDER', 'drink_logos')
+# Which GPIO backend drives the pumps: auto, rpi, logging or simulated
+GPIO_BACKEND = os.getenv('GPIO_BACKEND', 'auto')
+# Where pour telemetry is written in Prometheus text format. Empty to disable.
+METRICS_FILE = os.getenv('METRICS_FILE', 'metrics.prom')
+# The drink order queue shared by the touchscreen and the web app
+ORDERS_FILE = os.getenv('ORDERS_FILE', 'orders.json')
+# The Unix socket the pump daemon (pump_daemon.py) listens on
+PUMP_SOCKET = os.getenv('PUMP_SOCKET', 'pumps.sock')
+# Where cocktails and the pump config are kept: json (the files above) or sqlite (DATABASE_FILE)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')
+DATABASE_FILE = os.getenv('DATABASE_FILE', 'tipsy.db')
 
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
@@ -28,14 +41,54 @@ settings = {
         'parse_method': int,
         'default': '3'
     }, 
+    'MAINTENANCE_CONCURRENCY': {
+        'parse_method': int,
+        'default': '4'
+    }, 
+    'POWER_BUDGET': {
+        'parse_method': float,
+        'default': '0'
+    }, 
+    'PUMP_CURRENT_DRAW': {
+        'parse_method': float,
+        'default': '1.0'
+    }, 
     'RELOAD_COCKTAILS_TIMEOUT': {
         'parse_method': int,
         'default': '0'
     }, 
+    'FILE_WATCH_DEBOUNCE': {
+        'parse_method': float,
+        'default': '0.25'
+    }, 
     'RETRACTION_TIME': {
         'parse_method': float,
         'default': '0'
     }, 
+    'RETRACTION_IDLE_TIMEOUT': {
+        'parse_method': float,
+        'default': '30'
+    }, 
+    'ORDER_EXPIRY': {
+        'parse_method': float,
+        'default': '300'
+    }, 
+    'SPECULATIVE_PRIME_DWELL': {
+        'parse_method': float,
+        'default': '0'
+    }, 
+    'BATCH_CAPACITY': {
+        'parse_method': float,
+        'default': '64'
+    }, 
+    'BATCH_CHUNK_OUNCES': {
+        'parse_method': float,
+        'default': '2'
+    }, 
+    'JOURNAL_COMPACT_BYTES': {
+        'parse_method': int,
+        'default': '65536'
+    }, 
     'COCKTAIL_IMAGE_SCALE': {
         'parse_method': float,
         'default': '1.0'
@@ -0,0 +1,275 @@
+# storage.py
+"""
+An optional SQLite store for the cocktails, pump config and favorites,
+used instead of cocktails.json and pump_config.json when STORAGE_BACKEND
+is "sqlite".
+
+The database runs in WAL mode, so the touchscreen and the web app can read
+while the other writes. Every write is a single transaction, and every
+read sees one consistent snapshot, never a half-saved menu.
+
+Copy the existing JSON files in once with:
+
+    python storage.py import
+"""
+import os
+import json
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+
+import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', 0);
+
+CREATE TABLE IF NOT EXISTS cocktails (
+    id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    normal_name TEXT NOT NULL,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cocktails_position ON cocktails (position);
+
+CREATE TABLE IF NOT EXISTS ingredients (
+    cocktail_id TEXT NOT NULL REFERENCES cocktails (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    measurement TEXT NOT NULL,
+    PRIMARY KEY (cocktail_id, name)
+);
+CREATE INDEX IF NOT EXISTS ingredients_name ON ingredients (name);
+
+CREATE TABLE IF NOT EXISTS favorites (
+    cocktail_id TEXT PRIMARY KEY REFERENCES cocktails (id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS pumps (
+    label TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    ingredient TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pumps_ingredient ON pumps (ingredient);
+'''
+
+
+def cocktail_id(cocktail):
+    """A cocktail's stable ID: its name in lower snake_case, like its image file."""
+    return cocktail.get('normal_name', '').lower().replace(' ', '_')
+
+
+class SQLiteStorage:
+    """
+    Cocktails, pump config and favorites in a SQLite database.
+
+    Each thread gets its own connection. `revision()` goes up with every
+    write from any process, so callers can cache what they read until it
+    changes.
+    """
+
+    def __init__(self, database_file=None):
+        self.database_file = database_file or settings.DATABASE_FILE
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Transactions are managed explicitly, see _read() and _write()
+            connection = sqlite3.connect(self.database_file, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('PRAGMA foreign_keys=ON')
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def close(self):
+        """Close this thread's connection."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    @contextmanager
+    def _read(self):
+        """A read transaction, so every query in it sees the same snapshot."""
+        connection = self._connection()
+        connection.execute('BEGIN')
+        try:
+            yield connection
+        finally:
+            connection.execute('COMMIT')
+
+    @contextmanager
+    def _write(self):
+        """
+        A write transaction that bumps the revision, and is rolled back if
+        anything in it fails. The revisions before and after are kept for
+        the write methods to return.
+        """
+        connection = self._connection()
+        # Take the write lock up front, so two writers can't deadlock upgrading from a read
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+            previous = connection.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+            connection.execute("UPDATE meta SET value = ? WHERE key = 'revision'", (previous + 1,))
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        self._local.written = (previous, previous + 1)
+
+    def revision(self):
+        """
+        A number that changes whenever anything in the database does. Every
+        write method returns the revisions from just before and after it,
+        so a cache can tell whether anything else changed in between.
+        """
+        return self._connection().execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+
+    def load_cocktails(self):
+        """Every cocktail in menu order, as the cocktails.json dict."""
+        with self._read() as connection:
+            favorites = {row[0] for row in connection.execute('SELECT cocktail_id FROM favorites')}
+            rows = connection.execute('SELECT id, record FROM cocktails ORDER BY position').fetchall()
+        cocktails = []
+        for cocktail_id, record in rows:
+            cocktail = json.loads(record)
+            cocktail['favorite'] = cocktail_id in favorites
+            cocktails.append(cocktail)
+        return {'cocktails': cocktails}
+
+    def _insert_cocktail(self, connection, cocktail, position):
+        key = cocktail_id(cocktail)
+        record = {name: value for name, value in cocktail.items() if name != 'favorite'}
+        connection.execute(
+            'INSERT INTO cocktails (id, position, normal_name, record) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET position = excluded.position, normal_name = excluded.normal_name, record = excluded.record',
+            (key, position, cocktail.get('normal_name', ''), json.dumps(record)),
+        )
+        connection.execute('DELETE FROM ingredients WHERE cocktail_id = ?', (key,))
+        connection.executemany(
+            'INSERT OR REPLACE INTO ingredients (cocktail_id, name, measurement) VALUES (?, ?, ?)',
+            [(key, name, str(measurement)) for name, measurement in cocktail.get('ingredients', {}).items()],
+        )
+        if cocktail.get('favorite', False):
+            connection.execute('INSERT OR IGNORE INTO favorites (cocktail_id) VALUES (?)', (key,))
+        else:
+            connection.execute('DELETE FROM favorites WHERE cocktail_id = ?', (key,))
+
+    def _replace_cocktails(self, connection, data):
+        connection.execute('DELETE FROM cocktails')
+        seen = set()
+        for cocktail in data.get('cocktails', []):
+            key = cocktail_id(cocktail)
+            if key in seen:
+                logger.warning(f'More than one cocktail is named "{cocktail.get("normal_name", "")}". Keeping the first.')
+                continue
+            # Positions stay contiguous, so they match the indexes in load_cocktails()
+            self._insert_cocktail(connection, cocktail, len(seen))
+            seen.add(key)
+
+    def save_cocktails(self, data):
+        """Replace every cocktail with the ones in a cocktails.json dict, in one transaction."""
+        with self._write() as connection:
+            self._replace_cocktails(connection, data)
+        return self._local.written
+
+    def save_cocktail(self, cocktail, position):
+        """Insert or update a single cocktail, with its ingredients and favorite, at `position` on the menu."""
+        with self._write() as connection:
+            self._insert_cocktail(connection, cocktail, position)
+        return self._local.written
+
+    def set_favorite(self, cocktail_id, favorite=True):
+        with self._write() as connection:
+            if favorite:
+                connection.execute('INSERT OR IGNORE INTO favorites (cocktail_id) VALUES (?)', (cocktail_id,))
+            else:
+                connection.execute('DELETE FROM favorites WHERE cocktail_id = ?', (cocktail_id,))
+        return self._local.written
+
+    def load_pump_config(self):
+        """The pump config, like pump_config.json: {"Pump 1": "vodka", ...}."""
+        rows = self._connection().execute('SELECT label, ingredient FROM pumps ORDER BY position')
+        return dict(rows.fetchall())
+
+    def _replace_pump_config(self, connection, pump_config):
+        connection.execute('DELETE FROM pumps')
+        connection.executemany(
+            'INSERT INTO pumps (label, position, ingredient) VALUES (?, ?, ?)',
+            [(label, position, ingredient) for position, (label, ingredient) in enumerate(pump_config.items())],
+        )
+
+    def save_pump_config(self, pump_config):
+        with self._write() as connection:
+            self._replace_pump_config(connection, pump_config)
+        return self._local.written
+
+    def import_json(self, cocktails_file=None, config_file=None):
+        """
+        Copy cocktails.json and pump_config.json into the database, replacing
+        what's there. A missing file is skipped. Returns the number of
+        cocktails and pumps imported.
+        """
+        # journal.py builds on this module
+        from journal import CocktailJournal
+        cocktails_file = cocktails_file or settings.COCKTAILS_FILE
+        config_file = config_file or settings.CONFIG_FILE
+        cocktails = None
+        pump_config = None
+        journal = CocktailJournal(cocktails_file)
+        if any(journal.signature()):
+            # With the edits journaled since the file was last compacted
+            cocktails = journal.load()[0]
+        if os.path.exists(config_file):
+            with open(config_file, 'r') as f:
+                pump_config = json.load(f)
+        # Both files go in together, or neither does
+        with self._write() as connection:
+            if cocktails is not None:
+                self._replace_cocktails(connection, cocktails)
+            if pump_config is not None:
+                self._replace_pump_config(connection, pump_config)
+        return len((cocktails or {}).get('cocktails', [])), len(pump_config or {})
+
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+
+def get_storage():
+    """The SQLiteStorage for DATABASE_FILE when STORAGE_BACKEND is "sqlite", or None for the JSON files."""
+    if settings.STORAGE_BACKEND.lower() != 'sqlite':
+        return None
+    with _storages_lock:
+        if settings.DATABASE_FILE not in _storages:
+            _storages[settings.DATABASE_FILE] = SQLiteStorage(settings.DATABASE_FILE)
+        return _storages[settings.DATABASE_FILE]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Manage the SQLite store for cocktails and the pump config.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    importer = subparsers.add_parser('import', help='Copy the JSON files into the database, replacing what is there')
+    importer.add_argument('--cocktails', default=settings.COCKTAILS_FILE, help='Cocktails file to import')
+    importer.add_argument('--pump-config', default=settings.CONFIG_FILE, help='Pump config file to import')
+    importer.add_argument('--database', default=settings.DATABASE_FILE, help='Database to import into')
+    args = parser.parse_args(args)
+
+    if args.command == 'import':
+        cocktail_count, pump_count = SQLiteStorage(args.database).import_json(args.cocktails, args.pump_config)
+        print(f'Imported {cocktail_count} cocktails and {pump_count} pumps into {args.database}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import asyncio
+
+
+class TestAsyncController:
+    def get_async_controller(self):
+        """Get async_controller from parent directory with default settings"""
+        import sys
+        sys.path.append('.')
+        import async_controller
+        self.async_controller = async_controller
+
+    def get_scheduler(self, monkeypatch, clock=None):
+        import controller
+        from gpio_backends import SimulatedBackend
+        monkeypatch.setattr(controller, 'OZ_COEFFICIENT', 1.0)
+        monkeypatch.setattr(controller, 'RETRACTION_TIME', 0)
+        monkeypatch.setattr(controller, 'INVERT_PUMP_PINS', False)
+        backend = SimulatedBackend(clock)
+        scheduler = controller.PumpScheduler(backend=backend)
+        index = controller.IngredientIndex({'Pump 1': 'vodka', 'Pump 2': 'coke'})
+        return scheduler, index
+
+    def test_drinks(self, monkeypatch):
+        """Test that queued drinks can be awaited together and stream their status"""
+        self.get_async_controller()
+        import controller
+        scheduler, index = self.get_scheduler(monkeypatch)
+        pumps = self.async_controller.AsyncPumpScheduler(scheduler)
+        vodka_cola = controller.compile_recipe({'Vodka': '1 oz', 'Coke': '2 oz'}, index)
+        scheduler.start()
+        try:
+            async def order():
+                first = pumps.submit_drink(vodka_cola.single)
+                second = pumps.submit_drink(vodka_cola.double)
+                statuses = [status async for status in second.status()]
+                poured = await asyncio.gather(first, second)
+                return statuses, poured
+
+            statuses, poured = asyncio.run(order())
+        finally:
+            scheduler.stop()
+        assert [[pour.state for pour in pours] for pours in poured] == [['done', 'done'], ['done', 'done']]
+        assert statuses[-1].done and not statuses[-1].cancelled and statuses[-1].remaining == 0.0
+        assert sorted((pour.ingredient_name, pour.amount) for pour in statuses[-1].pours) == [('Coke', 4.0), ('Vodka', 2.0)]
+        # The second drink waits for the first one, which takes 2 seconds
+        assert scheduler.backend.clock.monotonic() == 2.0 + 4.0
+
+    def test_cancel(self, monkeypatch):
+        """Test that cancelling the task awaiting a drink stops its pumps"""
+        self.get_async_controller()
+        import controller
+        from gpio_backends import RealClock
+        scheduler, index = self.get_scheduler(monkeypatch, RealClock())
+        pumps = self.async_controller.AsyncPumpScheduler(scheduler)
+        vodka = controller.compile_recipe({'Vodka': '30 oz'}, index)
+        scheduler.start()
+        try:
+            async def order():
+                drink = pumps.submit_drink(vodka.single)
+                task = asyncio.ensure_future(drink.wait())
+                async for status in drink.status():
+                    if status.pours[0].state == controller.Pour.RUNNING:
+                        break
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                return await drink
+
+            pours = asyncio.run(order())
+        finally:
+            scheduler.stop()
+        assert pours[0].state == controller.Pour.ABORTED
+        backend = scheduler.backend
+        vodka_pin = [(at, value) for at, pin, value in backend.transitions if pin == controller.MOTORS[0][0]]
+        assert [value for at, value in vodka_pin] == [backend.HIGH, backend.LOW]
+        assert vodka_pin[1][0] - vodka_pin[0][0] < 5
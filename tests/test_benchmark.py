@@ -0,0 +1,86 @@
+import json
+
+import pytest
+
+
+class TestBenchmark:
+    def get_benchmark(self):
+        """Get benchmark from parent directory with default settings"""
+        import sys
+        sys.path.append('.')
+        import benchmark
+        self.benchmark = benchmark
+
+    def test_percentile(self):
+        """Test nearest-rank percentiles"""
+        self.get_benchmark()
+        values = list(range(1, 101))
+        assert self.benchmark.percentile(values, 50) == 50
+        assert self.benchmark.percentile(values, 99) == 99
+        assert self.benchmark.percentile([], 95) == 0.0
+
+    def test_run_benchmark(self, monkeypatch, tmp_path):
+        """Test that a benchmark run reports throughput, latency, utilization and idle gaps"""
+        self.get_benchmark()
+        monkeypatch.setattr(self.benchmark.controller, 'OZ_COEFFICIENT', 10.0)
+        monkeypatch.setattr(self.benchmark.controller, 'RETRACTION_TIME', 0)
+        monkeypatch.setattr(self.benchmark.controller, 'PUMP_CONCURRENCY', 2)
+        config_file = tmp_path / 'pump_config.json'
+        cocktails_file = tmp_path / 'cocktails.json'
+        cocktails = [{'normal_name': 'Vodka Cola', 'ingredients': {'Vodka': '2 oz', 'Coke': '4 oz'}}]
+        config_file.write_text(json.dumps({'Pump 1': 'vodka', 'Pump 2': 'coke'}))
+        cocktails_file.write_text(json.dumps({'cocktails': cocktails}))
+
+        orders = [
+            {'cocktail': cocktails[0], 'size': 'single', 'arrival': 0.0},
+            {'cocktail': cocktails[0], 'size': 'single', 'arrival': 0.0},
+            {'cocktail': cocktails[0], 'size': 'single', 'arrival': 100.0},
+        ]
+        results = self.benchmark.run_benchmark(orders, config_file, cocktails_file)
+        assert results['simulated_seconds'] == 140.0
+        assert results['latency']['p50'] == 40.0
+        assert results['latency']['max'] == 80.0
+        assert results['drinks_per_hour'] == 3 / 140 * 3600
+        assert results['pump_utilization']['Pump 2'] == 120 / 140
+        assert results['idle_gaps'] == {'count': 1, 'total': 20.0, 'max': 20.0, 'mean': 20.0}
+
+    def test_run_benchmark_queued(self, monkeypatch, tmp_path):
+        """Test that orders queue up at their arrival times, so lines are kept full between drinks"""
+        self.get_benchmark()
+        monkeypatch.setattr(self.benchmark.controller, 'OZ_COEFFICIENT', 10.0)
+        monkeypatch.setattr(self.benchmark.controller, 'RETRACTION_TIME', 2)
+        monkeypatch.setattr(self.benchmark.controller, 'PUMP_CONCURRENCY', 2)
+        config_file = tmp_path / 'pump_config.json'
+        cocktails_file = tmp_path / 'cocktails.json'
+        cocktails = [{'normal_name': 'Vodka Cola', 'ingredients': {'Vodka': '2 oz', 'Coke': '4 oz'}}]
+        config_file.write_text(json.dumps({'Pump 1': 'vodka', 'Pump 2': 'coke'}))
+        cocktails_file.write_text(json.dumps({'cocktails': cocktails}))
+
+        orders = [{'cocktail': cocktails[0], 'size': 'single', 'arrival': 0.0} for _ in range(2)]
+        results = self.benchmark.run_benchmark(orders, config_file, cocktails_file)
+        # The first drink skips its retractions and the second its refills, instead of 2 x (40 + 2 + 2)
+        assert results['simulated_seconds'] == 84.0
+        assert results['latency']['p50'] == 42.0
+
+    def test_build_orders(self):
+        """Test that orders follow the requested mix"""
+        self.get_benchmark()
+        cocktails = [{'normal_name': 'Vodka Cola'}, {'normal_name': 'Margarita'}]
+        orders = self.benchmark.build_orders(cocktails, 20, mix='Margarita=1', interval=30, seed=1)
+        assert len(orders) == 20
+        assert all(order['cocktail']['normal_name'] == 'Margarita' for order in orders)
+        assert orders[-1]['arrival'] > orders[0]['arrival'] > 0
+
+    def test_build_orders_pourable_only(self):
+        """Test that cocktails the pumps can't fully pour are left out of the orders"""
+        self.get_benchmark()
+        index = self.benchmark.controller.IngredientIndex({'Pump 1': 'vodka', 'Pump 2': 'coke'})
+        cocktails = [
+            {'normal_name': 'Vodka Cola', 'ingredients': {'Vodka': '2 oz', 'Coke': '4 oz'}},
+            {'normal_name': 'Margarita', 'ingredients': {'Tequila': '2 oz', 'Lime Juice': '1 oz'}},
+            {'normal_name': 'Vodka Splash', 'ingredients': {'Vodka': '2 splashes'}},
+        ]
+        orders = self.benchmark.build_orders(cocktails, 20, seed=1, ingredient_index=index)
+        assert {order['cocktail']['normal_name'] for order in orders} == {'Vodka Cola'}
+        with pytest.raises(ValueError):
+            self.benchmark.build_orders(cocktails, 20, mix='Margarita=1', ingredient_index=index)
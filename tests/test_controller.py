@@ -0,0 +1,642 @@
+import concurrent.futures
+import itertools
+import json
+import os
+import threading
+import time
+import pytest
+
+
+class TestController:
+    def get_controller(self):
+        """Get controller from parent directory with default settings"""
+        import sys
+        sys.path.append('.')
+        import controller
+        self.controller = controller
+
+    def test_watcher_wait(self):
+        """Test that waiting on a watcher blocks until its futures finish"""
+        self.get_controller()
+        release = threading.Event()
+        watcher = self.controller.ExecutorWatcher()
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            watcher.add_executor(executor.submit(release.wait))
+            assert not watcher.wait(timeout=0.01)
+            assert not watcher.done()
+            release.set()
+            assert watcher.wait(timeout=5)
+        assert watcher.done()
+
+    def test_watcher_done_callback(self):
+        """Test that done callbacks fire once, including ones added after completion"""
+        self.get_controller()
+        release = threading.Event()
+        calls = []
+        watcher = self.controller.ExecutorWatcher()
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            watcher.add_executor(executor.submit(release.wait))
+            watcher.add_done_callback(calls.append)
+            assert calls == []
+            release.set()
+            watcher.wait(timeout=5)
+        watcher.add_done_callback(calls.append)
+        assert calls == [watcher, watcher]
+
+    def test_pour_state_notifications(self):
+        """Test that pour state changes notify listeners and wake watchers"""
+        self.get_controller()
+        pour = self.controller.Pour(0, 1.0, 'Test Ingredient')
+        states = []
+        pour.add_listener(lambda changed: states.append(changed.state))
+        release = threading.Event()
+        watcher = self.controller.ExecutorWatcher()
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            watcher.add_executor(executor.submit(release.wait))
+            watcher.add_pour(pour)
+            timer = threading.Timer(0.05, pour.set_state, args=(self.controller.Pour.RUNNING,))
+            timer.start()
+            assert not watcher.wait_for_change(timeout=5)
+            assert pour.running
+            release.set()
+        timer.join()
+        assert states == [self.controller.Pour.RUNNING]
+
+    def test_scheduler_lifecycle(self, monkeypatch):
+        """Test that a scheduler pours drinks between start and stop, and refuses work after stop"""
+        self.get_controller()
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 0.001)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 0)
+        scheduler = self.controller.PumpScheduler()
+        scheduler.start()
+        try:
+            plan = self.controller.compile_recipe({'Vodka': '2 oz', 'Coke': '4 oz'}, self.controller.IngredientIndex({'Pump 1': 'vodka', 'Pump 2': 'coke'}))
+            watcher = scheduler.submit_drink(plan.double)
+            assert watcher.wait(timeout=5)
+            assert sorted(str(pour) for pour in watcher.pours) == ['Coke: 8.0 oz.', 'Vodka: 4.0 oz.']
+            assert all(pour.state == self.controller.Pour.DONE for pour in watcher.pours)
+        finally:
+            scheduler.stop()
+        assert not scheduler.running
+        with pytest.raises(RuntimeError):
+            scheduler.submit_job(lambda scheduler: None)
+
+    def test_parse_measurement(self):
+        """Test that measurements are converted to ounces using their units"""
+        self.get_controller()
+        assert self.controller.parse_measurement('4 oz') == 4.0
+        assert self.controller.parse_measurement('1/2 oz') == 0.5
+        assert self.controller.parse_measurement('1 1/2 oz') == 1.5
+        assert self.controller.parse_measurement('2 1/4') == 2.25
+        assert self.controller.parse_measurement('0.75') == 0.75
+        assert self.controller.parse_measurement('2 dashes') == 2 / 32
+        assert self.controller.parse_measurement('1 Tbsp.') == 0.5
+        with pytest.raises(ValueError):
+            self.controller.parse_measurement('a splash')
+        # An unknown unit isn't taken for ounces
+        with pytest.raises(ValueError):
+            self.controller.parse_measurement('2 splashes')
+        with pytest.raises(ValueError):
+            self.controller.parse_measurement('')
+
+    def test_plan_pours(self, monkeypatch):
+        """Test that pours are planned longest first into the earliest free slot"""
+        self.get_controller()
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 1.0)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 0)
+        pours = [self.controller.Pour(index, amount, f'Ingredient {index}') for index, amount in enumerate([1, 4, 3, 2, 2])]
+        slots = self.controller.plan_pours(pours, 2)
+        assert [[pour.amount for pour in slot] for slot in slots] == [[4, 2], [3, 2, 1]]
+        assert max(pour.end_offset for pour in pours) == 6
+        assert [pour.start_offset for pour in pours] == [5, 0, 0, 3, 4]
+
+    def test_plan_pours_power_budget(self, monkeypatch):
+        """Test that pours only run together while their current draw fits in the power budget"""
+        self.get_controller()
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 1.0)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 0)
+        pours = [self.controller.Pour(index, amount, f'Ingredient {index}') for index, amount in enumerate([4, 3, 2, 2])]
+        for pour, current_draw in zip(pours, [3.0, 1.0, 1.0, 5.0]):
+            pour.current_draw = current_draw
+        self.controller.plan_pours(pours, 4, power_budget=4.0)
+        # The 4 A syrup pump can't run with anything, the light pumps share the budget
+        assert [pour.start_offset for pour in pours] == [0, 0, 3, 5]
+        assert max(pour.end_offset for pour in pours) == 7
+
+    def test_drink_eta(self, monkeypatch):
+        """Test that a submitted drink knows its ETA before it starts pouring"""
+        self.get_controller()
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 0.01)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 0)
+        monkeypatch.setattr(self.controller, 'PUMP_CONCURRENCY', 1)
+        scheduler = self.controller.PumpScheduler()
+        scheduler.start()
+        try:
+            plan = self.controller.compile_recipe({'Bitters': '2 dashes', 'Vodka': '2 oz', 'Coke': '4 oz'}, self.controller.IngredientIndex({'Pump 1': 'vodka', 'Pump 2': 'coke', 'Pump 8': 'bitters'}))
+            watcher = scheduler.submit_drink(plan.single)
+            assert watcher.eta == pytest.approx(0.060625)
+            assert [pour.ingredient_name for pour in watcher.pours] == ['Coke', 'Vodka', 'Bitters']
+            assert watcher.wait(timeout=5)
+            assert watcher.remaining() == 0.0
+        finally:
+            scheduler.stop()
+
+    def test_compile_recipe(self, monkeypatch):
+        """Test that recipes compile to single and double plans, skipping unmapped ingredients"""
+        self.get_controller()
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 2.0)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 1.0)
+        plan = self.controller.compile_recipe({'Vodka': '2 oz', 'Tonic Water': '4 oz', 'Lime Juice': 'splash'}, self.controller.IngredientIndex({'Pump 1': 'vodka'}))
+        assert plan.single == ((0, 'Vodka', 2.0, 5.0),)
+        assert plan.double == ((0, 'Vodka', 4.0, 9.0),)
+
+    def test_calibrated_pour_times(self, monkeypatch, tmp_path):
+        """Test that calibrated pumps use their own flow rate and dead volume"""
+        self.get_controller()
+        from pump_profiles import PumpProfiles
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 8.0)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 1.0)
+        profiles = PumpProfiles({'Pump 2': {'seconds_per_oz': 10.0, 'dead_volume': 0.5}})
+        plan = self.controller.compile_recipe({'Vodka': '2 oz', 'Coke': '4 oz'}, self.controller.IngredientIndex({'Pump 1': 'vodka', 'Pump 2': 'coke'}), profiles=profiles)
+        assert [planned.seconds for planned in plan.single] == [17.0, 46.0]
+        assert [planned.seconds for planned in plan.double] == [33.0, 86.0]
+
+        profiles_file = str(tmp_path / 'pump_profiles.json')
+        profile = self.controller.calibrate_pump(0, [(6, 0.5), (11, 1.0)], profiles_file)
+        assert (profile.seconds_per_oz, profile.dead_volume) == (10.0, 0.1)
+        with open(profiles_file) as f:
+            assert json.load(f)['Pump 1']['seconds_per_oz'] == 10.0
+
+    def test_pour_plan_cache(self, monkeypatch, tmp_path):
+        """Test that compiled plans are reused until the pump config or timing settings change"""
+        self.get_controller()
+        config_file = tmp_path / 'pump_config.json'
+        cocktails_file = tmp_path / 'cocktails.json'
+        config_file.write_text(json.dumps({'Pump 1': 'vodka'}))
+        cocktails_file.write_text(json.dumps({'cocktails': [{'normal_name': 'Shot', 'ingredients': {'Vodka': '1 oz'}}]}))
+        cache = self.controller.PourPlanCache(config_file, cocktails_file)
+        recipe = {'ingredients': {'Vodka': '1 oz'}}
+
+        plan = cache.get(recipe)
+        assert plan.single[0].pump_index == 0
+        assert cache.get(recipe) is plan
+
+        config_file.write_text(json.dumps({'Pump 2': 'vodka'}))
+        os.utime(config_file, ns=(0, 0))
+        assert cache.get(recipe).single[0].pump_index == 1
+
+        plan = cache.get(recipe)
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', self.controller.OZ_COEFFICIENT + 1)
+        assert cache.get(recipe) is not plan
+
+        # Recipes saved to the journal are compiled without waiting for it to be compacted
+        from journal import CocktailJournal
+        double = {'normal_name': 'Double', 'ingredients': {'Vodka': '2 oz'}}
+        CocktailJournal(cocktails_file).append([{'op': 'upsert', 'cocktail': double}])
+        cache.get(recipe)
+        assert cache.recipe_key(double['ingredients']) in cache._plans
+
+    def test_simulated_drink(self, monkeypatch):
+        """Test that a simulated backend pours instantly while recording realistic pin timings"""
+        self.get_controller()
+        from gpio_backends import SimulatedBackend
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 8.0)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 0)
+        monkeypatch.setattr(self.controller, 'PUMP_CONCURRENCY', 1)
+        monkeypatch.setattr(self.controller, 'INVERT_PUMP_PINS', False)
+        backend = SimulatedBackend()
+        scheduler = self.controller.PumpScheduler(backend=backend)
+        scheduler.start()
+        try:
+            plan = self.controller.compile_recipe({'Vodka': '2 oz', 'Coke': '4 oz'}, self.controller.IngredientIndex({'Pump 1': 'vodka', 'Pump 2': 'coke'}))
+            watcher = scheduler.submit_drink(plan.single)
+            assert watcher.eta == 48.0
+            assert watcher.wait(timeout=5)
+        finally:
+            scheduler.stop()
+        assert backend.clock.monotonic() == 48.0
+        coke_ia, vodka_ia = self.controller.MOTORS[1][0], self.controller.MOTORS[0][0]
+        assert [(at, pin) for at, pin, value in backend.transitions if value == backend.HIGH] == [(0.0, coke_ia), (32.0, vodka_ia)]
+
+    def test_plan_batch(self, monkeypatch, tmp_path):
+        """Test that a batch is scaled by servings or volume, kept within capacity and split into rounds"""
+        self.get_controller()
+        config_file = tmp_path / 'pump_config.json'
+        config_file.write_text(json.dumps({'Pump 1': 'vodka', 'Pump 2': 'coke'}))
+        monkeypatch.setattr(self.controller, '_plan_cache', self.controller.PourPlanCache(config_file, tmp_path / 'cocktails.json', tmp_path / 'profiles.json'))
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 1.0)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 0)
+        monkeypatch.setattr(self.controller, 'POWER_BUDGET', 0)
+        monkeypatch.setattr(self.controller, 'PUMP_CONCURRENCY', 1)
+        monkeypatch.setattr(self.controller, 'MAINTENANCE_CONCURRENCY', 2)
+        recipe = {'ingredients': {'Vodka': '1.5 oz', 'Coke': '4.5 oz'}}
+
+        batch = self.controller.plan_batch(recipe, servings=4, capacity=64, chunk_ounces=6)
+        assert (batch.servings, batch.ounces, batch.capped, len(batch.rounds)) == (4, 24.0, False, 3)
+        assert [(planned.ingredient_name, planned.ounces) for planned in batch.rounds[0]] == [('Vodka', 2.0), ('Coke', 6.0)]
+        # Both pumps run together in each round
+        assert batch.eta == 3 * 6.0
+        assert self.controller.plan_batch(recipe, ounces=48, capacity=64, chunk_ounces=0).servings == 8
+
+        capped = self.controller.plan_batch(recipe, servings=20, capacity=60, chunk_ounces=0)
+        assert (capped.servings, capped.ounces, capped.capped, len(capped.rounds)) == (10, 60.0, True, 1)
+        assert self.controller.plan_batch({'ingredients': {'Gin': '1 oz'}}, servings=2) is None
+
+    def test_simulated_batch(self, monkeypatch):
+        """Test that a batch pours its rounds one after another behind a single watcher"""
+        self.get_controller()
+        from gpio_backends import SimulatedBackend
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 1.0)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 0)
+        monkeypatch.setattr(self.controller, 'PUMP_CONCURRENCY', 1)
+        monkeypatch.setattr(self.controller, 'INVERT_PUMP_PINS', False)
+        backend = SimulatedBackend()
+        scheduler = self.controller.PumpScheduler(backend=backend)
+        scheduler.start()
+        try:
+            round_pours = (
+                self.controller.PlannedPour(0, 'Vodka', 1.0, 1.0),
+                self.controller.PlannedPour(1, 'Coke', 3.0, 3.0),
+            )
+            watcher = scheduler.submit_batch([round_pours] * 2, concurrency=2)
+            assert watcher.eta == 6.0
+            assert watcher.wait(timeout=5) and not watcher.cancelled
+            assert [pour.state for pour in watcher.pours] == ['done'] * 4
+        finally:
+            scheduler.stop()
+        assert backend.clock.monotonic() == 6.0
+        coke_ia, vodka_ia = self.controller.MOTORS[1][0], self.controller.MOTORS[0][0]
+        highs = sorted((at, pin) for at, pin, value in backend.transitions if value == backend.HIGH)
+        assert highs == sorted([(0.0, coke_ia), (0.0, vodka_ia), (3.0, coke_ia), (3.0, vodka_ia)])
+
+    def test_drink_metrics(self, monkeypatch, tmp_path):
+        """Test that a drink records pour, retraction and latency telemetry and writes it out, and a calibration pour isn't counted as a drink"""
+        self.get_controller()
+        from gpio_backends import SimulatedBackend
+        from metrics import read_metrics
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 8.0)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 2.0)
+        metrics_file = str(tmp_path / 'metrics.prom')
+        pours = self.controller.POURS.value(pump=12)
+        duration = self.controller.POUR_DURATION.value(pump=12)
+        retraction = self.controller.RETRACTION_DURATION.value(pump=12)
+        scheduler = self.controller.PumpScheduler(backend=SimulatedBackend(), metrics_file=metrics_file)
+        scheduler.start()
+        try:
+            plan = self.controller.compile_recipe({'Vodka': '1 oz'}, self.controller.IngredientIndex({'Pump 12': 'vodka'}))
+            assert scheduler.submit_drink(plan.single).wait(timeout=5)
+            drinks, latency = self.controller.DRINKS.value(), self.controller.DRINK_LATENCY.value()
+            calibration = self.controller.PlannedPour(11, 'Pump 12 calibration', 0.0, 5.0)
+            assert scheduler.submit_drink([calibration], metrics=False).wait(timeout=5)
+            assert (self.controller.DRINKS.value(), self.controller.DRINK_LATENCY.value()) == (drinks, latency)
+        finally:
+            scheduler.stop()
+        assert self.controller.POURS.value(pump=12) == pours + 2
+        assert self.controller.POUR_DURATION.value(pump=12) == (duration[0] + 10.0 + 5.0, duration[1] + 2)
+        assert self.controller.RETRACTION_DURATION.value(pump=12) == (retraction[0] + 4.0, retraction[1] + 2)
+        samples = read_metrics(metrics_file)
+        assert ('tipsy_pours_total', {'pump': '12'}, pours + 2) in samples
+        assert any(name == 'tipsy_drink_latency_seconds_count' for name, labels, value in samples)
+
+    def test_lookahead_retraction(self, monkeypatch):
+        """Test that a line is kept full for a queued drink on the same pump and retracted once it goes idle"""
+        self.get_controller()
+        from gpio_backends import SimulatedBackend, RealClock
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 0.05)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 0.05)
+        monkeypatch.setattr(self.controller, 'RETRACTION_IDLE_TIMEOUT', 0.1)
+        monkeypatch.setattr(self.controller, 'INVERT_PUMP_PINS', False)
+        backend = SimulatedBackend(RealClock())
+        scheduler = self.controller.PumpScheduler(backend=backend)
+        index = self.controller.IngredientIndex({'Pump 1': 'vodka', 'Pump 2': 'coke'})
+        vodka = self.controller.compile_recipe({'Vodka': '1 oz'}, index).single
+        coke = self.controller.compile_recipe({'Coke': '1 oz'}, index).single
+        vodka_ib = self.controller.MOTORS[0][1]
+        scheduler.start()
+        try:
+            first, second, third = scheduler.submit_drink(vodka), scheduler.submit_drink(vodka), scheduler.submit_drink(coke)
+            assert third.wait(timeout=5)
+            # The first vodka keeps the line full, the second skips the refill and retracts
+            assert first.pours[0].retraction == 0
+            assert second.pours[0].seconds == pytest.approx(0.05) and second.pours[0].retraction == 0.05
+            assert [value for at, pin, value in backend.transitions if pin == vodka_ib] == [backend.HIGH, backend.LOW]
+            assert not scheduler.primed
+
+            kept = scheduler.submit_drink(vodka)
+            while not kept.pours[0].running:
+                kept.wait_for_change(timeout=5)
+            scheduler.submit_drink(vodka).cancel()
+            while not kept.pours[0].finished:
+                kept.wait_for_change(timeout=5)
+            assert kept.pours[0].retraction == 0 and scheduler.primed == {0}
+            # Nothing else pours from it, so it's retracted after the idle timeout
+            deadline = backend.clock.monotonic() + 5
+            while scheduler.primed and backend.clock.monotonic() < deadline:
+                backend.clock.sleep(0.01)
+            assert not scheduler.primed
+        finally:
+            scheduler.stop()
+        assert [value for at, pin, value in backend.transitions if pin == vodka_ib] == [backend.HIGH, backend.LOW] * 2
+
+    def test_aborted_pour_keeps_line_full(self, monkeypatch):
+        """Test that a pour stopped partway leaves its line full, so the next pour skips the refill, and it's retracted once idle"""
+        self.get_controller()
+        from gpio_backends import SimulatedBackend, RealClock
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 1.0)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 0.05)
+        monkeypatch.setattr(self.controller, 'RETRACTION_IDLE_TIMEOUT', 0.1)
+        monkeypatch.setattr(self.controller, 'INVERT_PUMP_PINS', False)
+        backend = SimulatedBackend(RealClock())
+        scheduler = self.controller.PumpScheduler(backend=backend)
+        vodka = self.controller.compile_recipe({'Vodka': '1 oz'}, self.controller.IngredientIndex({'Pump 1': 'vodka'})).single
+        vodka_ib = self.controller.MOTORS[0][1]
+        scheduler.start()
+        try:
+            watcher = scheduler.submit_drink(vodka)
+            while not watcher.pours[0].running:
+                watcher.wait_for_change(timeout=5)
+            watcher.cancel()
+            assert watcher.wait(timeout=5) and watcher.pours[0].state == self.controller.Pour.ABORTED
+            assert scheduler.primed == {0}
+            deadline = time.monotonic() + 5
+            while scheduler.primed and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert not scheduler.primed
+        finally:
+            scheduler.stop()
+        # Retracted once, by the idle retraction
+        assert [value for at, pin, value in backend.transitions if pin == vodka_ib] == [backend.HIGH, backend.LOW]
+
+    def test_idle_retraction_waits_for_drink(self, monkeypatch):
+        """Test that a line going idle isn't retracted while the next drink pours, outside what it was planned for"""
+        self.get_controller()
+        from gpio_backends import SimulatedBackend, RealClock
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 0.3)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 0.05)
+        monkeypatch.setattr(self.controller, 'RETRACTION_IDLE_TIMEOUT', 0.1)
+        monkeypatch.setattr(self.controller, 'INVERT_PUMP_PINS', False)
+        backend = SimulatedBackend(RealClock())
+        scheduler = self.controller.PumpScheduler(backend=backend)
+        index = self.controller.IngredientIndex({'Pump 1': 'vodka', 'Pump 2': 'coke', 'Pump 3': 'gin'})
+        gin = self.controller.compile_recipe({'Gin': '1 oz'}, index).single
+        vodka_cola = self.controller.compile_recipe({'Vodka': '1 oz', 'Coke': '1 oz'}, index).single
+        gin_ib = self.controller.MOTORS[2][1]
+        scheduler.start()
+        try:
+            stopped = scheduler.submit_drink(gin)
+            while not stopped.pours[0].running:
+                stopped.wait_for_change(timeout=5)
+            stopped.cancel()
+            watcher = scheduler.submit_drink(vodka_cola)
+            assert watcher.wait(timeout=5)
+            finished_at = backend.clock.monotonic()
+            deadline = finished_at + 5
+            while scheduler.primed and backend.clock.monotonic() < deadline:
+                backend.clock.sleep(0.01)
+            assert not scheduler.primed
+        finally:
+            scheduler.stop()
+        # The gin line the stopped drink left full is retracted once the next drink is done, not during it
+        retracted_at = [at for at, pin, value in backend.transitions if pin == gin_ib and value == backend.HIGH]
+        assert len(retracted_at) == 1 and retracted_at[0] >= finished_at
+
+    def test_preprime(self, monkeypatch):
+        """Test that a pre-primed line is retracted when released and skips the refill when a drink claims it"""
+        self.get_controller()
+        from gpio_backends import SimulatedBackend, RealClock
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 0.05)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 0.05)
+        monkeypatch.setattr(self.controller, 'RETRACTION_IDLE_TIMEOUT', 5)
+        monkeypatch.setattr(self.controller, 'INVERT_PUMP_PINS', False)
+        backend = SimulatedBackend(RealClock())
+        scheduler = self.controller.PumpScheduler(backend=backend)
+        index = self.controller.IngredientIndex({'Pump 1': 'vodka'})
+        vodka = self.controller.compile_recipe({'Vodka': '1 oz'}, index).single
+        vodka_ia, vodka_ib = self.controller.MOTORS[0]
+
+        def wait_until(condition):
+            deadline = backend.clock.monotonic() + 5
+            while not condition() and backend.clock.monotonic() < deadline:
+                backend.clock.sleep(0.01)
+            assert condition()
+
+        scheduler.start()
+        try:
+            assert scheduler.preprime([0]) == [0]
+            wait_until(lambda: scheduler.primed == {0})
+            # Swiping away retracts the line
+            assert scheduler.release_lines() == [0]
+            wait_until(lambda: not scheduler.primed)
+            assert [(pin, value) for at, pin, value in backend.transitions] == [
+                (vodka_ia, backend.HIGH), (vodka_ia, backend.LOW), (vodka_ib, backend.HIGH), (vodka_ib, backend.LOW),
+            ]
+
+            assert scheduler.preprime([0]) == [0]
+            wait_until(lambda: scheduler.primed == {0})
+            watcher = scheduler.submit_drink(vodka)
+            assert watcher.wait(timeout=5)
+            assert watcher.pours[0].seconds == pytest.approx(0.05)
+            # The drink claimed the line, so there's nothing left to release
+            assert scheduler.release_lines() == []
+        finally:
+            scheduler.stop()
+
+    def test_line_motion_power_budget(self, monkeypatch):
+        """Test that filling and retracting lines keeps within the power budget, alone and with a drink pouring"""
+        self.get_controller()
+        from gpio_backends import SimulatedBackend, RealClock
+        from pump_profiles import PumpProfiles
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 0.2)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 0.1)
+        monkeypatch.setattr(self.controller, 'RETRACTION_IDLE_TIMEOUT', 0.1)
+        monkeypatch.setattr(self.controller, 'POWER_BUDGET', 2.0)
+        monkeypatch.setattr(self.controller, 'INVERT_PUMP_PINS', False)
+        backend = SimulatedBackend(RealClock())
+        profiles = PumpProfiles({f'Pump {index + 1}': {'current_draw': 1.0} for index in range(3)})
+        scheduler = self.controller.PumpScheduler(backend=backend, profiles=profiles)
+        index = self.controller.IngredientIndex({'Pump 1': 'vodka', 'Pump 2': 'coke'})
+        vodka_cola = self.controller.compile_recipe({'Vodka': '1 oz', 'Coke': '1 oz'}, index).single
+
+        def wait_until(condition):
+            deadline = backend.clock.monotonic() + 5
+            while not condition() and backend.clock.monotonic() < deadline:
+                backend.clock.sleep(0.01)
+            assert condition()
+
+        def most_running():
+            pins = {}
+            most = 0
+            for at, transitions in itertools.groupby(backend.transitions, key=lambda transition: transition[0]):
+                pins.update((pin, value) for _, pin, value in transitions)
+                most = max(most, sum(any(pins.get(pin) == backend.HIGH for pin in motor) for motor in self.controller.MOTORS))
+            return most
+
+        scheduler.start()
+        try:
+            assert scheduler.preprime([0, 1, 2]) == [0, 1, 2]
+            wait_until(lambda: scheduler.primed == {0, 1, 2})
+            assert scheduler.release_lines() == [0, 1, 2]
+            wait_until(lambda: not scheduler.primed)
+            assert most_running() == 2
+
+            # A drink ordered while a line is filling doesn't run alongside it
+            assert scheduler.preprime([2]) == [2]
+            assert scheduler.submit_drink(vodka_cola).wait(timeout=5)
+            wait_until(lambda: not scheduler.primed)
+        finally:
+            scheduler.stop()
+        assert most_running() == 2
+
+    def test_line_fill(self, monkeypatch):
+        """Test tracking how full a line is from the fills and retractions applied to it"""
+        self.get_controller()
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 2.0)
+        Actuation = self.controller.Actuation
+
+        def applied(at, action):
+            actuation = Actuation(int(at * 1e9), 0, action)
+            actuation.error_ns = 0
+            return actuation
+
+        # Filling stopped half way
+        fill = [applied(0, Actuation.FORWARD), Actuation(int(2e9), 0, Actuation.STOP)]
+        assert self.controller.line_fill(0.0, fill, int(1e9)) == pytest.approx(1.0)
+        # Retracting a full line stopped a quarter of the way
+        retraction = [applied(10, Actuation.REVERSE), Actuation(int(12e9), 0, Actuation.STOP)]
+        assert self.controller.line_fill(2.0, retraction, int(10.5e9)) == pytest.approx(1.5)
+        # Never more than a full line, nor less than empty
+        assert self.controller.line_fill(2.0, fill, int(1e9)) == 2.0
+        assert self.controller.line_fill(0.0, retraction, int(11e9)) == 0.0
+
+    def test_emergency_stop(self, monkeypatch):
+        """Test that an emergency stop halts running pumps at once and aborts pouring and queued drinks"""
+        self.get_controller()
+        from gpio_backends import SimulatedBackend, RealClock
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 60.0)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 0)
+        monkeypatch.setattr(self.controller, 'INVERT_PUMP_PINS', False)
+        backend = SimulatedBackend(RealClock())
+        scheduler = self.controller.PumpScheduler(backend=backend)
+        scheduler.start()
+        try:
+            plan = self.controller.compile_recipe({'Vodka': '2 oz', 'Coke': '4 oz'}, self.controller.IngredientIndex({'Pump 1': 'vodka', 'Pump 2': 'coke'}))
+            pouring = scheduler.submit_drink(plan.single)
+            queued = scheduler.submit_drink(plan.single)
+            while not all(pour.running for pour in pouring.pours):
+                assert not pouring.wait_for_change(timeout=5)
+            stopping_at = backend.clock.monotonic()
+            assert set(scheduler.emergency_stop()) == {pouring, queued}
+            assert pouring.wait(timeout=5) and queued.wait(timeout=5)
+        finally:
+            scheduler.stop()
+        assert all(value == backend.LOW for value in backend.pins.values())
+        stops = [at for at, pin, value in backend.transitions if value == backend.LOW and at >= stopping_at]
+        assert len(set(stops)) == 1 and stops[0] - stopping_at < 0.5
+        assert all(pour.state == self.controller.Pour.ABORTED for pour in pouring.pours + queued.pours)
+        assert all(0 < pour.poured < pour.amount for pour in pouring.pours)
+        assert all(pour.poured == 0 for pour in queued.pours)
+        assert pouring.cancelled and queued.cancelled
+
+    def test_emergency_stop_leaves_lines_alone(self, monkeypatch):
+        """Test that no pump moves after an emergency stop, not even to retract the lines it left full"""
+        self.get_controller()
+        from gpio_backends import SimulatedBackend, RealClock
+        monkeypatch.setattr(self.controller, 'OZ_COEFFICIENT', 60.0)
+        monkeypatch.setattr(self.controller, 'RETRACTION_TIME', 0.05)
+        monkeypatch.setattr(self.controller, 'RETRACTION_IDLE_TIMEOUT', 0.1)
+        monkeypatch.setattr(self.controller, 'INVERT_PUMP_PINS', False)
+        backend = SimulatedBackend(RealClock())
+        scheduler = self.controller.PumpScheduler(backend=backend)
+        scheduler.start()
+        try:
+            assert scheduler.preprime([2]) == [2]
+            plan = self.controller.compile_recipe({'Vodka': '2 oz', 'Coke': '4 oz'}, self.controller.IngredientIndex({'Pump 1': 'vodka', 'Pump 2': 'coke'}))
+            pouring = scheduler.submit_drink(plan.single)
+            while not all(pour.running for pour in pouring.pours):
+                assert not pouring.wait_for_change(timeout=5)
+            stopping_at = backend.clock.monotonic()
+            assert scheduler.emergency_stop() == [pouring]
+            assert pouring.wait(timeout=5)
+            time.sleep(0.3)
+            assert not scheduler.primed and not scheduler._line_actuations and not scheduler._speculative
+        finally:
+            scheduler.stop()
+        assert not [pin for at, pin, value in backend.transitions if value == backend.HIGH and at >= stopping_at]
+
+    def test_parallel_maintenance(self, monkeypatch):
+        """Test that priming runs the chosen pumps in parallel within the concurrency limit and reports progress"""
+        self.get_controller()
+        from gpio_backends import SimulatedBackend
+        monkeypatch.setattr(self.controller, 'INVERT_PUMP_PINS', False)
+        backend = SimulatedBackend()
+        scheduler = self.controller.PumpScheduler(backend=backend)
+        scheduler.start()
+        try:
+            watcher = scheduler.submit_maintenance(self.controller.FORWARD, {0: 10, 1: 5, 2: 5, 3: 0}, concurrency=2)
+            assert watcher.eta == 10
+            progress = list(self.controller.maintenance_progress(watcher, interval=5))
+        finally:
+            scheduler.stop()
+        assert sorted(pump.pump_index for pump in progress[-1]) == [0, 1, 2]
+        assert all(pump.state == self.controller.Pour.DONE and pump.remaining == 0.0 for pump in progress[-1])
+        pump_1_ia, pump_2_ia, pump_3_ia = (self.controller.MOTORS[index][0] for index in range(3))
+        assert [(at, pin) for at, pin, value in backend.transitions if value == backend.HIGH] == [(0.0, pump_1_ia), (0.0, pump_2_ia), (5.0, pump_3_ia)]
+        assert backend.clock.monotonic() == 10.0
+
+    def test_drive_motors_batches(self, monkeypatch):
+        """Test that several motors are switched with one GPIO call"""
+        self.get_controller()
+        from gpio_backends import SimulatedBackend
+        monkeypatch.setattr(self.controller, 'INVERT_PUMP_PINS', True)
+        backend = SimulatedBackend()
+        calls = []
+        output = backend.output
+        monkeypatch.setattr(backend, 'output', lambda pins, values: calls.append(pins) or output(pins, values))
+        (ia1, ib1), (ia2, ib2) = self.controller.MOTORS[:2]
+        self.controller.drive_motors([((ia1, ib1), self.controller.FORWARD), ((ia2, ib2), self.controller.REVERSE)], backend)
+        assert calls == [[ia1, ib1, ia2, ib2]]
+        assert [backend.pins[pin] for pin in (ia1, ib1, ia2, ib2)] == [backend.LOW, backend.HIGH, backend.HIGH, backend.LOW]
+        with pytest.raises(ValueError):
+            backend.output([ia1, ib1], [backend.HIGH])
+
+    def test_actuation_engine(self, monkeypatch):
+        """Test that the engine switches due pins in deadline order, skips cancelled ones and records timing errors"""
+        self.get_controller()
+        from gpio_backends import SimulatedBackend
+        monkeypatch.setattr(self.controller, 'INVERT_PUMP_PINS', False)
+        backend = SimulatedBackend()
+        engine = self.controller.ActuationEngine(backend)
+        Actuation = self.controller.Actuation
+        applied = threading.Event()
+        cancelled = Actuation(1 * 10**9, 2, Actuation.FORWARD)
+        cancelled.cancel()
+        engine.start()
+        try:
+            engine.schedule([
+                Actuation(2 * 10**9, 1, Actuation.STOP, lambda actuation: applied.set()),
+                Actuation(0, 0, Actuation.FORWARD),
+                Actuation(1 * 10**9, 1, Actuation.FORWARD),
+                cancelled,
+            ])
+            assert applied.wait(timeout=5)
+        finally:
+            engine.stop()
+        assert list(engine.errors) == [(0, 'forward', 0), (1, 'forward', 0), (1, 'stop', 0)]
+        assert cancelled.error_ns is None
+        assert backend.clock.monotonic() == 2.0
+        pump_3_ia = self.controller.MOTORS[2][0]
+        assert backend.pins.get(pump_3_ia) != backend.HIGH
+
+    def test_actuation_engine_stop_releases_waiters(self):
+        """Test that stopping the engine still runs the callbacks of stops it drops"""
+        self.get_controller()
+        from gpio_backends import LoggingBackend
+        engine = self.controller.ActuationEngine(LoggingBackend())
+        Actuation = self.controller.Actuation
+        stopped = []
+        stop = Actuation(10**18, 0, Actuation.STOP, stopped.append)
+        engine.start()
+        engine.schedule([stop])
+        engine.stop()
+        assert stopped == [stop]
+        assert stop.error_ns is None
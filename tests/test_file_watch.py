@@ -0,0 +1,60 @@
+import os
+import queue
+import time
+
+
+class TestFileWatch:
+    def get_file_watch(self):
+        """Get file_watch from parent directory with default settings"""
+        import sys
+        sys.path.append('.')
+        import file_watch
+        self.file_watch = file_watch
+
+    def watch(self, paths, **kwargs):
+        changes = queue.Queue()
+        watcher = self.file_watch.FileWatcher(paths, changes.put, debounce=0.1, **kwargs).start()
+        return watcher, changes
+
+    def test_inotify(self, tmp_path):
+        """Test that a burst of saves is reported once, with only the watched paths that changed"""
+        self.get_file_watch()
+        cocktails_file = tmp_path / 'cocktails.json'
+        logo_folder = tmp_path / 'drink_logos'
+        logo_folder.mkdir()
+        cocktails_file.write_text('{}')
+        watcher, changes = self.watch([str(cocktails_file), str(logo_folder)])
+        try:
+            assert watcher.using_inotify
+            # Saved with a write and a rename, like write_json()
+            for _ in range(3):
+                (tmp_path / 'cocktails.json.tmp').write_text('{"cocktails": []}')
+                os.replace(tmp_path / 'cocktails.json.tmp', cocktails_file)
+            (tmp_path / 'orders.json').write_text('[]')
+            assert changes.get(timeout=5) == {str(cocktails_file)}
+
+            (logo_folder / 'vodka_cola.png').write_bytes(b'png')
+            assert changes.get(timeout=5) == {str(logo_folder / 'vodka_cola.png')}
+            time.sleep(0.3)
+            assert changes.empty()
+        finally:
+            watcher.stop()
+
+    def test_polling(self, tmp_path):
+        """Test that changes are still picked up without inotify"""
+        self.get_file_watch()
+        config_file = tmp_path / 'pump_config.json'
+        logo_folder = tmp_path / 'drink_logos'
+        logo_folder.mkdir()
+        (logo_folder / 'vodka_cola.png').write_bytes(b'png')
+        watcher, changes = self.watch([str(config_file), str(logo_folder)], poll_interval=0.05, use_inotify=False)
+        try:
+            assert not watcher.using_inotify
+            config_file.write_text('{"Pump 1": "vodka"}')
+            assert changes.get(timeout=5) == {str(config_file)}
+
+            # An image regenerated in place doesn't change the folder, but is still noticed
+            (logo_folder / 'vodka_cola.png').write_bytes(b'a new png')
+            assert changes.get(timeout=5) == {str(logo_folder / 'vodka_cola.png')}
+        finally:
+            watcher.stop()
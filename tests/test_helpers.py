@@ -1,4 +1,5 @@
 import base64
+import json
 import os
 import pygame
 from dotenv import dotenv_values
@@ -62,8 +63,9 @@ class TestHelpers:
             favorite_cocktail = cocktail_list[1]
             favorite_cocktail.update({'favorite': True})
             assert new_index == 0
-            assert self.helpers.load_cocktails() == {'cocktails': [favorite_cocktail, cocktail_list[0]] + cocktail_list[2:]}
-            assert self.helpers.load_cocktails()['cocktails'][0]['favorite'] == True
+            # Only the record changes on disk, and favorites come first on the menu
+            assert self.helpers.load_cocktails() == {'cocktails': cocktail_list}
+            assert self.helpers.get_valid_cocktails()[0] == favorite_cocktail
         finally:
             self.helpers.save_cocktails(old_cocktails, append=False)
 
@@ -108,6 +110,156 @@ class TestHelpers:
         finally:
             self.helpers.save_cocktails(old_cocktails, False)
 
+    def test_get_valid_cocktails_pourable_only(self):
+        """Test that cocktails with ingredients that aren't on a pump can be left out"""
+        self.get_helpers()
+        old_cocktails = self.helpers.load_cocktails()
+        old_config = self.helpers.load_saved_config()
+        try:
+            vodka_cola = {'normal_name': 'Vodka Cola', 'ingredients': {'Vodka': '2 oz', 'Cola': '4 oz'}}
+            gin_and_tonic = {'normal_name': 'Gin and Tonic', 'ingredients': {'Gin': '2 oz', 'Tonic Water': '4 oz'}}
+            self.helpers.save_config({'Pump 1': 'vodka', 'Pump 2': 'coke', 'Pump 5': 'gin'})
+            self.helpers.save_cocktails({'cocktails': [vodka_cola, gin_and_tonic]}, False)
+            assert self.helpers.get_valid_cocktails() == [vodka_cola, gin_and_tonic]
+            assert self.helpers.get_valid_cocktails(pourable_only=True) == [vodka_cola]
+
+            # The touchscreen's menu follows favorites, and the pump config once refreshed
+            menu = self.helpers.get_cocktail_repository().menu(pourable_only=True)
+            assert list(menu) == [vodka_cola] and menu.menu_index('gin_and_tonic') is None
+            self.helpers.save_config({'Pump 1': 'vodka', 'Pump 2': 'coke', 'Pump 5': 'gin', 'Pump 6': 'tonic water'})
+            menu.refresh()
+            assert [cocktail['normal_name'] for cocktail in menu] == ['Vodka Cola', 'Gin and Tonic']
+            self.helpers.get_cocktail_repository().set_favorite('gin_and_tonic')
+            assert menu.menu_index('gin_and_tonic') == 0 and menu[1]['normal_name'] == 'Vodka Cola'
+        finally:
+            self.helpers.save_config(old_config)
+            self.helpers.save_cocktails(old_cocktails, False)
+
+    def test_cocktail_repository(self, tmp_path, monkeypatch):
+        """Test that cocktails are parsed once and only read again when the file or logo folder changes"""
+        self.get_helpers()
+        cocktails_file = tmp_path / 'cocktails.json'
+        logo_folder = tmp_path / 'drink_logos'
+        logo_folder.mkdir()
+        (logo_folder / 'vodka_cola.png').write_bytes(b'')
+        vodka_cola = {'normal_name': 'Vodka Cola'}
+        gin_and_tonic = {'normal_name': 'Gin and Tonic'}
+        cocktails_file.write_text(json.dumps({'cocktails': [vodka_cola, gin_and_tonic]}))
+        repository = self.helpers.CocktailRepository(str(cocktails_file), str(logo_folder))
+
+        loads = []
+        json_load = self.helpers.json.load
+        monkeypatch.setattr(self.helpers.json, 'load', lambda f: loads.append(f.name) or json_load(f))
+        assert repository.valid_cocktails() == [vodka_cola]
+        revision = repository.revision
+        assert repository.valid_cocktails() == [vodka_cola]
+        assert repository.refresh() == revision
+        assert len(loads) == 1
+
+        # Adding an image is picked up from the folder, without parsing the cocktails again
+        (logo_folder / 'gin_and_tonic.png').write_bytes(b'')
+        os.utime(logo_folder, ns=(0, 0))
+        assert repository.valid_cocktails() == [vodka_cola, gin_and_tonic]
+        assert len(loads) == 1 and repository.revision > revision
+
+        # Saving keeps the new data without parsing it, and copies can be changed freely
+        data = repository.load()
+        data['cocktails'].pop()
+        repository.save(data)
+        data['cocktails'].clear()
+        assert repository.cocktails() == [vodka_cola]
+        assert len(loads) == 1
+
+        # Another process changing the file is picked up
+        cocktails_file.write_text(json.dumps({'cocktails': [gin_and_tonic, vodka_cola]}))
+        os.utime(cocktails_file, ns=(0, 0))
+        assert repository.cocktails() == [gin_and_tonic, vodka_cola]
+        assert len(loads) == 2
+
+    def test_cocktail_menu_favorites(self, tmp_path):
+        """Test that favoriting moves a cocktail to the front of the menu and saves it without reordering the file"""
+        self.get_helpers()
+        cocktails_file = tmp_path / 'cocktails.json'
+        logo_folder = tmp_path / 'drink_logos'
+        logo_folder.mkdir()
+        names = ['Vodka Cola', 'Gin and Tonic', 'Margarita', 'Daiquiri']
+        for name in names[:3]:
+            (logo_folder / self.helpers.get_safe_name(name)).write_bytes(b'')
+        cocktails_file.write_text(json.dumps({'cocktails': [{'normal_name': name} for name in names]}))
+        repository = self.helpers.CocktailRepository(str(cocktails_file), str(logo_folder))
+        menu = repository.menu()
+        assert [cocktail['normal_name'] for cocktail in menu] == names[:3]
+
+        assert repository.set_favorite('margarita') == 0
+        assert repository.set_favorite('gin_and_tonic') == 0
+        assert [cocktail['normal_name'] for cocktail in menu] == ['Gin and Tonic', 'Margarita', 'Vodka Cola']
+        assert repository.set_favorite('gin_and_tonic', False) == 2
+        assert [cocktail['normal_name'] for cocktail in menu] == ['Margarita', 'Vodka Cola', 'Gin and Tonic']
+        assert repository.menu_index('vodka_cola') == 1
+        assert repository.set_favorite('daiquiri') is None
+        assert repository.set_favorite('no_such_cocktail') is None
+
+        repository.compact()
+        saved = json.loads(cocktails_file.read_text())['cocktails']
+        assert [(cocktail['normal_name'], cocktail.get('favorite')) for cocktail in saved] == [
+            ('Vodka Cola', None), ('Gin and Tonic', False), ('Margarita', True), ('Daiquiri', True),
+        ]
+        assert self.helpers.CocktailRepository(str(cocktails_file), str(logo_folder)).valid_cocktails() == list(menu)
+
+    def test_cocktail_journal(self, tmp_path, monkeypatch):
+        """Test that edits are journaled, other readers apply only the new ones, and compaction folds them into the file"""
+        self.get_helpers()
+        cocktails_file = tmp_path / 'cocktails.json'
+        journal_file = tmp_path / 'cocktails.json.journal'
+        vodka_cola = {'normal_name': 'Vodka Cola', 'ingredients': {'Vodka': '2 oz'}}
+        gin_and_tonic = {'normal_name': 'Gin and Tonic', 'favorite': True}
+        cocktails_file.write_text(json.dumps({'cocktails': [vodka_cola]}))
+        writer = self.helpers.CocktailRepository(str(cocktails_file), str(tmp_path))
+        reader = self.helpers.CocktailRepository(str(cocktails_file), str(tmp_path))
+        assert reader.cocktails() == [vodka_cola]
+
+        # Edits only append to the journal
+        snapshot = cocktails_file.read_text()
+        edited = {**vodka_cola, 'ingredients': {'Vodka': '3 oz'}}
+        writer.save_cocktail(edited)
+        writer.append_cocktails([gin_and_tonic])
+        assert cocktails_file.read_text() == snapshot
+        assert [json.loads(line)['op'] for line in journal_file.read_text().splitlines()] == ['upsert', 'append']
+        assert writer.cocktails() == [gin_and_tonic, edited]
+
+        # The reader applies just the new journal lines, without parsing the cocktails file again
+        loads = []
+        json_load = self.helpers.json.load
+        monkeypatch.setattr(self.helpers.json, 'load', lambda f: loads.append(f.name) or json_load(f))
+        assert reader.cocktails() == [gin_and_tonic, edited]
+        assert loads == []
+
+        # A line cut short by a crash is left for later
+        with open(journal_file, 'a') as f:
+            f.write('{"op": "upsert", "cocktail": {"normal_name": "Marg')
+        assert self.helpers.CocktailRepository(str(cocktails_file), str(tmp_path)).cocktails() == [gin_and_tonic, edited]
+
+        # Compaction writes everything to the cocktails file and empties the journal
+        monkeypatch.setattr(self.helpers.settings, 'JOURNAL_COMPACT_BYTES', 1)
+        writer.set_favorite('vodka_cola')
+        writer._compactor.join()
+        assert journal_file.read_text() == ''
+        assert json.loads(cocktails_file.read_text()) == {'cocktails': [gin_and_tonic, {**edited, 'favorite': True}]}
+        assert reader.cocktails() == writer.cocktails() == [gin_and_tonic, {**edited, 'favorite': True}]
+
+    def test_diff_cocktails(self):
+        """Test that cocktails are diffed by ID into added, removed, changed and favorited"""
+        self.get_helpers()
+        vodka_cola = {'normal_name': 'Vodka Cola', 'ingredients': {'Vodka': '2 oz'}}
+        gin_and_tonic = {'normal_name': 'Gin and Tonic'}
+        margarita = {'normal_name': 'Margarita'}
+        old = [vodka_cola, gin_and_tonic, margarita]
+        new = [{**margarita, 'favorite': True}, {**vodka_cola, 'ingredients': {'Vodka': '3 oz'}}, {'normal_name': 'Daiquiri'}]
+        assert [(change.kind, change.cocktail_id) for change in self.helpers.diff_cocktails(old, new)] == [
+            ('favorited', 'margarita'), ('changed', 'vodka_cola'), ('added', 'daiquiri'), ('removed', 'gin_and_tonic'),
+        ]
+        assert self.helpers.diff_cocktails(old, list(reversed(old))) == []
+
     def test_save_base64_image(self):
         """Test that b64 image saves and is reloadable"""
         self.get_helpers()
@@ -0,0 +1,39 @@
+class TestIngredients:
+    def get_ingredients(self):
+        """Get ingredients from parent directory with default settings"""
+        import sys
+        sys.path.append('.')
+        import ingredients
+        self.ingredients = ingredients
+
+    def test_normalize_ingredient(self):
+        """Test that ingredient names are normalized and aliases resolved"""
+        self.get_ingredients()
+        assert self.ingredients.normalize_ingredient('  Lime   Juice ') == 'lime juice'
+        assert self.ingredients.normalize_ingredient('Fresh Lime-Juice') == 'lime juice'
+        assert self.ingredients.normalize_ingredient('Whiskey') == 'whisky'
+        assert self.ingredients.normalize_ingredient('Coca-Cola') == 'coke'
+
+    def test_ingredient_index(self):
+        """Test resolving ingredients to pumps through aliases"""
+        self.get_ingredients()
+        index = self.ingredients.IngredientIndex({'Pump 2': 'coke', 'Pump 3': 'whisky', 'Pump 4': '', 'Pump X': 'gin'})
+        assert len(index) == 2
+        assert index.pump_index('Whiskey') == 2
+        assert index.pump_label('cola') == 'Pump 2'
+        assert index.pump_index('Gin') is None
+        assert index.missing({'Whiskey': '2 oz', 'Gin': '1 oz'}) == ['Gin']
+
+    def test_get_ingredient_index(self, tmp_path):
+        """Test that the shared index is only rebuilt when the pump config file changes"""
+        self.get_ingredients()
+        config_file = str(tmp_path / 'pump_config.json')
+        with open(config_file, 'w') as f:
+            f.write('{"Pump 1": "vodka"}')
+        index = self.ingredients.get_ingredient_index(config_file)
+        assert index.pump_index('Vodka') == 0
+        assert self.ingredients.get_ingredient_index(config_file) is index
+
+        with open(config_file, 'w') as f:
+            f.write('{"Pump 1": "vodka", "Pump 2": "gin"}')
+        assert self.ingredients.get_ingredient_index(config_file).pump_index('Gin') == 1
@@ -0,0 +1,32 @@
+class TestMetrics:
+    def get_metrics(self):
+        """Get metrics from parent directory with default settings"""
+        import sys
+        sys.path.append('.')
+        import metrics
+        self.metrics = metrics
+
+    def test_render_and_parse(self, tmp_path):
+        """Test that counters and histograms round trip through the Prometheus text format"""
+        self.get_metrics()
+        registry = self.metrics.MetricsRegistry()
+        pours = registry.counter('test_pours_total', 'Pours', ['pump'])
+        duration = registry.histogram('test_pour_seconds', 'Pour seconds', ['pump'], buckets=(1, 5))
+        pours.inc(pump=1)
+        pours.inc(2, pump=1)
+        duration.observe(0.5, pump=1)
+        duration.observe(3, pump=1)
+        assert registry.counter('test_pours_total', 'Pours', ['pump']) is pours
+
+        text = registry.render()
+        assert '# TYPE test_pour_seconds histogram' in text
+        assert 'test_pours_total{pump="1"} 3' in text
+        assert 'test_pour_seconds_bucket{pump="1",le="+Inf"} 2' in text
+
+        metrics_file = tmp_path / 'metrics.prom'
+        registry.write(str(metrics_file))
+        samples = self.metrics.read_metrics(str(metrics_file))
+        assert ('test_pour_seconds_bucket', {'pump': '1', 'le': '1'}, 1.0) in samples
+        assert ('test_pour_seconds_sum', {'pump': '1'}, 3.5) in samples
+        assert duration.value(pump=1) == (3.5, 2)
+        assert self.metrics.read_metrics(str(tmp_path / 'missing.prom')) == []
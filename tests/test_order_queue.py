@@ -0,0 +1,157 @@
+import json
+import time
+
+import pytest
+
+
+class TestOrderQueue:
+    def get_order_queue(self):
+        """Get order_queue from parent directory with default settings"""
+        import sys
+        sys.path.append('.')
+        import order_queue
+        self.order_queue = order_queue
+
+    def get_scheduler(self, monkeypatch):
+        import controller
+        from gpio_backends import SimulatedBackend
+        monkeypatch.setattr(controller, 'OZ_COEFFICIENT', 1.0)
+        monkeypatch.setattr(controller, 'RETRACTION_TIME', 0)
+        scheduler = controller.PumpScheduler(backend=SimulatedBackend())
+        index = controller.IngredientIndex({'Pump 1': 'vodka', 'Pump 2': 'coke'})
+
+        def submit(recipe, size):
+            plan = controller.compile_recipe(recipe['ingredients'], index)
+            return scheduler.submit_drink(plan.double if size == 'double' else plan.single)
+
+        return scheduler, submit
+
+    def test_positions_and_eta(self, tmp_path, monkeypatch):
+        """Test that orders wait in line with an ETA that counts the orders ahead, and are kept on disk"""
+        self.get_order_queue()
+        monkeypatch.setattr(self.order_queue.controller, 'drink_seconds', lambda recipe, size: 10.0 if size == 'single' else 20.0)
+        orders_file = str(tmp_path / 'orders.json')
+        queue = self.order_queue.OrderQueue(orders_file)
+        first = queue.enqueue({'normal_name': 'Vodka Cola'}, 'single', source='touchscreen')
+        second = queue.enqueue({'normal_name': 'Margarita'}, 'double', source='web')
+        assert (first.id, first.status, first.position, first.eta) == (1, 'queued', 0, 10.0)
+        assert (second.id, second.position, second.eta, second.source) == (2, 1, 30.0, 'web')
+
+        assert queue.cancel(first.id)
+        assert not queue.cancel(first.id)
+        assert queue.status(first.id).status == 'cancelled'
+        # Another process sees the same queue
+        restarted = self.order_queue.OrderQueue(orders_file)
+        assert [(order.id, order.position, order.eta) for order in restarted.orders()] == [(2, 0, 20.0)]
+        assert restarted.cancel_all() == [2]
+        assert restarted.orders() == []
+
+    def test_owner_pours_in_order(self, tmp_path, monkeypatch):
+        """Test that only one queue pours the orders, first in first out, and that another takes over when it stops"""
+        self.get_order_queue()
+        scheduler, submit = self.get_scheduler(monkeypatch)
+        orders_file = str(tmp_path / 'orders.json')
+        owner = self.order_queue.OrderQueue(orders_file, submit=submit, poll_interval=0.01)
+        other = self.order_queue.OrderQueue(orders_file, submit=submit, poll_interval=0.01)
+        scheduler.start()
+        owner.start()
+        other.start()
+        try:
+            assert owner.is_owner and not other.is_owner
+            vodka = {'normal_name': 'Vodka', 'ingredients': {'Vodka': '1 oz'}}
+            cola = {'normal_name': 'Vodka Cola', 'ingredients': {'Vodka': '1 oz', 'Coke': '2 oz'}}
+            watchers = [other.watch(other.enqueue(recipe).id) for recipe in (vodka, cola)]
+            for watcher in watchers:
+                assert watcher.wait(timeout=5)
+            assert [watcher.order.status for watcher in watchers] == ['done', 'done']
+            assert sorted(str(pour) for pour in watchers[1].refresh().pours) == ['Coke: 2.0 oz.', 'Vodka: 1.0 oz.']
+            assert scheduler.backend.clock.monotonic() == pytest.approx(1.0 + 2.0)
+
+            owner.stop()
+            watcher = other.watch(other.enqueue(vodka).id)
+            assert watcher.wait(timeout=5) and watcher.order.status == 'done'
+            assert other.is_owner
+        finally:
+            owner.stop()
+            other.stop()
+            scheduler.stop()
+
+    def test_recover_after_restart(self, tmp_path, monkeypatch):
+        """Test that a drink left pouring by a stopped owner is marked failed, queued drinks still pour and stale ones expire"""
+        self.get_order_queue()
+        scheduler, submit = self.get_scheduler(monkeypatch)
+        orders_file = tmp_path / 'orders.json'
+        vodka = {'normal_name': 'Vodka', 'ingredients': {'Vodka': '1 oz'}}
+        now = time.time()
+        orders_file.write_text(json.dumps({'next_id': 4, 'orders': [
+            {'id': 1, 'name': 'Vodka', 'recipe': vodka, 'size': 'single', 'status': 'pouring', 'source': None,
+             'ordered_at': now - 10, 'started_at': now - 10, 'duration': 1.0, 'pours': []},
+            {'id': 2, 'name': 'Vodka', 'recipe': vodka, 'size': 'single', 'status': 'queued', 'source': None,
+             'ordered_at': now - 3600, 'started_at': None, 'duration': 1.0, 'pours': []},
+            {'id': 3, 'name': 'Vodka', 'recipe': vodka, 'size': 'double', 'status': 'queued', 'source': None,
+             'ordered_at': now - 10, 'started_at': None, 'duration': 2.0, 'pours': []},
+        ]}))
+        queue = self.order_queue.OrderQueue(str(orders_file), submit=submit, poll_interval=0.01)
+        scheduler.start()
+        queue.start()
+        try:
+            assert queue.watch(3).wait(timeout=5)
+            assert [order.status for order in queue.orders(active=False)] == ['failed', 'expired', 'done']
+        finally:
+            queue.stop()
+            scheduler.stop()
+
+    def test_watcher_polls_at_poll_interval(self, tmp_path, monkeypatch):
+        """Test that waiting on an order checks the queue at most once every poll_interval"""
+        self.get_order_queue()
+        queue = self.order_queue.OrderQueue(str(tmp_path / 'orders.json'), poll_interval=0.2)
+        order = queue.enqueue({'normal_name': 'Vodka', 'ingredients': {'Vodka': '1 oz'}})
+        watcher = queue.watch(order.id)
+        checks = []
+        status = queue.status
+        monkeypatch.setattr(queue, 'status', lambda order_id: checks.append(order_id) or status(order_id))
+        started = time.monotonic()
+        while time.monotonic() - started < 0.5:
+            assert not watcher.wait_for_change(timeout=0.01)
+        assert 1 <= len(checks) <= 3
+
+    def test_emergency_stop_from_another_process(self, tmp_path, monkeypatch):
+        """Test that a queue that doesn't own the pumps has the owner stop them at once, not at its next poll"""
+        self.get_order_queue()
+        import controller
+        from gpio_backends import SimulatedBackend, RealClock
+        monkeypatch.setattr(controller, 'OZ_COEFFICIENT', 60.0)
+        monkeypatch.setattr(controller, 'RETRACTION_TIME', 0)
+        scheduler = controller.PumpScheduler(backend=SimulatedBackend(RealClock()))
+        monkeypatch.setattr(controller, '_scheduler', scheduler)
+        index = controller.IngredientIndex({'Pump 1': 'vodka'})
+
+        def submit(recipe, size):
+            return scheduler.submit_drink(controller.compile_recipe(recipe['ingredients'], index).single)
+
+        orders_file = str(tmp_path / 'orders.json')
+        # Polls far too rarely to explain how quickly either queue reacts
+        owner = self.order_queue.OrderQueue(orders_file, submit=submit, poll_interval=30)
+        other = self.order_queue.OrderQueue(orders_file, submit=submit, poll_interval=30)
+        scheduler.start()
+        owner.start()
+        other.start()
+        try:
+            assert owner.is_owner and not other.is_owner
+            order = other.enqueue({'normal_name': 'Vodka', 'ingredients': {'Vodka': '1 oz'}})
+            deadline = time.monotonic() + 5
+            while owner.local_watcher(order.id) is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+            pouring = owner.local_watcher(order.id)
+            while not pouring.pours[0].running:
+                pouring.wait_for_change(timeout=5)
+
+            stopping_at = time.monotonic()
+            assert other.emergency_stop() == []
+            assert pouring.wait(timeout=5) and pouring.pours[0].emergency_stopped
+            assert time.monotonic() - stopping_at < 1
+            assert other.status(order.id).status == 'cancelled'
+        finally:
+            other.stop()
+            owner.stop()
+            scheduler.stop()
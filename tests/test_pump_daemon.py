@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+
+class TestPumpDaemon:
+    def get_pump_daemon(self):
+        """Get pump_daemon from parent directory with default settings"""
+        import sys
+        sys.path.append('.')
+        import pump_daemon
+        self.pump_daemon = pump_daemon
+
+    @pytest.fixture
+    def daemon(self, tmp_path, monkeypatch):
+        """A PumpDaemon pouring on the simulated backend, serving from a thread"""
+        self.get_pump_daemon()
+        import controller
+        from gpio_backends import SimulatedBackend
+        from order_queue import OrderQueue
+        monkeypatch.setattr(controller, 'OZ_COEFFICIENT', 1.0)
+        monkeypatch.setattr(controller, 'RETRACTION_TIME', 0)
+        scheduler = controller.PumpScheduler(backend=SimulatedBackend())
+        monkeypatch.setattr(controller, '_scheduler', scheduler)
+        index = controller.IngredientIndex({'Pump 1': 'vodka', 'Pump 2': 'coke'})
+
+        def submit(recipe, size):
+            plan = controller.compile_recipe(recipe['ingredients'], index)
+            return scheduler.submit_drink(plan.double if size == 'double' else plan.single)
+
+        queue = OrderQueue(str(tmp_path / 'orders.json'), submit=submit, poll_interval=0.01)
+        daemon = self.pump_daemon.PumpDaemon(str(tmp_path / 'pumps.sock'), queue)
+        scheduler.start()
+        thread = threading.Thread(target=daemon.serve)
+        thread.start()
+        try:
+            yield daemon
+        finally:
+            daemon.shutdown()
+            thread.join()
+            scheduler.stop()
+
+    def test_orders(self, daemon):
+        """Test making drinks, looking them up and cancelling them through the daemon"""
+        client = self.pump_daemon.connect(daemon.socket_path)
+        assert client is not None and client.is_owner
+        client.poll_interval = 0.01
+        vodka = {'normal_name': 'Vodka', 'ingredients': {'Vodka': '1 oz'}}
+        order = client.enqueue(vodka, 'double', source='test')
+        assert (order.name, order.size, order.source) == ('Vodka', 'double', 'test')
+        watcher = client.watch(order.id)
+        assert watcher.wait(timeout=5)
+        assert client.status(order.id).status == 'done'
+        assert [(pour.ingredient_name, pour.amount, pour.state) for pour in watcher.pours] == [('Vodka', 2.0, 'done')]
+        assert client.orders() == []
+        assert client.cancel(order.id) is False
+        assert [order.id for order in client.orders(active=False)] == [order.id]
+
+    def test_maintenance(self, daemon):
+        """Test that priming runs in the daemon and reports progress back to the client"""
+        client = self.pump_daemon.connect(daemon.socket_path)
+        client.poll_interval = 0.01
+        progress = []
+        watcher = client.prime_pumps({0: 1.0, 3: 2.0}, pumps=[0, 3], concurrency=2, callback=progress.append)
+        assert watcher.done() and not watcher.cancelled
+        assert [(run.pump_index, run.state, run.seconds) for run in progress[-1]] == [(0, 'done', 1.0), (3, 'done', 2.0)]
+
+    def test_errors(self, daemon, tmp_path):
+        """Test that failed requests raise on the client and a missing daemon gives no client"""
+        client = self.pump_daemon.connect(daemon.socket_path)
+        with pytest.raises(self.pump_daemon.PumpDaemonError):
+            client.request('no_such_op')
+        with pytest.raises(self.pump_daemon.PumpDaemonError):
+            client.request('job', job_id=404)
+        assert client.request('ping') == 'pong'
+        assert self.pump_daemon.connect(str(tmp_path / 'missing.sock')) is None
+
+    def test_socket_in_use(self, daemon, tmp_path):
+        """Test that a second daemon won't take over a running daemon's socket, but replaces a stale one"""
+        import socket
+        from order_queue import OrderQueue
+        queue = OrderQueue(str(tmp_path / 'other_orders.json'))
+        with pytest.raises(self.pump_daemon.PumpDaemonError):
+            self.pump_daemon.PumpDaemon(daemon.socket_path, queue)
+        assert self.pump_daemon.connect(daemon.socket_path).request('ping') == 'pong'
+
+        stale_path = str(tmp_path / 'stale.sock')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(stale_path)
+        replacement = self.pump_daemon.PumpDaemon(stale_path, queue)
+        replacement.server_close()
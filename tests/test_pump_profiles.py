@@ -0,0 +1,48 @@
+import json
+import os
+import pytest
+
+
+class TestPumpProfiles:
+    def get_pump_profiles(self):
+        """Get pump_profiles from parent directory with default settings"""
+        import sys
+        sys.path.append('.')
+        import pump_profiles
+        self.pump_profiles = pump_profiles
+
+    def test_pump_profiles(self):
+        """Test that pumps without a profile use the default current draw"""
+        self.get_pump_profiles()
+        profiles = self.pump_profiles.PumpProfiles({'Pump 4': {'current_draw': 2.5}, 'Pump X': {'current_draw': 1}, 'Pump 5': {'amps': 1}})
+        assert profiles[3].current_draw == 2.5
+        assert profiles[0].current_draw == self.pump_profiles.settings.PUMP_CURRENT_DRAW
+        assert 4 not in profiles
+        profiles.set(0, current_draw=0.5)
+        assert profiles.to_json() == {'Pump 1': {'current_draw': 0.5, 'dead_volume': 0.0}, 'Pump 4': {'current_draw': 2.5, 'dead_volume': 0.0}}
+
+    def test_fit_calibration(self):
+        """Test fitting seconds per ounce and dead volume from measured pours"""
+        self.get_pump_profiles()
+        seconds_per_oz, dead_volume = self.pump_profiles.fit_calibration([(6, 0.5), (11, 1.0), (21, 2.0)])
+        assert round(seconds_per_oz, 6) == 10
+        assert round(dead_volume, 6) == 0.1
+        assert self.pump_profiles.fit_calibration([(8, 1.0)]) == (8.0, 0.0)
+        # A negative dead volume is fitted through the origin instead
+        assert self.pump_profiles.fit_calibration([(4, 1.0), (12, 2.0)])[1] == 0.0
+        with pytest.raises(ValueError):
+            self.pump_profiles.fit_calibration([(5, 0)])
+
+    def test_get_pump_profiles(self, tmp_path):
+        """Test that profiles are saved and only read again when the file changes"""
+        self.get_pump_profiles()
+        profiles_file = str(tmp_path / 'pump_profiles.json')
+        assert 0 not in self.pump_profiles.get_pump_profiles(profiles_file)
+
+        self.pump_profiles.save_pump_profiles(self.pump_profiles.PumpProfiles({'Pump 1': {'current_draw': 3}}), profiles_file)
+        profiles = self.pump_profiles.get_pump_profiles(profiles_file)
+        assert profiles[0].current_draw == 3
+        assert self.pump_profiles.get_pump_profiles(profiles_file) is profiles
+        with open(profiles_file) as f:
+            assert json.load(f) == {'Pump 1': {'current_draw': 3, 'dead_volume': 0.0}}
+        assert not os.path.exists(f'{profiles_file}.tmp')
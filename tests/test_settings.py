@@ -12,16 +12,33 @@ class TestSettings:
         'FULL_SCREEN': 'false',
         'OZ_COEFFICIENT': 10,
         'RETRACTION_TIME': 10,
+        'RETRACTION_IDLE_TIMEOUT': 15,
+        'ORDER_EXPIRY': 60,
+        'SPECULATIVE_PRIME_DWELL': 1.5,
+        'BATCH_CAPACITY': 96.0,
+        'BATCH_CHUNK_OUNCES': 1.5,
+        'JOURNAL_COMPACT_BYTES': 1024,
         'USE_GPT_TRANSPARENCY': 'true',
         'COCKTAIL_IMAGE_SCALE': 0.75,
         'SHOW_RELOAD_COCKTAILS_BUTTON': 'true',
         'PUMP_CONCURRENCY': 2,
+        'MAINTENANCE_CONCURRENCY': 6,
+        'POWER_BUDGET': 5.5,
+        'PUMP_CURRENT_DRAW': 0.8,
+        'PUMP_PROFILES_FILE': 'test_pump_profiles.json',
         'PUMP_CONFIG_FILE': 'test_pump_config.json',
         'COCKTAILS_FILE': 'test_cocktails.json',
         'LOGO_FOLDER': 'test_drink_logos',
         'INVERT_PUMP_PINS': 'true',
         'RELOAD_COCKTAILS_TIMEOUT': 3000,
-        'ALLOW_FAVORITES': 'true'
+        'FILE_WATCH_DEBOUNCE': 0.5,
+        'ALLOW_FAVORITES': 'true',
+        'GPIO_BACKEND': 'simulated',
+        'METRICS_FILE': 'test_metrics.prom',
+        'ORDERS_FILE': 'test_orders.json',
+        'PUMP_SOCKET': 'test_pumps.sock',
+        'STORAGE_BACKEND': 'sqlite',
+        'DATABASE_FILE': 'test_tipsy.db',
     }
 
     def get_settings(self, **config):
@@ -39,14 +56,31 @@ class TestSettings:
         assert self.settings.CONFIG_FILE == 'pump_config.json'
         assert self.settings.COCKTAILS_FILE == 'cocktails.json'
         assert self.settings.LOGO_FOLDER == 'drink_logos'
+        assert self.settings.GPIO_BACKEND == 'auto'
+        assert self.settings.METRICS_FILE == 'metrics.prom'
+        assert self.settings.ORDERS_FILE == 'orders.json'
+        assert self.settings.PUMP_SOCKET == 'pumps.sock'
+        assert self.settings.STORAGE_BACKEND == 'json'
+        assert self.settings.DATABASE_FILE == 'tipsy.db'
         assert self.settings.OPENAI_API_KEY == None
         assert self.settings.OZ_COEFFICIENT == 8.0
         assert self.settings.INVERT_PUMP_PINS == False
         assert self.settings.PUMP_CONCURRENCY == 3
+        assert self.settings.MAINTENANCE_CONCURRENCY == 4
+        assert self.settings.POWER_BUDGET == 0
+        assert self.settings.PUMP_CURRENT_DRAW == 1.0
+        assert self.settings.PUMP_PROFILES_FILE == 'pump_profiles.json'
         assert self.settings.FULL_SCREEN == True
         assert self.settings.SHOW_RELOAD_COCKTAILS_BUTTON == False
         assert self.settings.RELOAD_COCKTAILS_TIMEOUT == 0
+        assert self.settings.FILE_WATCH_DEBOUNCE == 0.25
         assert self.settings.RETRACTION_TIME == 0
+        assert self.settings.RETRACTION_IDLE_TIMEOUT == 30
+        assert self.settings.ORDER_EXPIRY == 300
+        assert self.settings.SPECULATIVE_PRIME_DWELL == 0
+        assert self.settings.BATCH_CAPACITY == 64
+        assert self.settings.BATCH_CHUNK_OUNCES == 2
+        assert self.settings.JOURNAL_COMPACT_BYTES == 65536
         assert self.settings.USE_GPT_TRANSPARENCY == False
         assert self.settings.COCKTAIL_IMAGE_SCALE == 1.0
         assert self.settings.ALLOW_FAVORITES == False
@@ -59,14 +93,31 @@ class TestSettings:
         assert self.settings.CONFIG_FILE == 'test_pump_config.json'
         assert self.settings.COCKTAILS_FILE == 'test_cocktails.json'
         assert self.settings.LOGO_FOLDER == 'test_drink_logos'
+        assert self.settings.GPIO_BACKEND == 'simulated'
+        assert self.settings.METRICS_FILE == 'test_metrics.prom'
+        assert self.settings.ORDERS_FILE == 'test_orders.json'
+        assert self.settings.PUMP_SOCKET == 'test_pumps.sock'
+        assert self.settings.STORAGE_BACKEND == 'sqlite'
+        assert self.settings.DATABASE_FILE == 'test_tipsy.db'
         assert self.settings.OPENAI_API_KEY == 'test token'
         assert self.settings.OZ_COEFFICIENT == 10
         assert self.settings.INVERT_PUMP_PINS == True
         assert self.settings.PUMP_CONCURRENCY == 2
+        assert self.settings.MAINTENANCE_CONCURRENCY == 6
+        assert self.settings.POWER_BUDGET == 5.5
+        assert self.settings.PUMP_CURRENT_DRAW == 0.8
+        assert self.settings.PUMP_PROFILES_FILE == 'test_pump_profiles.json'
         assert self.settings.FULL_SCREEN == False
         assert self.settings.SHOW_RELOAD_COCKTAILS_BUTTON == True
         assert self.settings.RELOAD_COCKTAILS_TIMEOUT == 3000
+        assert self.settings.FILE_WATCH_DEBOUNCE == 0.5
         assert self.settings.RETRACTION_TIME == 10
+        assert self.settings.RETRACTION_IDLE_TIMEOUT == 15
+        assert self.settings.ORDER_EXPIRY == 60
+        assert self.settings.SPECULATIVE_PRIME_DWELL == 1.5
+        assert self.settings.BATCH_CAPACITY == 96.0
+        assert self.settings.BATCH_CHUNK_OUNCES == 1.5
+        assert self.settings.JOURNAL_COMPACT_BYTES == 1024
         assert self.settings.USE_GPT_TRANSPARENCY == True
         assert self.settings.COCKTAIL_IMAGE_SCALE == 0.75
         assert self.settings.ALLOW_FAVORITES == True
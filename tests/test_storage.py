@@ -0,0 +1,107 @@
+import json
+import threading
+
+
+class TestStorage:
+    def get_storage(self):
+        """Get storage from parent directory with default settings"""
+        import sys
+        sys.path.append('.')
+        import storage
+        self.storage = storage
+
+    def test_cocktails_and_favorites(self, tmp_path):
+        """Test that cocktails round trip in order, and favorites and single cocktails are saved on their own"""
+        self.get_storage()
+        database = self.storage.SQLiteStorage(str(tmp_path / 'tipsy.db'))
+        vodka_cola = {'normal_name': 'Vodka Cola', 'ingredients': {'Vodka': '2 oz', 'Coke': '4 oz'}}
+        margarita = {'normal_name': 'Margarita', 'ingredients': {'Tequila': '2 oz', 'Lime Juice': '1 oz'}, 'favorite': True}
+        revision = database.revision()
+        assert database.save_cocktails({'cocktails': [vodka_cola, margarita]}) == (revision, revision + 1)
+        assert database.load_cocktails() == {'cocktails': [{**vodka_cola, 'favorite': False}, margarita]}
+
+        assert database.set_favorite('vodka_cola') == (revision + 1, revision + 2)
+        database.save_cocktail({**margarita, 'favorite': False, 'ingredients': {'Tequila': '3 oz'}}, 1)
+        assert [(cocktail['normal_name'], cocktail['favorite']) for cocktail in database.load_cocktails()['cocktails']] == [
+            ('Vodka Cola', True), ('Margarita', False),
+        ]
+        assert database.load_cocktails()['cocktails'][1]['ingredients'] == {'Tequila': '3 oz'}
+
+    def test_import_json(self, tmp_path):
+        """Test importing the JSON files, and that another connection sees the import in one piece"""
+        self.get_storage()
+        cocktails_file = tmp_path / 'cocktails.json'
+        config_file = tmp_path / 'pump_config.json'
+        cocktails = [{'normal_name': f'Cocktail {index}', 'ingredients': {'Vodka': f'{index} oz'}} for index in range(50)]
+        cocktails_file.write_text(json.dumps({'cocktails': cocktails}))
+        config_file.write_text(json.dumps({'Pump 1': 'vodka', 'Pump 2': 'coke', 'Pump 10': 'gin'}))
+        database_file = str(tmp_path / 'tipsy.db')
+
+        assert self.storage.main(['import', '--cocktails', str(cocktails_file), '--pump-config', str(config_file), '--database', database_file]) is None
+        database = self.storage.SQLiteStorage(database_file)
+        assert list(database.load_pump_config().items()) == [('Pump 1', 'vodka'), ('Pump 2', 'coke'), ('Pump 10', 'gin')]
+        assert [cocktail['normal_name'] for cocktail in database.load_cocktails()['cocktails']] == [cocktail['normal_name'] for cocktail in cocktails]
+
+        # A reader in another thread sees every cocktail or none of a rewrite, never part of it
+        counts = []
+        stop = threading.Event()
+
+        def read():
+            reader = self.storage.SQLiteStorage(database_file)
+            while not stop.is_set():
+                counts.append(len(reader.load_cocktails()['cocktails']))
+            reader.close()
+
+        thread = threading.Thread(target=read)
+        thread.start()
+        try:
+            for _ in range(5):
+                database.save_cocktails({'cocktails': cocktails[:10]})
+                database.save_cocktails({'cocktails': cocktails})
+        finally:
+            stop.set()
+            thread.join()
+        assert set(counts) <= {10, 50}
+
+    def test_import_journaled_changes(self, tmp_path):
+        """Test that importing picks up the cocktail edits journaled since the file was last compacted"""
+        self.get_storage()
+        from journal import CocktailJournal
+        cocktails_file = tmp_path / 'cocktails.json'
+        vodka_cola = {'normal_name': 'Vodka Cola', 'ingredients': {'Vodka': '2 oz', 'Coke': '4 oz'}}
+        margarita = {'normal_name': 'Margarita', 'ingredients': {'Tequila': '2 oz'}}
+        cocktails_file.write_text(json.dumps({'cocktails': [vodka_cola]}))
+        CocktailJournal(str(cocktails_file)).append([
+            {'op': 'upsert', 'cocktail': {**vodka_cola, 'favorite': True}},
+            {'op': 'upsert', 'cocktail': margarita},
+        ])
+
+        database = self.storage.SQLiteStorage(str(tmp_path / 'tipsy.db'))
+        assert database.import_json(str(cocktails_file), str(tmp_path / 'missing.json')) == (2, 0)
+        assert [(cocktail['normal_name'], cocktail['favorite']) for cocktail in database.load_cocktails()['cocktails']] == [
+            ('Vodka Cola', True), ('Margarita', False),
+        ]
+
+    def test_sqlite_backend(self, tmp_path, monkeypatch):
+        """Test that helpers and the ingredient index read and write the database when it's the storage backend"""
+        self.get_storage()
+        import helpers
+        from ingredients import get_ingredient_index
+        monkeypatch.setattr(self.storage.settings, 'STORAGE_BACKEND', 'sqlite')
+        monkeypatch.setattr(self.storage.settings, 'DATABASE_FILE', str(tmp_path / 'tipsy.db'))
+        monkeypatch.setattr(self.storage.settings, 'LOGO_FOLDER', str(tmp_path))
+        (tmp_path / 'vodka_cola.png').write_bytes(b'')
+        (tmp_path / 'gin_and_tonic.png').write_bytes(b'')
+
+        helpers.save_config({'Pump 1': 'vodka', 'Pump 2': 'coke'})
+        assert helpers.load_saved_config() == {'Pump 1': 'vodka', 'Pump 2': 'coke'}
+        assert get_ingredient_index().pump_index('Vodka') == 0
+        helpers.save_config({'Pump 3': 'vodka'})
+        assert get_ingredient_index().pump_index('Vodka') == 2
+
+        vodka_cola = {'normal_name': 'Vodka Cola', 'ingredients': {'Vodka': '2 oz'}}
+        gin_and_tonic = {'normal_name': 'Gin and Tonic', 'ingredients': {'Gin': '2 oz'}}
+        helpers.save_cocktails({'cocktails': [vodka_cola, gin_and_tonic]}, append=False)
+        assert helpers.favorite_cocktail(1) == 0
+        assert [cocktail['normal_name'] for cocktail in helpers.get_valid_cocktails()] == ['Gin and Tonic', 'Vodka Cola']
+        assert self.storage.get_storage().load_cocktails()['cocktails'][1]['favorite'] is True